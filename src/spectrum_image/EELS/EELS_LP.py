@@ -5,14 +5,16 @@ from matplotlib.backend_bases import MouseButton
 
 import spectrum_image.EELS.EELS_bgsub as bg
 from spectrum_image.EELS.EELS_edge import EELS_edge
+from spectrum_image.EELS.EELS_chunks import chunked_mean, nan_to_zero
+from spectrum_image.EELS.EELS_axis import EnergyAxis, searchsorted
+from spectrum_image.EELS.EELS_onset import edge_onset, suggest_edge
 
 class LineProfile :
     def __init__( self, lp, energy, adf=None, xaxis=None ):
-
-        lp[np.isnan(lp)] = 0
+        # lp is kept by reference (no copy), NaNs are zeroed chunk by chunk when reduced
         self.lp = lp
         (self.nx,  self.ne) = self.lp.shape
-        self.eaxis = np.asarray( energy )
+        self.eaxis = energy if isinstance( energy, EnergyAxis ) else np.asarray( energy )
 
         self.adf = adf
         if xaxis is None:
@@ -21,13 +23,14 @@ class LineProfile :
         self.yaxis = xaxis
         
     def fitbrowser( self, edge=None, cmap='gray', figsize=(9,6)):
+        # edge - EELS_edge, or 'auto' to suggest windows from the edge onset of the mean spectrum
         
         ## Initialize browser object
-        self.spectrum1 = np.mean(self.lp,axis=(0))
-        self.spectrum2 = np.mean(self.lp,axis=(0))
+        self.spectrum1 = chunked_mean(self.lp,axis=(0))
+        self.spectrum2 = self.spectrum1.copy()
 
         self.im_inel = self.lp
-        self.lp_inel = np.mean( self.lp, axis=1)
+        self.lp_inel = chunked_mean( self.lp, axis=1)
 
         self.bsub1 = self.spectrum1
         self.bsub1_fit  = np.zeros_like( self.spectrum1 )
@@ -222,6 +225,9 @@ class LineProfile :
         self.fig.canvas.mpl_connect( 'motion_notify_event', 
                                     lambda event: self.onclick_figure(event))
         
+        if isinstance( edge, str ) and edge == 'auto':
+            onset = edge_onset( self.spectrum1, self.eaxis )
+            edge = suggest_edge( self.eaxis, onset, label=" " ) if np.isfinite( onset ) else None
         if edge is None:
             self.edge = EELS_edge( " ", (self.eaxis[0],self.eaxis[-1]), (self.eaxis[0],self.eaxis[-1]) )
             self.ax['e_bsub'].set_visible(False)
@@ -324,7 +330,7 @@ class LineProfile :
         if emin == emax:
             emax += 1
 
-        self.spectrum1=np.mean( self.lp[ymin:ymax,:],axis=(0))
+        self.spectrum1=np.mean( nan_to_zero( self.lp[ymin:ymax,:] ),axis=(0))
         self.ax['spec'].set_xlim( (emin,emax) )
 
         self.h['plot_roi1'].extents = ( real_roi[2], real_roi[3])
@@ -344,7 +350,7 @@ class LineProfile :
             emax += 1
 
     
-        self.spectrum2=np.mean( self.lp[ymin:ymax,:],axis=(0))
+        self.spectrum2=np.mean( nan_to_zero( self.lp[ymin:ymax,:] ),axis=(0))
         self.ax['spec2'].set_xlim((emin,emax) )
         self.h['plot_roi2'].extents = ( real_roi[2], real_roi[3])
         self.h['spec2'].set_ydata( self.spectrum2)
@@ -352,7 +358,7 @@ class LineProfile :
         self.rescale_yrange()
         
     def update_fit1(self):
-        ind_min = np.searchsorted( self.eaxis, self.edge.e_bsub[0])
+        ind_min = searchsorted( self.eaxis, self.edge.e_bsub[0])
 
         self.h['bsub1'].set_ydata(self.bsub1)
         self.h['bsub1'].set_color('orangered')
@@ -364,7 +370,7 @@ class LineProfile :
         self.rescale_yrange()
         
     def update_fit2(self):
-        ind_min = np.searchsorted( self.eaxis, self.edge.e_bsub[0])
+        ind_min = searchsorted( self.eaxis, self.edge.e_bsub[0])
 
         self.h['bsub2'].set_ydata(self.bsub2)
         self.h['bsub2'].set_color('steelblue')
@@ -522,12 +528,12 @@ class LineProfile :
             self.update_image()
 
     def update_image(self):
-        indmin, indmax = np.searchsorted(self.eaxis, self.edge.e_int)
+        indmin, indmax = searchsorted(self.eaxis, self.edge.e_int)
         if indmin == indmax:
             indmax +1
 
         if self.lp_bsub is None:
-            self.lp_inel = np.mean(self.lp[:,indmin:indmax],axis=(-1))
+            self.lp_inel = chunked_mean(self.lp[:,indmin:indmax],axis=(-1))
         else:           
             self.lp_inel = np.mean(self.lp_bsub[:,indmin:indmax],axis=(-1))
         
@@ -5,14 +5,18 @@ from matplotlib.backend_bases import MouseButton
 
 import spectrum_image.EELS.EELS_bgsub as bg
 from spectrum_image.EELS.EELS_edge import EELS_edge
+from spectrum_image.EELS.EELS_roi import rect_mask, roi_spectra, roi_colors, line_profile
+from spectrum_image.EELS.EELS_LP import LineProfile
+from spectrum_image.EELS.EELS_chunks import chunked_mean
+from spectrum_image.EELS.EELS_stats import SIStats
+from spectrum_image.EELS.EELS_axis import EnergyAxis, searchsorted
+from spectrum_image.EELS.EELS_onset import edge_onset, suggest_edge
 
 class SpectrumImage :
     def __init__( self, si, energy, adf=None, xaxis=None, yaxis=None ):
-
-        si[np.isnan(si)] = 0
+        # si is kept by reference (no copy, memmaps stay on disk), NaNs are zeroed chunk by chunk when reduced
         self.si = si
-        (self.ny, self.nx, self.ne) = self.si.shape
-        self.eaxis = np.asarray( energy )
+        self.eaxis = energy if isinstance( energy, EnergyAxis ) else np.asarray( energy )
 
         self.adf = adf
         if xaxis is None:
@@ -23,32 +27,85 @@ class SpectrumImage :
         self.xaxis = xaxis
         self.yaxis = yaxis
 
-    def fitbrowser( self, edge=None, cmap='gray', figsize=(9,6)):
+    @property
+    def si( self ):
+        return self._si
+
+    @si.setter
+    def si( self, si ):
+        # Replacing the data invalidates the cached statistics
+        self._si = si
+        (self.ny, self.nx, self.ne) = self._si.shape
+        self._stats = None
+
+    @property
+    def stats( self ):
+        # Summary statistics (SIStats), computed in a single pass on first use
+        if self._stats is None:
+            self._stats = SIStats( self._si )
+        return self._stats
+
+    def invalidate_stats( self ):
+        # Call after modifying si in place
+        if self._stats is not None:
+            self._stats.invalidate()
+
+    def line_profile( self, p0, p1, width=1, step=1 ):
+        """
+        Line profile between two points, averaged over a perpendicular width.
+        Spectra are bilinearly interpolated along the line, without shearing or copying the SI.
+
+        Inputs:
+        p0, p1 - (x, y) start and end points in pixels
+        width - integration width perpendicular to the line in pixels
+        step - sampling step along the line in pixels
+
+        Outputs:
+        LineProfile, with its scan axis in units of xaxis
+        """
+        lp, t = line_profile( self.si, p0, p1, width=width, step=step )
+
+        adf = None
+        if self.adf is not None:
+            adf, _ = line_profile( self.adf, p0, p1, width=width, step=step )
+
+        if len( self.xaxis ) > 1:
+            t = t*(self.xaxis[1]-self.xaxis[0])
+        return LineProfile( lp, self.eaxis, adf=adf, xaxis=t )
+
+    def fitbrowser( self, edge=None, cmap='gray', figsize=(9,6), rois=None):
         self.FitBrowser = FitBrowser(  si = self.si, adf=self.adf, 
                                    eaxis=self.eaxis,xaxis=self.xaxis, yaxis=self.yaxis,
-                                   edge=edge, cmap=cmap, figsize=figsize )
+                                   edge=edge, cmap=cmap, figsize=figsize, rois=rois,
+                                   stats=self.stats )
 
         
 class FitBrowser:
     
-    def __init__( self, si,adf,eaxis,xaxis,yaxis,edge=None, cmap='gray', figsize=(9,6)):
+    def __init__( self, si,adf,eaxis,xaxis,yaxis,edge=None, cmap='gray', figsize=(9,6), rois=None, stats=None):
+        # rois - optional list of boolean (ny,nx) masks added as extra ROIs
+        # stats - SIStats of si, shared with the SpectrumImage to avoid reducing the cube again
+        # edge - EELS_edge, or 'auto' to suggest windows from the edge onset of the mean spectrum
         
         ## Initialize browser object
         self.si = si
         (self.ny, self.nx, self.ne) = self.si.shape
+        if stats is None:
+            stats = SIStats( self.si )
+        self.stats = stats
         self.adf = adf
         self.eaxis = eaxis
         self.xaxis = xaxis
         self.yaxis = yaxis
-        self.spectrum1 = np.mean(self.si,axis=(0,1))
-        self.spectrum2 = np.mean(self.si,axis=(0,1))
 
-        self.im_inel = np.mean(self.si,axis=(-1))
+        # ROI 0 follows the left button, ROI 1.. are right button rectangles or masks
+        self.roi_masks = [np.ones( (self.ny,self.nx), dtype=bool ) for i in range(2)]
+        self.spectra = np.stack( [self.stats.mean_spectrum]*2 )
+        self.active_roi = 1
 
-        self.bsub1 = self.spectrum1
-        self.bsub1_fit  = np.zeros_like( self.spectrum1 )
-        self.bsub2 = self.spectrum2
-        self.bsub2_fit  = np.zeros_like( self.spectrum2 )
+        self.im_inel = self.stats.mean_image
+
+        self.bsubs = self.spectra.copy()
 
         self.fit_check = False
         self.int_check = False
@@ -73,8 +130,9 @@ class FitBrowser:
         self.ax['spec2'] = self.fig.add_axes([0.525,0.45,0.45,0.20]) # Spec 2
         self.ax['ck_ysetting'] = self.fig.add_axes([0.85,0.89,0.13,0.07]) # Y-lock chkbox
         self.ax['ck_roi2'] = self.fig.add_axes([0.025,0.0,0.15,0.05]) # ROI2 chkbox
+        self.ax['btn_roi'] = self.fig.add_axes([0.18,0.0,0.1,0.05]) # Add ROI Button
         if self.adf is not None:
-            self.ax['ck_adf'] = self.fig.add_axes([0.18,0.0,0.15,0.05]) # adf chkbox
+            self.ax['ck_adf'] = self.fig.add_axes([0.29,0.0,0.15,0.05]) # adf chkbox
         self.ax['e_view']=self.fig.add_axes( [0.625,0.30,0.25,0.05]) # Range slider
         self.ax['e_bsub']=self.fig.add_axes([0.625,0.25,0.25,0.05]) # Range slider
         self.ax['e_int'] =self.fig.add_axes([0.625,0.20,0.25,0.05]) # Range slider
@@ -95,11 +153,10 @@ class FitBrowser:
         self.ax['inel'].set_title('Inelastic image')
 
         ################## ax['spec'] #######################
-        self.h['spec1'], =self.ax['spec'].plot(self.eaxis, self.spectrum1,color='crimson')
-        self.h['bsub1'], =self.ax['spec'].plot(self.eaxis, self.bsub1,color='k',alpha=0)
-        self.h['fit1'],  =self.ax['spec'].plot(self.eaxis, self.bsub1_fit,color='palevioletred',alpha=0)
+        self.h['spec'], self.h['bsub'], self.h['fit'] = [], [], []
+        self.add_roi_lines( self.ax['spec'], 0 )
         self.ax['spec'].axhline(0,color='k',linestyle='--',alpha=0.3)
-        self.ax['spec'].set_ylim([self.spectrum1.min(),self.spectrum1.max()])
+        self.ax['spec'].set_ylim([self.spectra[0].min(),self.spectra[0].max()])
         self.ax['spec'].set_xlim([self.eaxis.min(),self.eaxis.max()])
         self.ax['spec'].set_yticks([])
         self.ax['spec'].set_xlabel('Energy (eV)')
@@ -107,11 +164,10 @@ class FitBrowser:
         self.ax['spec'].set_title('EELS spectrum')
 
         ################## ax['spec2'] #######################
-        self.h['spec2'], =self.ax['spec2'].plot(self.eaxis, self.spectrum2,color='royalblue',alpha=0)
-        self.h['bsub2'], =self.ax['spec2'].plot(self.eaxis, self.bsub1,color='k',alpha=0)
-        self.h['fit2'],  =self.ax['spec2'].plot(self.eaxis, self.bsub1_fit,color='palevioletred',alpha=0)
+        self.add_roi_lines( self.ax['spec2'], 1 )
+        self.h['spec'][1].set_alpha(0)
         self.ax['spec2'].axhline(0,color='k',linestyle='--',alpha=0.3)
-        self.ax['spec2'].set_ylim([self.spectrum1.min(),self.spectrum1.max()])
+        self.ax['spec2'].set_ylim([self.spectra[0].min(),self.spectra[0].max()])
         self.ax['spec2'].set_xlim([self.eaxis.min(),self.eaxis.max()])
         self.ax['spec2'].set_yticks([])
         self.ax['spec2'].set_xlabel('Energy (eV)')
@@ -132,11 +188,14 @@ class FitBrowser:
                                             actives=[False, False, True], check_props={'facecolor': 'k'} )
         self.ui['ck_fit'].on_clicked( lambda v: self.onclick_ck_fit() )
 
-        self.ui['ck_roi2'] = CheckButtons(ax=self.ax['ck_roi2'], labels= ["Enable ROI 2"],
+        self.ui['ck_roi2'] = CheckButtons(ax=self.ax['ck_roi2'], labels= ["Enable ROIs"],
                                         actives=[False], check_props={'facecolor': 'k'} )
         self.ui['ck_roi2'].on_clicked( lambda v: self.onclick_ck_roi2() )
         self.roi2_enabled = False
 
+        self.ui['btn_roi']=Button(self.ax['btn_roi'],"Add ROI",useblit=True,)
+        self.ui['btn_roi'].on_clicked( lambda v: self.add_roi() )
+
         if self.adf is not None:
             self.ui['ck_adf'] = CheckButtons(ax=self.ax['ck_adf'], labels= ["Toggle ADF"],
                                             actives=[False], check_props={'facecolor': 'k'} )
@@ -158,17 +217,9 @@ class FitBrowser:
 
 
         ################### Selectors ###################
-        self.ui['roi1'] = RectangleSelector(self.ax['inel'], self.dummy, button=[1],
-                                        useblit=True ,minspanx=1, minspany=1,spancoords='pixels',
-                                        interactive=True,props=dict(facecolor='crimson',edgecolor='crimson',alpha=0.2,fill=True),
-                                        handle_props=dict(markersize=2,markerfacecolor='white'))#,ignore_event_outside=True
-        
-        self.ui['roi2'] = RectangleSelector(self.ax['inel'], self.dummy, button=[3],
-                                        useblit=True ,minspanx=1, minspany=1,spancoords='pixels',
-                                        interactive=True,props=dict(facecolor='royalblue',edgecolor='royalblue',alpha=0.2,fill=True),
-                                        handle_props=dict(markersize=2,markerfacecolor='white'))#,ignore_event_outside=True)   
-        self.ui['roi2'].set_visible( False )
-        self.ui['roi2'].set_active( False )
+        self.ui['rois'] = [ self.roi_selector( 0, button=1 ), self.roi_selector( 1, button=3 ) ]
+        self.ui['rois'][1].set_visible( False )
+        self.ui['rois'][1].set_active( False )
             
         self.ui['bsub'] = SpanSelector(self.ax['spec'], self.dummy, button=[1],
                                             useblit=True, minspan=1,direction="horizontal",
@@ -224,6 +275,9 @@ class FitBrowser:
         self.fig.canvas.mpl_connect( 'motion_notify_event', 
                                     lambda event: self.onclick_figure(event))
         
+        if isinstance( edge, str ) and edge == 'auto':
+            onset = edge_onset( self.stats.mean_spectrum, self.eaxis )
+            edge = suggest_edge( self.eaxis, onset, label=" " ) if np.isfinite( onset ) else None
         if edge is None:
             self.edge = EELS_edge( " ", (self.eaxis[0],self.eaxis[-1]), (self.eaxis[0],self.eaxis[-1]) )
             self.ax['e_bsub'].set_visible(False)
@@ -244,8 +298,75 @@ class FitBrowser:
                 self.int_check = True
                 self.ui['slid_e_int'].set_val( self.edge.e_int )
 
+        if rois is not None:
+            for mask in rois:
+                self.add_roi( mask )
+
         self.rescale_yrange()
         # return results_dict,selector_collection
+
+    ################### ROI Management ###################
+    def roi_selector( self, k, button ):
+        color = roi_colors[ k % len(roi_colors) ]
+        return RectangleSelector(self.ax['inel'], self.dummy, button=[button],
+                                        useblit=True ,minspanx=1, minspany=1,spancoords='pixels',
+                                        interactive=True,props=dict(facecolor=color,edgecolor=color,alpha=0.2,fill=True),
+                                        handle_props=dict(markersize=2,markerfacecolor='white'))#,ignore_event_outside=True
+
+    def add_roi_lines( self, ax, k ):
+        color = roi_colors[ k % len(roi_colors) ]
+        h_spec, = ax.plot(self.eaxis, self.spectra[k],color=color)
+        h_bsub, = ax.plot(self.eaxis, self.bsubs[k],color=color,linestyle='--',alpha=0)
+        h_fit,  = ax.plot(self.eaxis, np.zeros_like(self.spectra[k]),color=color,alpha=0)
+        self.h['spec'].append( h_spec )
+        self.h['bsub'].append( h_bsub )
+        self.h['fit'].append( h_fit )
+
+    def add_roi( self, mask=None ):
+        """
+        Add a region of interest to the browser.
+        mask - boolean (ny,nx) array. If None, a new rectangle is bound to the right mouse button.
+        """
+        k = len( self.roi_masks )
+        color = roi_colors[ k % len(roi_colors) ]
+
+        if mask is None:
+            self.ui['rois'][self.active_roi].set_active( False )
+            self.ui['rois'].append( self.roi_selector( k, button=3 ) )
+            self.roi_masks.append( np.ones( (self.ny,self.nx), dtype=bool ) )
+            self.active_roi = k
+        else:
+            mask = np.asarray( mask, dtype=bool )
+            self.ui['rois'].append( self.ax['inel'].contour( self.xaxis, self.yaxis, mask,
+                                                            levels=[0.5], colors=[color] ) )
+            self.roi_masks.append( mask )
+
+        if mask is None:
+            spectrum = self.stats.mean_spectrum[np.newaxis]
+        else:
+            spectrum = roi_spectra( self.si, self.roi_masks[k:] )
+        self.spectra = np.append( self.spectra, spectrum, axis=0 )
+        self.bsubs = np.append( self.bsubs, self.spectra[k:], axis=0 )
+        self.add_roi_lines( self.ax['spec2'], k )
+
+        if self.roi2_enabled:
+            self.update_rois_visible()
+        else:
+            self.ui['ck_roi2'].set_active(0)
+
+        if self.fit_check:
+            self.calc_bsub()
+            self.update_fit()
+        self.rescale_yrange()
+
+    def update_rois_visible( self ):
+        for k in range(1, len(self.roi_masks)):
+            self.ui['rois'][k].set_visible( self.roi2_enabled )
+            self.h['spec'][k].set_alpha( float(self.roi2_enabled) )
+            if not self.roi2_enabled:
+                self.h['bsub'][k].set_alpha(0)
+                self.h['fit'][k].set_alpha(0)
+        self.ui['rois'][self.active_roi].set_active( self.roi2_enabled )
         
     ################### Update Functions ###################
     def onchange_lc(self, value ):
@@ -296,80 +417,38 @@ class FitBrowser:
     def onclick_ck_roi2( self ):
         self.roi2_enabled = self.ui['ck_roi2'].get_status()[0]
         if self.roi2_enabled:
-            self.h['spec2'].set_alpha(1)
-            self.ui['roi2'].set_visible( True )
-            self.ui['roi2'].set_active( True )
             self.ax['spec2'].set_visible( True )
             self.ax['spec'].set_position( [0.525,0.7,0.45,0.2] )
+            self.update_rois_visible()
             if self.fit_check:
-                self.calc_bsub2()
-                self.update_fit2()
+                self.calc_bsub()
+                self.update_fit()
         else:
             self.ax['spec'].set_position( [0.525,0.45,0.45,0.45] )
             self.ax['spec2'].set_visible( False )
-            self.h['spec2'].set_alpha(0)
-            self.h['bsub2'].set_alpha(0)
-            self.h['fit2'].set_alpha(0)
-            self.ui['roi2'].set_visible( False )
-            self.ui['roi2'].set_active( False )
-
-    def update_spectrum1(self):
-        real_roi = self.ui['roi1'].extents
-        xmin = np.searchsorted( self.xaxis, int( real_roi[0]))
-        xmax = np.searchsorted( self.xaxis, int( real_roi[1]))
-        ymin = np.searchsorted( self.yaxis, int( real_roi[2]))
-        ymax = np.searchsorted( self.yaxis, int( real_roi[3]))
-
-        if xmin == xmax:
-            xmax += 1
-        if ymin == ymax:
-            ymax +=1
-
-        self.spectrum1=np.mean( self.si[ymin:ymax,xmin:xmax,:],axis=(0,1))
-        
-        self.h['spec1'].set_ydata( self.spectrum1)
-        self.rescale_yrange()
-
-    def update_spectrum2(self):
-        real_roi = self.ui['roi2'].extents
-        xmin = np.searchsorted( self.xaxis, int( real_roi[0]))
-        xmax = np.searchsorted( self.xaxis, int( real_roi[1]))
-        ymin = np.searchsorted( self.yaxis, int( real_roi[2]))
-        ymax = np.searchsorted( self.yaxis, int( real_roi[3]))
-
-        if xmin == xmax:
-            xmax += 1
-        if ymin == ymax:
-            ymax +=1
+            self.update_rois_visible()
 
-        self.spectrum2=np.mean( self.si[ymin:ymax,xmin:xmax,:],axis=(0,1))
+    def update_spectra(self, rois):
+        # Re-extract the spectra of the given ROI indices in one sparse product
+        for k in rois:
+            self.roi_masks[k] = rect_mask( (self.ny,self.nx), self.xaxis, self.yaxis,
+                                           self.ui['rois'][k].extents )
+        self.spectra[rois] = roi_spectra( self.si, [self.roi_masks[k] for k in rois] )
 
-        self.h['spec2'].set_ydata( self.spectrum2)
-        self.h['spec2'].set_alpha(1)
+        for k in rois:
+            self.h['spec'][k].set_ydata( self.spectra[k] )
         self.rescale_yrange()
-        
-    def update_fit1(self):
-        ind_min = np.searchsorted( self.eaxis, self.edge.e_bsub[0])
 
-        self.h['bsub1'].set_ydata(self.bsub1)
-        self.h['bsub1'].set_color('orangered')
-        self.h['bsub1'].set_alpha(1)
+    def update_fit(self):
+        ind_min = searchsorted( self.eaxis, self.edge.e_bsub[0])
 
-        self.h['fit1'].set_data( self.eaxis[ind_min:], self.spectrum1[ind_min:]-self.bsub1[ind_min:])
-        self.h['fit1'].set_color('palevioletred')
-        self.h['fit1'].set_alpha(1)
-        self.rescale_yrange()
-        
-    def update_fit2(self):
-        ind_min = np.searchsorted( self.eaxis, self.edge.e_bsub[0])
-
-        self.h['bsub2'].set_ydata(self.bsub2)
-        self.h['bsub2'].set_color('steelblue')
-        self.h['bsub2'].set_alpha(1)
+        for k in range( len(self.roi_masks) ):
+            alpha = 1 if (k == 0 or self.roi2_enabled) else 0
+            self.h['bsub'][k].set_ydata(self.bsubs[k])
+            self.h['bsub'][k].set_alpha(alpha)
 
-        self.h['fit2'].set_data( self.eaxis[ind_min:], self.spectrum2[ind_min:]-self.bsub2[ind_min:])
-        self.h['fit2'].set_color('cornflowerblue')
-        self.h['fit2'].set_alpha(1)
+            self.h['fit'][k].set_data( self.eaxis[ind_min:], self.spectra[k,ind_min:]-self.bsubs[k,ind_min:])
+            self.h['fit'][k].set_alpha(alpha)
         self.rescale_yrange()
 
     def slider_bsub_action(self, erange):
@@ -378,10 +457,8 @@ class FitBrowser:
         self.edge.e_bsub = erange
 
         if self.fit_check:
-            self.calc_bsub1()
-            self.update_fit1()
-            self.calc_bsub2()
-            self.update_fit2()
+            self.calc_bsub()
+            self.update_fit()
 
     def slider_int_action(self, erange):
         self.ui['int'].extents = erange
@@ -396,7 +473,7 @@ class FitBrowser:
         self.ax['spec'].set_xlim([erange[0],erange[1]])
         self.ax['spec2'].set_xlim([erange[0],erange[1]])
 
-        slidermin, slidermax = np.searchsorted(self.eaxis, (erange[0],erange[1]))
+        slidermin, slidermax = searchsorted(self.eaxis, (erange[0],erange[1]))
         self.slider_window = (slidermin, slidermax)
         self.rescale_yrange()
 
@@ -421,31 +498,31 @@ class FitBrowser:
             slidermin,slidermax = self.slider_window
             
             if not self.y_log:
-                maxval =  1.1*self.spectrum1[slidermin:slidermax].max()
-                minval =  min( 0.9*self.spectrum1[slidermin:slidermax].min(),0)
+                maxval =  1.1*self.spectra[0,slidermin:slidermax].max()
+                minval =  min( 0.9*self.spectra[0,slidermin:slidermax].min(),0)
 
                 if self.fit_check:
-                    minval = min( 0.9*self.bsub1[slidermin:slidermax].min(),
+                    minval = min( 0.9*self.bsubs[0,slidermin:slidermax].min(),
                                   0)
             else:
-                maxval =  1.2*self.spectrum1[slidermin:slidermax].max()
-                minval =  0.8*self.spectrum1[slidermin:slidermax].min()
+                maxval =  1.2*self.spectra[0,slidermin:slidermax].max()
+                minval =  0.8*self.spectra[0,slidermin:slidermax].min()
 
             self.ax['spec'].set_ylim([minval,maxval])
             self.ax['spec'].set_yticks([])
 
-            # axis 2
+            # axis 2, shared by all other ROIs
             if self.roi2_enabled:
                 if not self.y_log:
-                    maxval =  1.1*self.spectrum2[slidermin:slidermax].max()
-                    minval =  min( 0.9*self.spectrum2[slidermin:slidermax].min(),0)
+                    maxval =  1.1*self.spectra[1:,slidermin:slidermax].max()
+                    minval =  min( 0.9*self.spectra[1:,slidermin:slidermax].min(),0)
 
                     if self.fit_check:
-                        minval = min( 0.9*self.bsub2[slidermin:slidermax].min(),
+                        minval = min( 0.9*self.bsubs[1:,slidermin:slidermax].min(),
                                     0)
                 else:
-                    maxval =  1.2*self.spectrum2[slidermin:slidermax].max()
-                    minval =  0.8*self.spectrum2[slidermin:slidermax].min()
+                    maxval =  1.2*self.spectra[1:,slidermin:slidermax].max()
+                    minval =  0.8*self.spectra[1:,slidermin:slidermax].min()
 
                 self.ax['spec2'].set_ylim([minval,maxval])
 
@@ -455,17 +532,17 @@ class FitBrowser:
         if event.inaxes in [self.ax['inel']]:
             if event.button == MouseButton.LEFT:
                 # Left Click on Inelastic Image
-                self.update_spectrum1()
+                self.update_spectra( [0] )
                 if self.fit_check:
-                    self.calc_bsub1()
-                    self.update_fit1()
+                    self.calc_bsub()
+                    self.update_fit()
             elif event.button == MouseButton.RIGHT:
                 if self.roi2_enabled:
                     # Right Click on Inelastic Image
-                    self.update_spectrum2()
+                    self.update_spectra( [self.active_roi] )
                     if self.fit_check:
-                        self.calc_bsub2()
-                        self.update_fit2()
+                        self.calc_bsub()
+                        self.update_fit()
 
         elif event.inaxes in [self.ax['spec']]:
             if event.button == MouseButton.LEFT:
@@ -489,13 +566,13 @@ class FitBrowser:
                 self.ax['e_int'].set_visible(True)
                 self.ui['slid_e_int'].set_val( self.ui['int2'].extents )
 
-    def calc_bsub1(self):
-            self.bsub1, fit_param = bg.bgsub_SI_linearized( self.spectrum1, self.eaxis, self.edge, fit_options=self.fit_options)
-            self.r1 = fit_param[1]
-
-    def calc_bsub2(self):
-        self.bsub2, fit_param = bg.bgsub_SI_linearized( self.spectrum2, self.eaxis, self.edge, fit_options=self.fit_options)
-        self.r2 = fit_param[1]
+    def calc_bsub(self):
+        # One batched linearized fit over the spectra of all ROIs
+        nroi = len( self.roi_masks )
+        bsubs, fit_params = bg.bgsub_SI_linearized( self.spectra, self.eaxis, self.edge, fit_options=self.fit_options)
+        self.bsubs = np.reshape( bsubs, (nroi, self.ne) )
+        self.fit_params = np.reshape( fit_params, (2, nroi) )
+        self.r1 = self.fit_params[1,0]
 
 
     def onclick_fitmode(self, label):
@@ -504,10 +581,8 @@ class FitBrowser:
         if self.fit_options.fit == 'lin' and self.fit_options.lc==True:
             self.ui['ck_fit'].set_active(0)
 
-        self.calc_bsub1()
-        self.update_fit1()
-        self.calc_bsub2()
-        self.update_fit1()
+        self.calc_bsub()
+        self.update_fit()
         
     def onclick_fbsub(self):
         if (self.int_check and self.fit_check):
@@ -519,18 +594,21 @@ class FitBrowser:
     def onclick_bsub(self):
         if (self.int_check and self.fit_check):
             if self.fit_options.lc:
-                _,self.si_bsub = bg.bgsub_SI( self.si, self.eaxis, self.edge, fit_options=self.fit_options)
+                _,self.si_bsub = bg.bgsub_SI( self.si, self.eaxis, self.edge, fit_options=self.fit_options, stats=self.stats)
             else:
-                self.si_bsub =   bg.bgsub_SI( self.si, self.eaxis, self.edge, fit_options=self.fit_options)
+                self.si_bsub =   bg.bgsub_SI( self.si, self.eaxis, self.edge, fit_options=self.fit_options, stats=self.stats)
             self.update_image()
 
     def update_image(self):
-        indmin, indmax = np.searchsorted(self.eaxis, self.edge.e_int)
+        indmin, indmax = searchsorted(self.eaxis, self.edge.e_int)
         if indmin == indmax:
-            indmax +1
+            indmax +=1
 
         if self.si_bsub is None:
-            self.im_inel = np.mean(self.si[:,:,indmin:indmax],axis=(-1))
+            if indmin == 0 and indmax >= self.ne:
+                self.im_inel = self.stats.mean_image
+            else:
+                self.im_inel = chunked_mean(self.si[:,:,indmin:indmax],axis=(-1))
         else:           
             self.im_inel = np.mean(self.si_bsub[:,:,indmin:indmax],axis=(-1))
         
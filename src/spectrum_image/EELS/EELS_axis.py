@@ -0,0 +1,155 @@
+import numpy as np
+from numpy.lib.mixins import NDArrayOperatorsMixin
+
+
+class EnergyAxis(NDArrayOperatorsMixin):
+    """
+    Uniform energy axis stored as offset, dispersion and size.
+    Behaves like the rounded ndarray offset + arange(size)*dispersion (the loaders' convention)
+    for indexing, ufuncs and plotting, but channel lookups are O(1) and the values are only
+    materialized when an array is actually needed. It is read-only and not a full ndarray, so
+    the loaders return plain arrays; wrap one with from_array where many lookups are made.
+
+    Inputs:
+    offset - energy of the first channel (eV)
+    dispersion - energy per channel (eV)
+    size - number of channels
+    decimals - rounding of the channel energies, default 4
+    """
+
+    def __init__(self, offset, dispersion, size, decimals=4):
+        self.offset = float( offset )
+        self.dispersion = float( dispersion )
+        self.size = int( size )
+        self.decimals = decimals
+        self._values = None
+
+    @classmethod
+    def from_hyperspy(cls, axis, decimals=4):
+        # EnergyAxis of a hyperspy DataAxis, e.g. signal.axes_manager[2j]
+        d = axis.get_axis_dictionary()
+        return cls( np.round( d['offset'], decimals ), np.round( d['scale'], decimals ),
+                    int( d['size'] ), decimals )
+
+    @classmethod
+    def from_array(cls, energy, decimals=4):
+        # EnergyAxis of a uniformly spaced array; raises ValueError if it is not uniform
+        energy = np.asarray( energy, dtype='float64' )
+        if len( energy ) < 2:
+            return cls( energy[0] if len( energy ) else 0, 1, len( energy ), decimals )
+        axis = cls( energy[0], (energy[-1]-energy[0])/(len( energy )-1), len( energy ), decimals )
+        if not np.allclose( axis.values, energy, rtol=0, atol=0.5*10.0**(-decimals) + 1e-9 ):
+            raise ValueError( "Energy array is not uniformly spaced" )
+        return axis
+
+    ######## Array behaviour
+    @property
+    def values(self):
+        if self._values is None:
+            self._values = self.value( np.arange( self.size ) )
+            self._values.flags.writeable = False
+        return self._values
+
+    def value(self, index):
+        # Channel energy at (integer or fractional) index, rounded like the loaders
+        return np.round( self.offset + np.asarray( index )*self.dispersion, self.decimals )
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None:
+            return self.values.copy() if copy else self.values
+        return self.values.astype( dtype )
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = tuple( np.asarray( x ) if isinstance( x, EnergyAxis ) else x for x in inputs )
+        return getattr( ufunc, method )( *inputs, **kwargs )
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter( self.values )
+
+    def __getitem__(self, key):
+        if isinstance( key, slice ):
+            r = range( self.size )[key]
+            return EnergyAxis( self.offset + r.start*self.dispersion, r.step*self.dispersion,
+                               len( r ), self.decimals )
+        if isinstance( key, (int, np.integer) ):
+            if key < -self.size or key >= self.size:
+                raise IndexError( "index {} is out of bounds for axis with size {}".format( key, self.size ) )
+            return float( self.value( key % self.size ) )
+        return self.values[key]
+
+    def __repr__(self):
+        return "EnergyAxis(offset={}, dispersion={}, size={})".format( self.offset, self.dispersion, self.size )
+
+    @property
+    def shape(self):
+        return (self.size,)
+
+    @property
+    def ndim(self):
+        return 1
+
+    @property
+    def dtype(self):
+        return np.dtype( 'float64' )
+
+    def astype(self, dtype):
+        return self.values.astype( dtype )
+
+    def min(self, *args, **kwargs):
+        # O(1); also serves np.min( axis )
+        if args or any( v is not None for v in kwargs.values() ):
+            return self.values.min( *args, **kwargs )
+        return min( self[0], self[-1] )
+
+    def max(self, *args, **kwargs):
+        if args or any( v is not None for v in kwargs.values() ):
+            return self.values.max( *args, **kwargs )
+        return max( self[0], self[-1] )
+
+    ######## Channel lookup
+    def index(self, energy):
+        # Fractional channel index of energy
+        return (np.asarray( energy, dtype='float64' ) - self.offset)/self.dispersion
+
+    def searchsorted(self, energy, side='left'):
+        """
+        Same result as np.searchsorted( axis.values, energy, side ) in O(1):
+        a closed-form estimate corrected against the rounded channel energies.
+        """
+        energy = np.asarray( energy, dtype='float64' )
+        ind = np.clip( np.round( self.index( energy ) ), 0, self.size ).astype( int )
+
+        if side == 'left':
+            after = lambda i: self.value( i ) >= energy
+        else:
+            after = lambda i: self.value( i ) > energy
+        # Index = first channel after energy; the estimate is off by at most one
+        for it in range( 2 ):
+            ind = np.where( (ind > 0) & after( ind-1 ), ind-1, ind )
+            ind = np.where( (ind < self.size) & ~after( np.minimum( ind, self.size-1 ) ), ind+1, ind )
+        return ind if ind.ndim else int( ind )
+
+    def integrate(self, data, e_range, axis=-1):
+        """
+        Sum of data over the energy range e_range = (emin, emax) along axis, with
+        fractional weights for the channels cut by the bounds. Channel i covers
+        index i-0.5 .. i+0.5.
+        """
+        lo, hi = np.clip( self.index( e_range ), -0.5, self.size-0.5 )
+        i0 = int( np.floor( lo+0.5 ) )
+        i1 = min( int( np.ceil( hi+0.5 ) ), self.size )
+        channels = np.arange( i0, i1 )
+        weights = np.clip( np.minimum( hi, channels+0.5 ) - np.maximum( lo, channels-0.5 ), 0, 1 )
+
+        data = np.moveaxis( np.asarray( data ), axis, -1 )
+        return data[..., i0:i1] @ weights
+
+
+def searchsorted( axis, energy, side='left' ):
+    # np.searchsorted for energy axes: O(1) for EnergyAxis, binary search for arrays
+    if isinstance( axis, EnergyAxis ):
+        return axis.searchsorted( energy, side )
+    return np.searchsorted( axis, energy, side )
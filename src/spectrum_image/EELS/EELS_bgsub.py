@@ -1,24 +1,38 @@
 import numpy as np
 import copy
+import hashlib
 from tqdm import tqdm, tqdm_notebook
 import numpy.linalg as LA
 from scipy.ndimage import gaussian_filter
 from scipy.stats import norm
 import spectrum_image.EELS.EELS_lineshapes as ls
-from scipy.optimize import curve_fit
+from scipy.optimize import curve_fit, nnls
+from spectrum_image.EELS.EELS_chunks import gather_pixels, scatter_pixels, iter_chunks
+from spectrum_image.EELS.EELS_axis import searchsorted
 
 
 class options_bgsub:
 
     def __init__(self, fit='pl', log='False', lc=False, perc=(5,95), lba=False, gfwhm=None,
-                       maxfev=50000, method='trf', ftol=0.0005, gtol=0.00005, xtol=None):
+                       maxfev=50000, method='trf', ftol=0.0005, gtol=0.00005, xtol=None,
+                       lc_r=None, lc_nonneg=True, lc_sample=None, lc_strata=None, lc_seed=None,
+                       weighted=False, irls=0):
         """
         **kawrgs:
         fit - choose the type of background fit, default == 'pl' == Power law. Can also use 'exp'== Exponential, 'lin' == Linear.
         gfwhm - If using LBA, gfwhm corresponds to width of gaussian filter, default = None, meaning no LBA.
         log - Boolean, if true, log transform data and fit using QR factorization, default == False.
         lc - Boolean, if true, include LCPL or LCEX background subtracted SI, default == False.
-        perc - standard deviation spread of r values from power law fitting. Default == (5/95)
+        perc - percentiles of the fitted r distribution used as LC components, any number of them. Default == (5/95)
+        lc_r - explicit LC exponents (pl) or decay rates (exp), overrides perc when set, default == None.
+        lc_nonneg - Boolean, if true, solve LC weights with non-negative least squares, default == True.
+        lc_sample - estimate the r distribution for LC from a subset of non-vacuum pixels only: a number of pixels,
+                    or a fraction if < 1. Skips the full per-pixel fit, default == None (fit every pixel).
+        lc_strata - if set, draw lc_sample stratified over a lc_strata x lc_strata grid of tiles, default == None (random).
+        lc_seed - seed of the lc_sample draw, default == None.
+        weighted - Boolean, if true, weight the linearized fit with Poisson weights (implies log), default == False.
+        irls - number of iteratively reweighted least squares refinements of a weighted fit, converging to
+               the Poisson maximum likelihood fit, default == 0.
         ftol - default to 0.0005, Relative error desired in the sum of squares.
         gtol - default to 0.00005, Orthogonality desired between the function vector and the columns of the Jacobian.
         xtol - default to None, Relative error desired in the approximate solution.
@@ -37,13 +51,24 @@ class options_bgsub:
         self.ftol = ftol
         self.gtol = gtol
         self.xtol = xtol
+        self.lc_r = lc_r
+        self.lc_nonneg = lc_nonneg
+        self.lc_sample = lc_sample
+        self.lc_strata = lc_strata
+        self.lc_seed = lc_seed
+        self.weighted = weighted
+        self.irls = irls
 
         if (lba == True) and (gfwhm is None or gfwhm <=0 ) :
             print( "gfwhm not set or invalid: Setting lba = False")
             self.lba = False
 
+        if weighted and not (log == True) and fit != 'lin':
+            print( "weighted fits are linearized: Setting log = True")
+            self.log = True
+
         if (lc ==  True):
-            if (perc is None):
+            if (perc is None) and (lc_r is None):
                 print( "perc not set or invalid: Setting lc = False")
                 self.lc = False
             if (fit=='lin'):
@@ -69,9 +94,141 @@ def linear_regression_QR( y, X ):
 
     return b
 
+def weighted_regression( y, X, w ):
+    # Weighted linear regression with 2 parameters for every column of y at once
+    # Solves the 2x2 normal equations (X.T W X) b = X.T W y in closed form
+    # y: (n x m) dependent variables, X: (n x 2) [1, x], w: (n x m) weights
+    # b: (2 x m) [[b0],[b1]], b0: intercept, b1: slope
+    x = X[:,1:2]
+    s0 = np.sum( w, axis=0 )
+    s1 = np.sum( w*x, axis=0 )
+    s2 = np.sum( w*x**2, axis=0 )
+    t0 = np.sum( w*y, axis=0 )
+    t1 = np.sum( w*x*y, axis=0 )
+    det = s0*s2 - s1**2
+    with np.errstate( divide='ignore', invalid='ignore' ):
+        b = np.stack( [(s2*t0 - s1*t1)/det, (s0*t1 - s1*t0)/det] )
+    return b
+
+def poisson_regression( y, X, irls=0, log=True ):
+    # Poisson-weighted linearized fit of counts y (n x m) for every column at once
+    # log == True: fits log(y) = Xb, weights y (variance of log(y) ~ 1/y), zero-count channels get no weight;
+    #              irls steps use the working response Xb + (y-mu)/mu with weights mu = exp(Xb)
+    # log == False: fits y = Xb with weights 1/y, irls steps reweight with 1/mu
+    if y.ndim == 1:
+        y = np.atleast_2d( y ).T
+    y = y.astype( 'float64' )
+
+    if log:
+        w = np.maximum( y, 0 )
+        z = np.log( np.where( y > 0, y, 1 ) )
+    else:
+        w = 1/np.maximum( y, 1 )
+        z = y
+    b = weighted_regression( z, X, w )
+
+    for it in range( irls ):
+        eta = X @ b
+        if log:
+            mu = np.exp( np.clip( eta, -700, 700 ) )
+            z = eta + (y - mu)/np.maximum( mu, 1e-300 )
+            w = mu
+        else:
+            w = 1/np.maximum( eta, 1 )
+        b = weighted_regression( z, X, w )
+    return b
+
+def solve_on_support( G, C, support ):
+    # Unconstrained least squares restricted to support (k x m) of every column, zero elsewhere
+    # Columns sharing a support pattern are solved together
+    s = np.zeros( C.shape )
+    patterns, inverse = np.unique( support.T, axis=0, return_inverse=True )
+    inverse = np.ravel( inverse )
+    for p, pattern in enumerate( patterns ):
+        if not pattern.any():
+            continue
+        cols, = np.nonzero( inverse == p )
+        s[np.ix_(pattern, cols)] = LA.lstsq( G[np.ix_(pattern, pattern)], C[np.ix_(pattern, cols)], rcond=None )[0]
+    return s
+
+def nnls_batch( y, X, max_iter=1000, tol=1e-10 ):
+    # Solve Non-negative Least Squares min||Xb - y||, b >= 0 for every column of y at once
+    # Accelerated projected gradient (FISTA) on the normal equations gives a warm start for a
+    # batched Lawson-Hanson active set, iterated until the KKT conditions hold in every column;
+    # columns that still fail after 3k active-set steps are handed to scipy.optimize.nnls
+    # y: (n x m) dependent variables, one column per spectrum
+    # X: (n x k) basis
+    # b: (k x m) non-negative coefficients
+    if y.ndim == 1:
+        Y = np.atleast_2d( y ).T
+    else:
+        Y = y
+
+    # Unit-norm columns keep the problem well conditioned for basis functions of very different scale
+    norms = LA.norm( X, axis=0 )
+    norms[norms == 0] = 1
+    Xs = X/norms
+    G = Xs.T @ Xs
+    C = Xs.T @ Y
+    L = LA.eigvalsh( G ).max()
+    k, m = C.shape
+
+    b = np.maximum( LA.lstsq( G, C, rcond=None )[0], 0 )
+    z = b.copy()
+    t = 1
+    for it in range( max_iter ):
+        b_new = np.maximum( z - (G @ z - C)/L, 0 )
+        t_new = (1 + np.sqrt( 1 + 4*t**2 ))/2
+        z = b_new + ((t-1)/t_new)*(b_new - b)
+        converged = np.max( np.abs( b_new - b ) ) <= tol*max( np.max( np.abs( b_new ) ), 1 )
+        b, t = b_new, t_new
+        if converged:
+            break
+
+    # Lawson-Hanson active set on the columns violating the KKT conditions.
+    # b stays feasible and zero off the support P throughout.
+    P = b > 0
+    dual_tol = 10*np.finfo( float ).eps*k*np.maximum( np.max( np.abs( C ), axis=0 ), 1e-300 )
+    active = np.ones( m, dtype=bool )
+    for it in range( 3*k ):
+        # Inner loop: exact solve on P, stepping back and dropping indices that turn non-positive
+        for inner in range( k+1 ):
+            cols, = np.nonzero( active )
+            s = solve_on_support( G, C[:, cols], P[:, cols] )
+            infeasible = P[:, cols] & (s <= 0)
+            bad = np.any( infeasible, axis=0 )
+            good = cols[~bad]
+            b[:, good] = s[:, ~bad]
+            if not bad.any():
+                break
+            bc, sc, ic = b[:, cols[bad]], s[:, bad], infeasible[:, bad]
+            with np.errstate( divide='ignore', invalid='ignore' ):
+                ratio = np.where( ic, bc/(bc - sc), np.inf )
+            alpha = np.clip( np.min( ratio, axis=0 ), 0, 1 )
+            bc = bc + alpha*(sc - bc)
+            drop = ic & (bc <= tol*np.max( np.abs( bc ), axis=0 ))
+            drop[np.argmin( ratio, axis=0 ), np.arange( len(alpha) )] = True
+            bc[drop] = 0
+            b[:, cols[bad]] = bc
+            P[:, cols[bad]] &= ~drop
+
+        # Dual feasibility: the gradient C - G b must be non-positive off the support
+        w = np.where( P, -np.inf, C - G @ b )
+        wmax = np.max( w, axis=0 )
+        active = wmax > dual_tol
+        if not active.any():
+            break
+        cols, = np.nonzero( active )
+        P[np.argmax( w[:, cols], axis=0 ), cols] = True
+
+    for col in np.nonzero( active )[0]:
+        b[:, col] = nnls( Xs, Y[:, col] )[0]
+
+    return b/norms[:,None]
+
 
 ######## Background Subtractions SI
-def bgsub_SI( si, energy, edge, fit_options=None, mask=None, threshold=None):
+def bgsub_SI( si, energy, edge, fit_options=None, mask=None, threshold=None, stats=None, return_params=False, chunk_mb=64):
     """
     Full background subtraction function-
     Optional LBA, log fitting, LCPL, and exponential fitting.
@@ -83,23 +240,29 @@ def bgsub_SI( si, energy, edge, fit_options=None, mask=None, threshold=None):
     edge - edge parameters defined by KEM convention
     fit_options - eels_bgsub.options_bg object
 
-    mask - Boolean mask defines non-vacuum region in SI, used to improve LCPL
-    threshold - mininum average counts in fit window to be included in LCPL calculation.
+    mask - Boolean mask defines non-vacuum region in SI, used to improve LCPL.
+           Only pixels inside the mask are fitted; outside it the background subtracted SI is 0
+           and the fit parameters are NaN.
+    threshold - mininum average counts in fit window to be included in LCPL calculation and fitting.
+    stats - SIStats of si; its mean spectrum seeds the non-linear fits instead of reducing the SI again
+    return_params - if True, also return the (2, xdim, ydim) background fit parameters as the last output
+    chunk_mb - the SI is cast to float32, NaN-zeroed and fitted in row blocks of this size, so a
+               memmapped SI is never loaded as a whole; only the fit window is kept in memory
 
     Outputs:
     if lcpl == False:
         bg_pl_SI - background subtracted SI
     if lcpl == True:
         bg_pl_SI, bg_lcpl_SI - background subtracted SI, LCPL background subtracted SI
+        With fit_options.lc_sample only the LC fit runs, and bg_pl_SI (and the fit parameters) are None.
     """
 
     ### Load Fit Options
     if (fit_options is None):
         fit_options = options_bgsub()
 
-    fit_start_ch, fit_end_ch = np.searchsorted( energy, edge.e_bsub)
+    fit_start_ch, fit_end_ch = searchsorted( energy, edge.e_bsub)
 
-    si = si.astype('float32')
     if len(np.shape(si)) == 2:
         tempx,tempz = np.shape(si)
         si = np.reshape(si,(tempx,1,tempz))
@@ -108,48 +271,106 @@ def bgsub_SI( si, energy, edge, fit_options=None, mask=None, threshold=None):
         si = np.reshape(si,(1,1,tempz))
     xdim, ydim, zdim = np.shape(si)
 
+    ## NaN-free float32 copy of the fit window only
+    win = np.empty( (xdim,ydim,fit_end_ch-fit_start_ch), dtype='float32' )
+    for rows, chunk in iter_chunks( si[:,:,fit_start_ch:fit_end_ch], chunk_mb ):
+        win[rows] = chunk
+
+    ## Fits skip the pixels outside a user mask or threshold
+    fit_mask = None
+    if mask is not None or threshold is not None:
+        fit_mask = mask
+
+    ## Special case: if there is vacuum in the SI and it is causing trouble with your LCPL fitting:
+    if mask is None and threshold is not None:
+        mean_back = np.mean(win,axis=2)
+        mask = mean_back > threshold
+        fit_mask = mask
+    elif mask is None and threshold is None:
+        mask = np.ones((xdim,ydim), dtype='bool')
 
     ## Apply Local Background Averaging
     if fit_options.lba==True:
-        fit_data = prepare_si_lba( si, fit_options.gfwhm, fit_start_ch, fit_end_ch )
-    else:
-        fit_data = si
-    
+        win = lba_window( win, fit_options.gfwhm )
+
+    def run_blocks( fit ):
+        # fit( block, rows ) -> (background subtracted block, parameters or None), block by block
+        bg_SI = np.zeros( (xdim,ydim,zdim), dtype='float32' )
+        fit_params = np.full( (2,xdim,ydim), np.nan )
+        for rows, chunk in iter_chunks( si, chunk_mb ):
+            block = chunk.astype( 'float32', copy=False )
+            if fit_options.lba==True:
+                block[:,:,fit_start_ch:fit_end_ch] = win[rows]
+            bg_block, p_block = fit( block, rows )
+            bg_SI[rows] = np.reshape( bg_block, block.shape )
+            if p_block is not None:
+                fit_params[:,rows] = np.reshape( p_block, (2,)+block.shape[:2] )
+        return bg_SI, fit_params
+
+    def run_LC( rline, rdist=None ):
+        # Exponents are set once from all pixels, the weights are then fitted block by block
+        lc_options = copy.copy( fit_options )
+        lc_options.lc_r = lc_exponents( fit_options, rline, rdist )
+        return run_blocks( lambda block, rows: (bgsub_SI_LC( block, energy, edge, None, lc_options ), None) )[0]
+
+    ## Sampled LC: estimate the r distribution from a subset of pixels, skip the full per-pixel fit
+    if fit_options.lc and fit_options.lc_sample:
+        if fit_options.lba==True:
+            rdist = lc_r_distribution( win, energy[fit_start_ch:fit_end_ch], edge, mask, fit_options )
+        else:
+            rdist = lc_r_distribution( si, energy, edge, mask, fit_options, stats=stats )
+        bg_lcpl_SI = run_LC( None, rdist )
+        if return_params:
+            return None, bg_lcpl_SI, None
+        return None, bg_lcpl_SI
+
+    block_mask = lambda rows: None if fit_mask is None else fit_mask[rows]
+
     ## If log fitting or linear fitting, find fit using qr factorization       
     if fit_options.log or (fit_options.fit=='lin'):
-        bg_pl_SI, fit_params = bgsub_SI_linearized( fit_data, energy, edge, fit_options=fit_options )
+        bg_pl_SI, fit_params = run_blocks( lambda block, rows: bgsub_SI_linearized(
+            block, energy, edge, fit_options=fit_options, mask=block_mask( rows ) ) )
 
     ## Power law non-linear curve fitting using scipy.optimize.curve_fit
     elif (fit_options.fit=='pl') or (fit_options.fit=='exp') : 
-        bg_pl_SI, fit_params = bgsub_SI_nllsq( fit_data, energy, edge, fit_options=fit_options )
-        
-    ## Special case: if there is vacuum in the SI and it is causing trouble with your LCPL fitting:
-    if mask is None and threshold is not None:
-        mean_back = np.mean(si[:,:,fit_start_ch:fit_end_ch],axis=2)
-        mask = mean_back > threshold
-    elif mask is None and threshold is None:
-        mask = np.ones((xdim,ydim), dtype='bool')
-    
+        if stats is not None and not fit_options.lba:
+            mean_spec = stats.mean_spectrum[fit_start_ch:fit_end_ch]
+        elif fit_mask is not None:
+            mean_spec = np.mean( win[fit_mask], axis=0 )
+        else:
+            mean_spec = np.mean( win, axis=(0,1) )
+        bg_pl_SI, fit_params = run_blocks( lambda block, rows: bgsub_SI_nllsq(
+            block, energy, edge, fit_options=fit_options, mean_spec=mean_spec, mask=block_mask( rows ) ) )
+
     maskline = np.reshape( mask,(xdim*ydim))
-    fit_params = np.reshape( fit_params, (2, xdim, ydim))
-    rline_long = -1*np.reshape( fit_params[1,:,:], (xdim*ydim) )
+    # Linearized fits return the slope -r, the non-linear ones r itself
+    rline_long = np.reshape( fit_params[1,:,:], (xdim*ydim) )
+    if fit_options.log or (fit_options.fit=='lin'):
+        rline_long = -rline_long
     rline = rline_long[maskline]
+    rline = rline[np.isfinite(rline)]
 
     ## Given r values of SI, refit background using a linear combination of power laws, 
     ## using either 5/95 percentile or 20/80 percentile r values.
     if fit_options.lc:
-        bg_lcpl_SI = bgsub_SI_LC(fit_data, energy, edge, rline, fit_options)
+        bg_lcpl_SI = run_LC( rline )
+        if return_params:
+            return bg_pl_SI, bg_lcpl_SI, fit_params
         return bg_pl_SI, bg_lcpl_SI
     else:
+        if return_params:
+            return bg_pl_SI, fit_params
         return bg_pl_SI
     
 
 ########### background subtractions ########
-def bgsub_SI_fast( si, energy, edge, rval, fit_options=None):
+def bgsub_SI_fast( si, energy, edge, rval, fit_options=None, return_params=False):
     """
     Quick background subtraction based on fixed 'r' value
     For Y = Ax + b + error with fixed 'A':
         Y' = b + error. MSE is minimized when b = mean(Y)
+    rval - slope of the linearized fit (-r for power laws), a scalar or an (xdim,ydim) map
+    return_params - if True, also return the (2, xdim, ydim) parameters as bgsub_SI_linearized does
     """
     ### Load Fit Options
     if (fit_options is None):
@@ -163,39 +384,63 @@ def bgsub_SI_fast( si, energy, edge, rval, fit_options=None):
         si = np.reshape(si,(1,1,tempz))
     xdim, ydim, zdim = np.shape(si)
 
-    fit_start_ch, fit_end_ch = np.searchsorted(energy, edge.e_bsub)
-    y_win = si[:,:,fit_start_ch:fit_end_ch]
+    rval = np.asarray( rval )
+    if rval.ndim > 0:
+        rval = np.reshape( rval, (xdim,ydim,1) )
+
+    fit_start_ch, fit_end_ch = searchsorted(energy, edge.e_bsub)
     e_win = np.reshape( energy[fit_start_ch:fit_end_ch], (1,1,(fit_end_ch-fit_start_ch)) )
     e_sub = np.reshape( energy[fit_start_ch:], (1,1,zdim-fit_start_ch) )
 
-    bg_SI = np.zeros_like( si )  
+    bg_SI = np.zeros( si.shape, dtype=si.dtype )
+    c_fit = np.zeros( (xdim,ydim,1) )
 
-    if fit_options.fit == 'lin':
-        c_fit = np.reshape( np.mean( y_win-rval*e_win, axis=(2)), (xdim,ydim,1))
-        y_fit = c_fit + rval*e_sub
+    # Row blocks of the NaN-free SI, so raw (memmapped) data can be passed in
+    for rows, chunk in iter_chunks( si ):
+        r = rval[rows] if rval.ndim > 0 else rval
+        y_win = chunk[:,:,fit_start_ch:fit_end_ch]
+        nx = chunk.shape[0]
 
-    if fit_options.fit == 'pl':
-        c_fit = np.reshape( np.mean( np.log(y_win)-rval*np.log(e_win), axis=(2)), (xdim,ydim,1))
-        y_fit = np.exp( c_fit + rval*np.log(e_sub) )
+        if fit_options.fit == 'lin':
+            c_fit[rows] = np.reshape( np.mean( y_win-r*e_win, axis=(2)), (nx,ydim,1))
+            y_fit = c_fit[rows] + r*e_sub
 
-    if fit_options.fit == 'exp':
-        c_fit = np.reshape( np.mean( np.log(y_win)-rval*e_win, axis=(2)), (xdim,ydim,1))
-        y_fit = np.exp( c_fit + rval*e_sub )
+        if fit_options.fit == 'pl':
+            c_fit[rows] = np.reshape( np.mean( np.log(y_win)-r*np.log(e_win), axis=(2)), (nx,ydim,1))
+            y_fit = np.exp( c_fit[rows] + r*np.log(e_sub) )
 
-    bg_SI[:,:,fit_start_ch:] = si[:,:,fit_start_ch:] - y_fit
+        if fit_options.fit == 'exp':
+            c_fit[rows] = np.reshape( np.mean( np.log(y_win)-r*e_win, axis=(2)), (nx,ydim,1))
+            y_fit = np.exp( c_fit[rows] + r*e_sub )
+
+        bg_SI[rows,:,fit_start_ch:] = chunk[:,:,fit_start_ch:] - y_fit
+    if return_params:
+        b0 = c_fit[:,:,0] if fit_options.fit == 'lin' else np.exp( c_fit[:,:,0] )
+        b_fit = np.stack( [b0, np.broadcast_to( rval, (xdim,ydim,1) )[:,:,0]] )
+        return np.squeeze(bg_SI), np.squeeze(b_fit)
     return np.squeeze(bg_SI)
 
-def bgsub_SI_linearized( si, energy, edge, fit_options=None):
+def bgsub_SI_linearized( si, energy, edge, fit_options=None, mask=None):
     """
     Quick background subtraction based on fixed 'r' value
     For Y = Ax + b + error with fixed 'A':
         Y' = b + error. MSE is minimized when b = mean(Y)
+    mask - optional (xdim,ydim) boolean mask; only those pixels are fitted, the
+           others get a zero background subtracted SI and NaN parameters
     """
     ### Load Fit Options
     if (fit_options is None):
         fit_options = options_bgsub()
 
-    fit_start_ch, fit_end_ch = np.searchsorted(energy, edge.e_bsub)
+    if mask is not None:
+        xdim, ydim, zdim = np.shape( si )
+        active = gather_pixels( si, mask )
+        bg_act, b_act = bgsub_SI_linearized( active[:,None,:], energy, edge, fit_options=fit_options )
+        bg_SI = scatter_pixels( np.reshape( bg_act, (-1,zdim) ), mask, dtype=si.dtype )
+        b_fit = scatter_pixels( np.reshape( b_act, (2,-1) ).T, mask, fill=np.nan, dtype='float64' )
+        return np.squeeze( bg_SI ), np.squeeze( np.moveaxis( b_fit, -1, 0 ) )
+
+    fit_start_ch, fit_end_ch = searchsorted(energy, edge.e_bsub)
     if (fit_end_ch - fit_start_ch)<2:
         fit_end_ch = fit_start_ch+2
     e_win = np.atleast_2d( energy[fit_start_ch:fit_end_ch] ).T
@@ -218,14 +463,20 @@ def bgsub_SI_linearized( si, energy, edge, fit_options=None):
         e_win = np.insert( e_win, 0, 1, axis=1)
         e_sub = np.insert( e_sub, 0, 1, axis=1)
 
-        b_fit = linear_regression_QR( y_win, e_win)
+        if fit_options.weighted:
+            b_fit = poisson_regression( y_win, e_win, fit_options.irls, log=False )
+        else:
+            b_fit = linear_regression_QR( y_win, e_win)
         y_fit = e_sub @ b_fit
 
     if fit_options.fit == 'pl':
         e_win = np.insert( np.log(e_win), 0, 1, axis=1)
         e_sub = np.insert( np.log(e_sub), 0, 1, axis=1)
 
-        b_fit = linear_regression_QR( np.log(y_win), e_win )
+        if fit_options.weighted:
+            b_fit = poisson_regression( y_win, e_win, fit_options.irls )
+        else:
+            b_fit = linear_regression_QR( np.log(y_win), e_win )
         y_fit = np.exp(e_sub @ b_fit )
         
         b_fit[0,:] = np.exp( b_fit[0,:] )
@@ -234,7 +485,10 @@ def bgsub_SI_linearized( si, energy, edge, fit_options=None):
         e_win = np.insert( e_win, 0, 1, axis=1)
         e_sub = np.insert( e_sub, 0, 1, axis=1)
 
-        b_fit = linear_regression_QR( np.log(y_win), e_win )
+        if fit_options.weighted:
+            b_fit = poisson_regression( y_win, e_win, fit_options.irls )
+        else:
+            b_fit = linear_regression_QR( np.log(y_win), e_win )
         y_fit = np.exp(e_sub @ b_fit )
 
         b_fit[0,:] = np.exp( b_fit[0,:] )
@@ -245,22 +499,34 @@ def bgsub_SI_linearized( si, energy, edge, fit_options=None):
     bg_SI = np.squeeze( bg_SI )
     return bg_SI, b_fit
 
-def bgsub_SI_nllsq( si, energy, edge, fit_options=None):
+def bgsub_SI_nllsq( si, energy, edge, fit_options=None, mean_spec=None, mask=None):
     """
     Quick background subtraction based on fixed 'r' value
     For Y = Ax + b + error with fixed 'A':
         Y' = b + error. MSE is minimized when b = mean(Y)
+    mean_spec - optional precomputed mean spectrum over the fit window, used for the initial guess
+    mask - optional (xdim,ydim) boolean mask; only those pixels are fitted, the
+           others get a zero background subtracted SI and NaN parameters
     """
     ### Load Fit Options
     if (fit_options is None):
         fit_options = options_bgsub()
+
+    if mask is not None:
+        if not np.any( mask ):
+            return np.zeros( np.shape( si ), dtype=si.dtype ), np.full( (2,) + np.shape( mask ), np.nan )
+        active = gather_pixels( si, mask )
+        bg_act, p_act = bgsub_SI_nllsq( active[:,None,:], energy, edge, fit_options=fit_options, mean_spec=mean_spec )
+        bg_SI = scatter_pixels( bg_act[:,0,:], mask )
+        fit_params = scatter_pixels( p_act[:,:,0].T, mask, fill=np.nan )
+        return bg_SI, np.moveaxis( fit_params, -1, 0 )
     maxfev = fit_options.maxfev
     method = fit_options.method
     ftol   = fit_options.ftol
     gtol   = fit_options.gtol
     xtol   = fit_options.xtol
 
-    fit_start_ch, fit_end_ch = np.searchsorted(energy, edge.e_bsub)
+    fit_start_ch, fit_end_ch = searchsorted(energy, edge.e_bsub)
     e_win = energy[fit_start_ch:fit_end_ch]
     e_sub = energy[fit_start_ch:]
     zdim = len(energy)
@@ -278,7 +544,8 @@ def bgsub_SI_nllsq( si, energy, edge, fit_options=None):
         jac_Func = ls.d_exponential
         fit_params = np.zeros( (2,xdim,ydim) )
 
-    mean_spec = np.mean( y_win, (0,1) )
+    if mean_spec is None:
+        mean_spec = np.mean( y_win, (0,1) )
     popt_init,_ = curve_fit( fitfunc, e_win, mean_spec, maxfev=maxfev,method=method,verbose=0 )
     
     pbar1 = tqdm(total = (xdim)*(ydim),desc = "Background subtracting")
@@ -294,47 +561,149 @@ def bgsub_SI_nllsq( si, energy, edge, fit_options=None):
 
     return bg_SI, fit_params
 
-def bgsub_SI_LC( si, energy, edge, rline, fit_options=None):
-    bg_lcpl_SI = np.zeros_like(si)
+# LC basis functions of recently used windows, keyed by fit type, components and energies
+lc_basis_cache = {}
 
-    ### Load Fit Options
+def lc_basis( energy, fit_start_ch, fit_end_ch, rs, fit='pl' ):
+    """
+    Linear combination background basis, cached per energy window so repeated edges reuse it.
+    Returns X_win (n_win x N) over the fit window and X_sub (n_sub x N) from the window start.
+    """
+    e_sub = np.asarray( energy[fit_start_ch:], dtype='float64' )
+    key = (fit, tuple( np.round( rs, 12 ) ), fit_end_ch-fit_start_ch,
+           hashlib.sha1( e_sub.tobytes() ).hexdigest())
+    if key not in lc_basis_cache:
+        if len( lc_basis_cache ) > 32:
+            lc_basis_cache.clear()
+        if fit == 'pl':
+            X = np.stack( [e_sub**(-r) for r in rs], axis=1 )
+        elif fit == 'exp':
+            X = np.stack( [np.exp(-r*e_sub) for r in rs], axis=1 )
+        lc_basis_cache[key] = X
+    X_sub = lc_basis_cache[key]
+    return X_sub[:fit_end_ch-fit_start_ch], X_sub
+
+def sample_pixels( mask, n, strata=None, seed=None ):
+    """
+    Random subset of n pixels inside a boolean mask, returned as (ys, xs) index arrays.
+    With strata, the mask is cut into strata x strata tiles and every tile contributes
+    in proportion to its number of mask pixels, so no region of the map is left out.
+    """
+    rng = np.random.default_rng( seed )
+    ys, xs = np.nonzero( mask )
+    npix = len( ys )
+    n = int( min( n, npix ) )
+    if strata is None or n == npix:
+        keep = rng.choice( npix, n, replace=False )
+        return ys[keep], xs[keep]
+
+    (xdim, ydim) = mask.shape
+    tile = (ys*strata//xdim)*strata + xs*strata//ydim
+    counts = np.bincount( tile, minlength=strata**2 )
+    quota = np.round( counts*n/npix ).astype( int )
+
+    # Random order within every tile; keep the first quota[tile] pixels of each
+    order = np.lexsort( (rng.random( npix ), tile) )
+    starts = np.cumsum( counts ) - counts
+    rank = np.arange( npix ) - starts[tile[order]]
+    keep = order[rank < quota[tile[order]]]
+    return ys[keep], xs[keep]
+
+def lc_r_distribution( si, energy, edge, mask, fit_options=None, batch=4096, stats=None ):
+    """
+    Mean and standard deviation of the fitted r over a sample of fit_options.lc_sample pixels of mask,
+    accumulated batch by batch with streaming (Welford) statistics. Pixels are fitted with the same
+    engine as bgsub_SI: linearized if fit_options.log or fit=='lin', non-linear otherwise.
+    Returns (rmu, rstd), to be passed to bgsub_SI_LC as rdist.
+    """
     if (fit_options is None):
         fit_options = options_bgsub()
 
-    rmu,rstd = norm.fit(rline)
-
-    rmin = norm.ppf( fit_options.perc[0]*0.01, rmu, rstd )
-    rmax = norm.ppf( fit_options.perc[1]*0.01, rmu, rstd )
-
-
-    (xdim, ydim, zdim) = si.shape
-    fit_start_ch, fit_end_ch = np.searchsorted(energy, edge.e_bsub)
-
-    
+    nsample = fit_options.lc_sample
+    if nsample < 1:
+        nsample = np.ceil( nsample*np.count_nonzero( mask ) )
+    ys, xs = sample_pixels( mask, nsample, fit_options.lc_strata, fit_options.lc_seed )
+
+    fit_start_ch, fit_end_ch = searchsorted( energy, edge.e_bsub )
+    mean_spec = None
+    if stats is not None and not fit_options.lba:
+        mean_spec = stats.mean_spectrum[fit_start_ch:fit_end_ch]
+
+    count, rmu, m2 = 0, 0.0, 0.0
+    for start in range( 0, len(ys), batch ):
+        spectra = np.nan_to_num( np.asarray( si[ys[start:start+batch], xs[start:start+batch]] ).astype( 'float32' ) )[:,None,:]
+        if fit_options.log or (fit_options.fit=='lin'):
+            _, fit_params = bgsub_SI_linearized( spectra, energy, edge, fit_options=fit_options )
+        else:
+            _, fit_params = bgsub_SI_nllsq( spectra, energy, edge, fit_options=fit_options, mean_spec=mean_spec )
+        # Linearized fits return the slope -r, the non-linear ones r itself
+        r = np.reshape( fit_params, (2,-1) )[1]
+        if fit_options.log or (fit_options.fit=='lin'):
+            r = -r
+        r = r[np.isfinite( r )]
+        if len( r ) == 0:
+            continue
+
+        # Merge the batch mean and sum of squared deviations into the running ones
+        n_b, mu_b = len( r ), np.mean( r )
+        m2_b = np.sum( (r-mu_b)**2 )
+        delta = mu_b - rmu
+        total = count + n_b
+        rmu += delta*n_b/total
+        m2 += m2_b + delta**2*count*n_b/total
+        count = total
+
+    if count == 0:
+        raise ValueError( "No valid r values in the sampled pixels" )
+    return rmu, np.sqrt( m2/count )
+
+def lc_exponents( fit_options, rline, rdist=None ):
+    # LC exponents: fit_options.lc_r, or the fit_options.perc percentiles of a normal
+    # distribution fitted to rline (or given as rdist = (rmu, rstd))
     if fit_options.fit=='pl':
         fitname = 'power law'
-        e_win = np.log(energy[fit_start_ch:fit_end_ch])
-        e_sub = np.log(energy[fit_start_ch:])
     elif fit_options.fit=='exp':
         fitname = 'exponential'
-        e_win = energy[fit_start_ch:fit_end_ch]
-        e_sub = energy[fit_start_ch:]
 
-    print( '{}th percentile {} = {}'.format( fit_options.perc[0], fitname, rmin))
-    print('{}th percentile {} = {}'.format( fit_options.perc[1], fitname, rmax))
+    if fit_options.lc_r is not None:
+        return list( fit_options.lc_r )
+    if rdist is None:
+        rmu,rstd = norm.fit(rline)
+    else:
+        rmu,rstd = rdist
+    rs = [norm.ppf( p*0.01, rmu, rstd ) for p in fit_options.perc]
+    for p, r in zip( fit_options.perc, rs ):
+        print( '{}th percentile {} = {}'.format( p, fitname, r))
+    return rs
 
+def bgsub_SI_LC( si, energy, edge, rline, fit_options=None, rdist=None):
+    """
+    Linear combination background: N power laws (or exponentials) with exponents taken at the
+    fit_options.perc percentiles of a normal distribution fitted to rline, or set by fit_options.lc_r.
+    rdist - optional (rmu, rstd) of the r distribution, e.g. from lc_r_distribution, used instead of rline.
+    Weights of all pixels are solved at once, with batched NNLS if fit_options.lc_nonneg.
+    """
+    bg_lcpl_SI = np.zeros_like(si)
+
+    ### Load Fit Options
+    if (fit_options is None):
+        fit_options = options_bgsub()
+
+    rs = lc_exponents( fit_options, rline, rdist )
+
+    (xdim, ydim, zdim) = si.shape
+    fit_start_ch, fit_end_ch = searchsorted(energy, edge.e_bsub)
+
+    e_win, e_sub = lc_basis( energy, fit_start_ch, fit_end_ch, rs, fit_options.fit )
     len_e_win = len(e_win)
     len_e_sub = len(e_sub)
-
-    e_win = np.atleast_2d( energy[fit_start_ch:fit_end_ch] ).T
-    e_win = np.append( e_win**(-rmin), e_win**(-rmax), axis=1)
-    e_sub = np.atleast_2d( energy[fit_start_ch:] ).T
-    e_sub = np.append( e_sub**(-rmin), e_sub**(-rmax), axis=1)
     
     y_win = np.reshape( si[:,:,fit_start_ch:fit_end_ch], (xdim*ydim,len_e_win ) ).T
     
-    
-    b_fit = linear_regression_QR( y_win, e_win )
+    if fit_options.lc_nonneg:
+        b_fit = nnls_batch( y_win, e_win )
+    else:
+        b_fit = linear_regression_QR( y_win, e_win )
     y_fit = (e_sub @ b_fit).T
 
     bgndLCPL = np.reshape( y_fit,(xdim,ydim,len_e_sub))
@@ -342,17 +711,19 @@ def bgsub_SI_LC( si, energy, edge, rline, fit_options=None):
 
     return bg_lcpl_SI
 
-def prepare_si_lba( si, gfwhm, fit_start_ch, fit_end_ch ):
-    lba_raw = np.copy( si )
-    lba_normalized = np.copy( si )
-    for energychannel in np.arange(fit_start_ch,fit_end_ch):
-        lba_raw[:,:,energychannel] = gaussian_filter(si[:,:,energychannel],sigma=gfwhm/2.35)
-    
-    lba_mean = np.mean( lba_raw[:,:,fit_start_ch:fit_end_ch], 2 )
-    data_mean = np.mean(     si[:,:,fit_start_ch:fit_end_ch], 2)
+def lba_window( win, gfwhm ):
+    # Local Background Averaging of the fit window win (xdim,ydim,nwin): every channel is gaussian
+    # filtered in space, then rescaled so each pixel keeps its mean counts over the window
+    lba_raw = np.empty_like( win )
+    for energychannel in range( win.shape[2] ):
+        lba_raw[:,:,energychannel] = gaussian_filter(win[:,:,energychannel],sigma=gfwhm/2.35)
 
-    for energychannel in np.arange(fit_start_ch,fit_end_ch):
-        lba_normalized[:,:,energychannel] = lba_raw[:,:,energychannel]*data_mean/lba_mean
+    lba_mean = np.mean( lba_raw, 2 )
+    data_mean = np.mean( win, 2 )
+    return lba_raw*(data_mean/lba_mean)[:,:,None]
 
+def prepare_si_lba( si, gfwhm, fit_start_ch, fit_end_ch ):
+    lba_normalized = np.copy( si )
+    lba_normalized[:,:,fit_start_ch:fit_end_ch] = lba_window( si[:,:,fit_start_ch:fit_end_ch], gfwhm )
     return lba_normalized
     
\ No newline at end of file
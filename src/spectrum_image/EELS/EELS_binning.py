@@ -0,0 +1,127 @@
+import numpy as np
+
+import spectrum_image.EELS.EELS_bgsub as bg
+from spectrum_image.EELS.EELS_chunks import iter_chunks, gather_pixels, scatter_pixels
+from spectrum_image.EELS.EELS_roi import roi_spectra
+from spectrum_image.EELS.EELS_axis import searchsorted
+
+
+def window_counts( si, energy, e_window, chunk_mb=64 ):
+    # (ny,nx) counts summed over the energy window e_window (eV), streamed by row blocks
+    (ny, nx, ne) = si.shape
+    indmin, indmax = searchsorted( energy, e_window )
+    if indmin == indmax:
+        indmax += 1
+    counts = np.zeros( (ny, nx) )
+    for rows, chunk in iter_chunks( si, chunk_mb ):
+        counts[rows] = np.sum( chunk[..., indmin:indmax], axis=-1, dtype='float64' )
+    return counts
+
+def quadtree_bins( counts, target_snr, mask=None, min_size=1 ):
+    """
+    Adaptive quadtree binning of a counts image. Starting from the whole image, every tile
+    is split into quadrants as long as each quadrant still reaches target_snr, with the
+    Poisson SNR = sqrt(counts). Tiles are split level by level using a summed-area table.
+
+    Inputs:
+    counts - (ny,nx) counts per pixel, e.g. window_counts over the pre-edge window
+    target_snr - SNR every bin should reach, where the counts allow it
+    mask - optional (ny,nx) boolean mask, pixels outside it are not binned
+    min_size - tiles of min_size pixels or fewer are not split further
+
+    Outputs:
+    labels - (ny,nx) integer bin label, 1..nbins, 0 outside mask
+    """
+    (ny, nx) = counts.shape
+    if mask is None:
+        mask = np.ones( (ny, nx), dtype=bool )
+    mask = np.asarray( mask, dtype=bool )
+
+    def table( a ):
+        t = np.zeros( (ny+1, nx+1) )
+        t[1:,1:] = np.cumsum( np.cumsum( a, axis=0 ), axis=1 )
+        return t
+    sat_counts = table( np.where( mask, counts, 0 ) )
+    sat_mask = table( mask )
+
+    def tile_sum( t, y0, y1, x0, x1 ):
+        return t[y1,x1] - t[y0,x1] - t[y1,x0] + t[y0,x0]
+
+    tiles = np.array( [[0, ny, 0, nx]] )
+    leaves = []
+    while len( tiles ):
+        y0, y1, x0, x1 = tiles.T
+        ym = np.where( y1-y0 > 1, (y0+y1)//2, y1 )
+        xm = np.where( x1-x0 > 1, (x0+x1)//2, x1 )
+        # Quadrants, (4, ntiles, 4); a quadrant is empty when its side is not split
+        children = np.stack( [np.stack( [y0, ym, x0, xm], axis=-1 ),
+                              np.stack( [y0, ym, xm, x1], axis=-1 ),
+                              np.stack( [ym, y1, x0, xm], axis=-1 ),
+                              np.stack( [ym, y1, xm, x1], axis=-1 )] )
+        c_pix = tile_sum( sat_mask, *np.moveaxis( children, -1, 0 ) )
+        c_snr = np.sqrt( np.maximum( tile_sum( sat_counts, *np.moveaxis( children, -1, 0 ) ), 0 ) )
+
+        split = (y1-y0)*(x1-x0) > max( min_size, 1 )
+        split &= np.all( (c_pix == 0) | (c_snr >= target_snr), axis=0 )
+        leaves.append( tiles[~split] )
+        children = np.reshape( np.swapaxes( children[:, split], 0, 1 ), (-1, 4) )
+        tiles = children[ tile_sum( sat_mask, *children.T ) > 0 ]
+
+    # Paint the leaves that hold mask pixels with labels 1..nbins
+    leaves = np.concatenate( leaves )
+    leaves = leaves[ tile_sum( sat_mask, *leaves.T ) > 0 ]
+    h = leaves[:,1]-leaves[:,0]
+    w = leaves[:,3]-leaves[:,2]
+    leaf = np.repeat( np.arange( len( leaves ) ), h*w )
+    offset = np.arange( len( leaf ) ) - np.repeat( np.cumsum( h*w ) - h*w, h*w )
+    ys = leaves[leaf,0] + offset//w[leaf]
+    xs = leaves[leaf,2] + offset%w[leaf]
+
+    labels = np.zeros( (ny, nx), dtype=int )
+    labels[ys, xs] = leaf+1
+    labels[~mask] = 0
+    return labels
+
+def bgsub_SI_binned( si, energy, edge, target_snr, fit_options=None, mask=None, min_size=1, chunk_mb=64 ):
+    """
+    Background subtraction on adaptive bins: pixels are grouped by quadtree_bins until the
+    pre-edge window (edge.e_bsub) reaches target_snr, the mean spectrum of each bin is fitted
+    once with the bgsub_SI engines (linearized if fit_options.log or fit=='lin', non-linear
+    otherwise), and the slope of each bin is broadcast to its pixels. Every pixel then only
+    gets its own amplitude, via bgsub_SI_fast with the slope map.
+
+    Inputs:
+    si - (ny,nx,ne) spectrum image in counts
+    energy - energy axis
+    edge - EELS_edge
+    target_snr - pre-edge SNR every bin should reach
+    fit_options - eels_bgsub.options_bgsub object
+    mask - optional (ny,nx) boolean non-vacuum mask, pixels outside are not fitted
+
+    Outputs:
+    bg_SI - background subtracted SI, 0 outside mask
+    fit_params - (2, ny, nx) per-pixel parameters in the bgsub_SI_linearized convention, NaN outside mask
+    labels - (ny,nx) bin labels, 1..nbins, 0 outside mask
+    """
+    if (fit_options is None):
+        fit_options = bg.options_bgsub()
+
+    counts = window_counts( si, energy, edge.e_bsub, chunk_mb )
+    labels = quadtree_bins( counts, target_snr, mask=mask, min_size=min_size )
+
+    spectra = roi_spectra( si, labels, chunk_mb )[:,None,:]
+    if fit_options.log or (fit_options.fit=='lin'):
+        _, bin_params = bg.bgsub_SI_linearized( spectra, energy, edge, fit_options=fit_options )
+        slope = np.reshape( bin_params, (2,-1) )[1]
+    else:
+        _, bin_params = bg.bgsub_SI_nllsq( spectra, energy, edge, fit_options=fit_options )
+        slope = -np.reshape( bin_params, (2,-1) )[1]
+
+    inbin = labels > 0
+    active = np.nan_to_num( gather_pixels( si, inbin ).astype( 'float32' ) )[:,None,:]
+    rval = slope[labels[inbin]-1][:,None]
+    bg_act, p_act = bg.bgsub_SI_fast( active, energy, edge, rval, fit_options=fit_options, return_params=True )
+
+    bg_SI = scatter_pixels( np.reshape( bg_act, (len(active),-1) ), inbin )
+    fit_params = scatter_pixels( np.reshape( p_act, (2,-1) ).T, inbin, fill=np.nan, dtype='float64' )
+    return bg_SI, np.moveaxis( fit_params, -1, 0 ), labels
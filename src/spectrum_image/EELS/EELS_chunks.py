@@ -0,0 +1,63 @@
+import numpy as np
+
+def chunk_len( a, chunk_mb=64 ):
+    # Number of leading-axis rows of a that fit in chunk_mb megabytes
+    row_bytes = a.itemsize * int( np.prod( a.shape[1:] ) )
+    return max( 1, int( chunk_mb*2**20 // max( row_bytes, 1 ) ) )
+
+def nan_to_zero( chunk ):
+    # NaN-free copy of a chunk; integer data is returned as-is
+    if chunk.dtype.kind in 'fc':
+        return np.nan_to_num( chunk, copy=True, nan=0.0 )
+    return chunk
+
+def iter_chunks( a, chunk_mb=64, start=0, stop=None ):
+    """
+    Iterate over blocks of rows along the first axis of a (e.g. SI rows).
+    Only one block is read into memory at a time, so memmapped data is streamed.
+
+    Yields:
+    rows - slice of the block along the first axis
+    chunk - NaN-free block a[rows]
+    """
+    if stop is None:
+        stop = a.shape[0]
+    step = chunk_len( a, chunk_mb )
+    for i in range( start, stop, step ):
+        rows = slice( i, min( i+step, stop ) )
+        yield rows, nan_to_zero( np.asarray( a[rows] ) )
+
+def chunked_mean( a, axis, chunk_mb=64 ):
+    """
+    NaN-safe mean of a along axis, reduced chunk by chunk.
+    NaNs count as zeros, identical to zero filling the array first.
+    """
+    axis = tuple( np.atleast_1d( axis ) % a.ndim )
+    count = np.prod( [a.shape[ax] for ax in axis] )
+
+    if 0 in axis:
+        total = 0
+        for rows, chunk in iter_chunks( a, chunk_mb ):
+            total = total + np.sum( chunk, axis=axis, dtype='float64' )
+        return total/count
+
+    out = np.empty( [a.shape[ax] for ax in range(a.ndim) if ax not in axis] )
+    for rows, chunk in iter_chunks( a, chunk_mb ):
+        out[rows] = np.mean( chunk, axis=axis, dtype='float64' )
+    return out
+
+def gather_pixels( si, mask ):
+    # Compact (npix, ne) copy of the spectra of si (ny,nx,ne) where mask (ny,nx) is True
+    return np.asarray( si[np.asarray( mask, dtype=bool )] )
+
+def scatter_pixels( values, mask, fill=0, dtype=None ):
+    """
+    Inverse of gather_pixels: place per-pixel values (npix, ...) back at the True pixels
+    of mask (ny,nx) in a new (ny,nx,...) array filled with fill elsewhere.
+    """
+    mask = np.asarray( mask, dtype=bool )
+    values = np.asarray( values )
+    out = np.full( mask.shape + values.shape[1:], fill,
+                   dtype=values.dtype if dtype is None else dtype )
+    out[mask] = values
+    return out
@@ -0,0 +1,82 @@
+import numpy as np
+from scipy import sparse
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import IncrementalPCA
+
+from spectrum_image.EELS.EELS_chunks import iter_chunks
+
+
+def unit_sum( spectra ):
+    # Spectra (npix, ne) normalized to unit total counts
+    total = np.sum( spectra, axis=-1, keepdims=True )
+    return np.divide( spectra, total, out=np.zeros_like(spectra), where=total!=0 )
+
+def iter_pixel_batches( si, min_pixels, chunk_mb=64, normalize=False ):
+    # (npix, ne) float pixel batches of at least min_pixels spectra (except the last), streamed from si
+    (ny, nx, ne) = si.shape
+    chunk_mb = max( chunk_mb, (min_pixels+nx)*si.itemsize*ne/2**20 )
+    for rows, chunk in iter_chunks( si, chunk_mb ):
+        spectra = np.reshape( chunk, (-1, ne) ).astype( 'float64' )
+        if normalize:
+            spectra = unit_sum( spectra )
+        yield rows, spectra
+
+def cluster_SI( si, n_clusters, n_components=None, normalize=False, n_epochs=3,
+                random_state=None, chunk_mb=64 ):
+    """
+    Segment an SI into phases with mini-batch k-means, streamed block by block so memmapped
+    SIs never have to fit in memory.
+
+    Inputs:
+    si - (ny,nx,ne) spectrum image
+    n_clusters - number of clusters
+    n_components - if set, cluster on IncrementalPCA scores with this many components instead of raw spectra
+    normalize - if True, cluster spectra normalized to unit total counts (shape rather than intensity)
+    n_epochs - number of passes over the SI for k-means
+
+    Outputs:
+    labels - (ny,nx) cluster index of every pixel
+    mean_spectra - (n_clusters, ne) mean raw spectrum of every cluster, accumulated in the labelling pass.
+                   Can be passed directly to bgsub_SI_linearized; labels_to_masks( labels ) gives
+                   matching masks for the rois argument of SpectrumImage.fitbrowser.
+    """
+    (ny, nx, ne) = si.shape
+    min_pixels = max( n_clusters, n_components or 0 )
+
+    pca = None
+    if n_components is not None:
+        pca = IncrementalPCA( n_components=n_components )
+        for rows, spectra in iter_pixel_batches( si, min_pixels, chunk_mb, normalize ):
+            if len( spectra ) >= n_components:
+                pca.partial_fit( spectra )
+
+    def features( spectra ):
+        return spectra if pca is None else pca.transform( spectra )
+
+    kmeans = MiniBatchKMeans( n_clusters=n_clusters, random_state=random_state )
+    for epoch in range( n_epochs ):
+        for rows, spectra in iter_pixel_batches( si, min_pixels, chunk_mb, normalize ):
+            if epoch > 0 or len( spectra ) >= n_clusters:
+                kmeans.partial_fit( features( spectra ) )
+
+    # Label pixels and accumulate cluster sums in a single pass
+    labels = np.zeros( (ny, nx), dtype=int )
+    sums = np.zeros( (n_clusters, ne) )
+    for rows, chunk in iter_chunks( si, chunk_mb ):
+        spectra = np.reshape( chunk, (-1, ne) )
+        if normalize:
+            lab = kmeans.predict( features( unit_sum( spectra.astype( 'float64' ) ) ) )
+        else:
+            lab = kmeans.predict( features( spectra.astype( 'float64' ) ) )
+        labels[rows] = np.reshape( lab, (-1, nx) )
+        onehot = sparse.csr_matrix( (np.ones( len(lab) ), (lab, np.arange( len(lab) ))),
+                                    shape=(n_clusters, len(lab)) )
+        sums += onehot @ spectra
+
+    counts = np.bincount( labels.ravel(), minlength=n_clusters )
+    mean_spectra = sums/np.maximum( counts, 1 )[:,None]
+    return labels, mean_spectra
+
+def labels_to_masks( labels ):
+    # List of boolean masks, one per label value 0..labels.max()
+    return [labels == k for k in range( labels.max()+1 )]
@@ -0,0 +1,120 @@
+import numpy as np
+from scipy import fft
+
+from spectrum_image.EELS.EELS_chunks import iter_chunks
+
+
+def zlp_threshold( spectra ):
+    # Index of the first minimum after the zero-loss peak, for every row of spectra (m, ne)
+    ne = spectra.shape[-1]
+    peak = np.argmax( spectra, axis=-1 )
+    rising = np.diff( spectra, axis=-1 ) > 0
+    rising &= np.arange( ne-1 ) > peak[:,None]
+    threshold = np.argmax( rising, axis=-1 )
+    threshold[ ~rising.any( axis=-1 ) ] = ne-1
+    return threshold
+
+def hann_taper( spectra, ntaper ):
+    # Bring the last ntaper channels smoothly to zero to avoid truncation ringing
+    if ntaper > 0:
+        spectra[..., -ntaper:] *= 0.5*(1 + np.cos( np.pi*np.arange( 1, ntaper+1 )/ntaper ))
+    return spectra
+
+def gaussian_kernel_ft( n, energy, fwhm ):
+    # rfft of a unit-area gaussian of fwhm (eV), centered at 0 eV of energy
+    dispersion = energy[1]-energy[0]
+    i0 = -energy[0]/dispersion
+    sigma = fwhm/2.3548/dispersion
+    nu = fft.rfftfreq( n )
+    return np.exp( -2*(np.pi*sigma*nu)**2 - 2j*np.pi*nu*i0 )
+
+def fourier_log( si_ll, energy_ll, fwhm=None, ntaper=None, out=None, chunk_mb=64 ):
+    """
+    Fourier-log deconvolution of a low-loss SI, removing plural scattering.
+    Spectra are processed in row blocks with a batched rfft along the energy axis.
+
+    Inputs:
+    si_ll - (ny,nx,ne) low-loss SI containing the zero-loss peak
+    energy_ll - energy axis of si_ll
+    fwhm - width (eV) of the gaussian reconvolution function. None reconvolves with the zero-loss peak.
+    ntaper - number of channels tapered at the high-energy end, default ne//20
+    out - optional (ny,nx,ne) output array, e.g. a memmap, filled block by block
+
+    Outputs:
+    ssd - single scattering distribution on energy_ll
+    """
+    (ny, nx, ne) = si_ll.shape
+    if ntaper is None:
+        ntaper = ne//20
+    if out is None:
+        out = np.zeros( (ny, nx, ne), dtype='float32' )
+    n = fft.next_fast_len( 2*ne, real=True )
+    channels = np.arange( ne )
+
+    for rows, chunk in iter_chunks( si_ll, chunk_mb ):
+        spectra = np.reshape( chunk, (-1, ne) ).astype( 'float64' )
+        zlp = spectra * ( channels <= zlp_threshold( spectra )[:,None] )
+
+        j = fft.rfft( hann_taper( spectra, ntaper ), n, axis=-1 )
+        z = fft.rfft( zlp, n, axis=-1 )
+        with np.errstate( divide='ignore', invalid='ignore' ):
+            log_jz = np.nan_to_num( np.log( j/z ), nan=0.0, posinf=0.0, neginf=0.0 )
+
+        if fwhm is None:
+            s = z*log_jz
+        else:
+            i0 = np.sum( zlp, axis=-1, keepdims=True )
+            s = i0*gaussian_kernel_ft( n, energy_ll, fwhm )*log_jz
+
+        ssd = fft.irfft( s, n, axis=-1 )[:, :ne]
+        out[rows] = np.reshape( ssd, chunk.shape )
+    return out
+
+def fourier_ratio( si_ll, si_cl, energy_ll, energy_cl, fwhm=None, ntaper=None, out=None, chunk_mb=64 ):
+    """
+    Fourier-ratio deconvolution of a core-loss SI by the low-loss SI of the same pixels,
+    e.g. the pair returned by specload_dual. Spectra are processed in row blocks with a
+    batched rfft along the energy axis; both halves need the same dispersion.
+
+    Inputs:
+    si_ll, si_cl - (ny,nx,ne_ll) low-loss and (ny,nx,ne_cl) core-loss SIs
+    energy_ll, energy_cl - their energy axes
+    fwhm - width (eV) of the gaussian reconvolution function. None reconvolves with the zero-loss peak.
+    ntaper - number of channels tapered at the high-energy end, default ne//20
+    out - optional (ny,nx,ne_cl) output array, e.g. a memmap, filled block by block
+
+    Outputs:
+    si_ssd - single scattering core-loss SI on energy_cl
+    """
+    (ny, nx, ne_ll) = si_ll.shape
+    ne_cl = si_cl.shape[-1]
+    if not np.isclose( energy_ll[1]-energy_ll[0], energy_cl[1]-energy_cl[0] ):
+        raise ValueError( "Low-loss and core-loss SIs need the same dispersion" )
+    if ntaper is None:
+        ntaper = ne_cl//20
+    if out is None:
+        out = np.zeros( (ny, nx, ne_cl), dtype='float32' )
+    n = fft.next_fast_len( ne_ll+ne_cl, real=True )
+    channels = np.arange( ne_ll )
+
+    # Take equally many rows of both SIs per block
+    chunk_mb = chunk_mb*ne_ll/(ne_ll+ne_cl)
+    for rows, chunk in iter_chunks( si_ll, chunk_mb ):
+        spectra_ll = np.reshape( chunk, (-1, ne_ll) ).astype( 'float64' )
+        spectra_cl = np.reshape( np.nan_to_num( np.asarray( si_cl[rows] ) ), (-1, ne_cl) ).astype( 'float64' )
+        zlp = spectra_ll * ( channels <= zlp_threshold( spectra_ll )[:,None] )
+
+        l = fft.rfft( hann_taper( spectra_ll, ne_ll//20 ), n, axis=-1 )
+        c = fft.rfft( hann_taper( spectra_cl, ntaper ), n, axis=-1 )
+        with np.errstate( divide='ignore', invalid='ignore' ):
+            c_l = np.nan_to_num( c/l, nan=0.0, posinf=0.0, neginf=0.0 )
+
+        if fwhm is None:
+            d = fft.rfft( zlp, n, axis=-1 )*c_l
+        else:
+            i0 = np.sum( zlp, axis=-1, keepdims=True )
+            d = i0*gaussian_kernel_ft( n, energy_ll, fwhm )*c_l
+
+        ssd = fft.irfft( d, n, axis=-1 )[:, :ne_cl]
+        out[rows] = np.reshape( ssd, (-1, nx, ne_cl) )
+    return out
@@ -0,0 +1,162 @@
+import numpy as np
+import numpy.linalg as LA
+
+import spectrum_image.EELS.EELS_lineshapes as ls
+
+
+def levenberg_marquardt( fun, p0, y, max_iter=100, tol=1e-10, lam=1e-3, free=None ):
+    """
+    Levenberg-Marquardt least squares for many independent spectra at once.
+    Every spectrum keeps its own damping and stops when its cost no longer improves;
+    only the spectra still iterating are evaluated.
+
+    Inputs:
+    fun - fun( p ) -> (f, J) for parameters p (m, k): model f (m, ne) and Jacobian J (k, m, ne)
+    p0 - (m, k) or (k,) initial parameters
+    y - (m, ne) data
+    free - optional (k,) boolean mask, parameters set False stay at p0
+
+    Outputs:
+    p - (m, k) fitted parameters
+    cost - (m,) sum of squared residuals
+    """
+    y = np.atleast_2d( np.asarray( y, dtype='float64' ) )
+    m = len( y )
+    p = np.array( np.broadcast_to( p0, (m, np.shape(p0)[-1]) ), dtype='float64' )
+    k = p.shape[1]
+    free = np.ones( k, dtype=bool ) if free is None else np.asarray( free, dtype=bool )
+
+    f, J = fun( p )
+    r = y - f
+    cost = np.sum( r**2, axis=-1 )
+    lam = np.full( m, float( lam ) )
+    active = np.ones( m, dtype=bool )
+
+    for it in range( max_iter ):
+        idx, = np.nonzero( active )
+        if len( idx ) == 0:
+            break
+        Ja = J[:, idx] * free[:,None,None]
+        JtJ = np.einsum( 'kmi,lmi->mkl', Ja, Ja )
+        g = np.einsum( 'kmi,mi->mk', Ja, r[idx] )
+
+        # Marquardt scaling by the diagonal; fixed parameters get a unit diagonal and zero step
+        diag = np.einsum( 'mkk->mk', JtJ ) + ~free
+        A = JtJ + (lam[idx,None]*np.maximum( diag, 1e-12*diag.max( axis=-1, keepdims=True ) ))[:,:,None]*np.eye( k ) \
+            + np.diag( (~free).astype( float ) )
+        try:
+            delta = LA.solve( A, g[...,None] )[...,0]
+        except LA.LinAlgError:
+            delta = (LA.pinv( A ) @ g[...,None])[...,0]
+
+        p_new = p[idx] + delta
+        f_new, J_new = fun( p_new )
+        r_new = y[idx] - f_new
+        cost_new = np.sum( r_new**2, axis=-1 )
+
+        better = np.isfinite( cost_new ) & (cost_new < cost[idx])
+        acc = idx[better]
+        p[acc], f[acc], r[acc] = p_new[better], f_new[better], r_new[better]
+        J[:, acc] = J_new[:, better]
+        small = (cost[acc] - cost_new[better]) <= tol*cost[acc]
+        cost[acc] = cost_new[better]
+
+        lam[idx] = np.where( better, lam[idx]/10, lam[idx]*10 )
+        active[acc[small]] = False
+        active[idx[lam[idx] > 1e10]] = False
+
+    return p, cost
+
+
+######## Multi-peak models
+def peak_model( x, peaks, background='linear' ):
+    """
+    Sum of peaks plus a polynomial background, as fun( p ) -> (f, J) for levenberg_marquardt.
+    Peaks are evaluated with EELS_lineshapes.value_and_jacobian straight into the Jacobian buffer.
+
+    Inputs:
+    x - energy axis of the fit window
+    peaks - list of peak lineshape names: 'gaussian', 'lorentzian' (A, e0, sg),
+            'pseudo_voigt' (A, e0, sg, eta) or 'voigt' (A, e0, sg, gm)
+    background - None, 'constant' or 'linear' (c0 + c1*x)
+
+    Outputs:
+    fun - model function for levenberg_marquardt
+    names - parameter names, e.g. ['p0_A', 'p0_e0', 'p0_sg', ..., 'bg_c0', 'bg_c1']
+    """
+    x = np.asarray( x, dtype='float64' )
+    nbg = {None: 0, 'constant': 1, 'linear': 2}[background]
+    names, slices = [], []
+    for i, shape in enumerate( peaks ):
+        pnames = ls.lineshapes[shape][1]
+        slices.append( slice( len(names), len(names)+len(pnames) ) )
+        names += [ 'p{}_{}'.format( i, n ) for n in pnames ]
+    npeak = len( names )
+    names += [ 'bg_c{}'.format( i ) for i in range( nbg ) ]
+    powers = x[None,None,:]**np.arange( nbg )[:,None,None]
+
+    def fun( p ):
+        m = len( p )
+        f = np.zeros( (m, len(x)) )
+        fi = np.empty( (m, len(x)) )
+        J = np.empty( (len(names), m, len(x)) )
+        for shape, sl in zip( peaks, slices ):
+            ls.value_and_jacobian( shape, x, p[:, sl], out=fi, jac=J[sl] )
+            f += fi
+        if nbg:
+            J[npeak:] = powers
+            f += p[:, npeak:] @ powers[:,0,:]
+        return f, J
+
+    return fun, names
+
+def fit_peaks( spectra, x, peaks, p0, background='linear', seed=None, block=32, free=None, max_iter=100 ):
+    """
+    Fit a multi-peak model to a sequence of spectra (e.g. the columns of a RIXS map).
+    Spectra are solved in blocks with levenberg_marquardt, moving outward from the seed
+    spectrum; every block starts from the fitted parameters of its neighbour.
+
+    Inputs:
+    spectra - (n, ne) spectra on x
+    peaks, background - see peak_model
+    p0 - initial parameters of the seed block, peaks first; missing background terms start at 0
+    seed - index of the first spectrum, default the one with the largest total intensity
+    block - number of spectra solved together
+    free - optional boolean mask of fitted parameters, see levenberg_marquardt
+
+    Outputs:
+    params - (n, k) fitted parameters
+    cost - (n,) sum of squared residuals
+    names - parameter names
+    """
+    spectra = np.nan_to_num( np.asarray( spectra, dtype='float64' ) )
+    n = len( spectra )
+    fun, names = peak_model( x, peaks, background )
+    p_init = np.zeros( len(names) )
+    p_init[:len(p0)] = p0
+    if seed is None:
+        seed = int( np.argmax( np.sum( spectra, axis=-1 ) ) )
+
+    params = np.zeros( (n, len(names)) )
+    cost = np.zeros( n )
+    blocks = [(seed, min( seed+block, n ), p_init)]
+    while blocks:
+        start, stop, p_start = blocks.pop()
+        rows = slice( start, stop )
+        params[rows], cost[rows] = levenberg_marquardt( fun, p_start, spectra[rows], max_iter=max_iter, free=free )
+        # Queue the neighbouring blocks, warm started from the adjacent edge of this one
+        if stop < n and (start >= seed):
+            blocks.append( (stop, min( stop+block, n ), params[stop-1]) )
+        if start > 0 and (start <= seed):
+            blocks.append( (max( start-block, 0 ), start, params[start]) )
+
+    # Widths are symmetric in sign
+    for k, name in enumerate( names ):
+        if name.endswith( ('_sg', '_gm') ):
+            params[:, k] = np.abs( params[:, k] )
+    return params, cost, names
+
+def peak_model_values( x, peaks, params, background='linear' ):
+    # (n, ne) model spectra of fitted parameters (n, k)
+    fun, names = peak_model( x, peaks, background )
+    return fun( np.atleast_2d( params ) )[0]
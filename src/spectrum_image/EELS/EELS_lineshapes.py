@@ -1,52 +1,181 @@
 import numpy as np
+from scipy.special import wofz
+
+## Parameters are scalars, or arrays of shape (npix,) that broadcast against the energy axis x:
+## values are then (npix, ne) and Jacobians (nparam, npix, ne). The d_* functions keep the
+## (ne, nparam) layout of curve_fit for scalar parameters.
+
+def as_column( p ):
+    # (npix,) parameter arrays become (npix, 1) columns, scalars stay scalars
+    p = np.asarray( p, dtype='float64' )
+    return p[...,None] if p.ndim else p
+
+def buffers( x, params, out, jac ):
+    # Preallocated value (npix, ne) and Jacobian (nparam, npix, ne) buffers
+    shape = np.broadcast_shapes( np.shape( x ), *[np.shape( p ) for p in params] )
+    if out is None:
+        out = np.empty( shape )
+    if jac is None:
+        jac = np.empty( (len(params),) + shape )
+    return out, jac
+
+def jacobian_T( jac, params ):
+    # curve_fit layout (ne, nparam) for scalar parameters
+    return jac.T if all( np.ndim( p ) == 0 for p in params ) else jac
+
 
 ## Peak Like functions
 def gaussian( x, A, e0, sg ):
+    A, e0, sg = as_column( A ), as_column( e0 ), as_column( sg )
     return A*np.exp( -0.5*( ((x-e0)/sg)**2 ) )
+def gaussian_vj( x, A, e0, sg, out=None, jac=None ):
+    A, e0, sg = as_column( A ), as_column( e0 ), as_column( sg )
+    out, jac = buffers( x, (A, e0, sg), out, jac )
+    u = (x-e0)/sg
+    np.exp( -0.5*u**2, out=jac[0] )
+    np.multiply( A, jac[0], out=out )
+    np.multiply( out, u/sg, out=jac[1] )
+    np.multiply( jac[1], u, out=jac[2] )
+    return out, jac
 def d_gaussian( x, A, e0, sg ):
-    dfdA = np.exp( -0.5*( ((x-e0)/sg)**2 ) )
-    dfde = A*(x-e0)/(sg**2)*dfdA
-    dfds = (x-e0)/sg*dfdA
-    return np.asarray([dfdA,dfde,dfds]).T
+    return jacobian_T( gaussian_vj( x, A, e0, sg )[1], (A, e0, sg) )
 
 def lorentzian( x, A, e0, sg ):
+    # sg is the gaussian-equivalent width: same FWHM as gaussian( x, A, e0, sg )
+    A, e0, sg = as_column( A ), as_column( e0 ), as_column( sg )
     gm = sg*np.sqrt(2*np.log(2))
     return A/( ((x-e0)/gm)**2 + 1 )
-def d_lorentzian( x, A, e0, sg ):
+def lorentzian_vj( x, A, e0, sg, out=None, jac=None ):
+    A, e0, sg = as_column( A ), as_column( e0 ), as_column( sg )
+    out, jac = buffers( x, (A, e0, sg), out, jac )
     gm = sg*np.sqrt(2*np.log(2))
-    dfdA = 1/( ((x-e0)/gm)**2 + 1 )
-    dfde = 2*e0*A*( dfdA**2 )* ((x-e0)/gm)
-    dfds = 2*A*( dfdA**2 )*((x-e0)**2)/(gm**3) * np.sqrt(2*np.log(2))
-    return np.asarray([dfdA,dfde,dfds]).T
+    v = (x-e0)/gm
+    np.reciprocal( v**2 + 1, out=jac[0] )
+    np.multiply( A, jac[0], out=out )
+    np.multiply( out, 2*jac[0]*v, out=jac[2] )
+    np.divide( jac[2], gm, out=jac[1] )
+    np.multiply( jac[2], v/sg, out=jac[2] )
+    return out, jac
+def d_lorentzian( x, A, e0, sg ):
+    return jacobian_T( lorentzian_vj( x, A, e0, sg )[1], (A, e0, sg) )
+
+def pseudo_voigt( x, A, e0, sg, eta ):
+    # eta*lorentzian + (1-eta)*gaussian of equal FWHM and peak height A
+    eta = as_column( eta )
+    return eta*lorentzian( x, A, e0, sg ) + (1-eta)*gaussian( x, A, e0, sg )
+def pseudo_voigt_vj( x, A, e0, sg, eta, out=None, jac=None ):
+    eta = as_column( eta )
+    out, jac = buffers( x, (as_column( A ), as_column( e0 ), as_column( sg ), eta), out, jac )
+    fg, jg = gaussian_vj( x, A, e0, sg )
+    fl, jl = lorentzian_vj( x, A, e0, sg )
+    np.add( eta*fl, (1-eta)*fg, out=out )
+    np.add( eta*jl, (1-eta)*jg, out=jac[:3] )
+    np.subtract( fl, fg, out=jac[3] )
+    return out, jac
+def d_pseudo_voigt( x, A, e0, sg, eta ):
+    return jacobian_T( pseudo_voigt_vj( x, A, e0, sg, eta )[1], (A, e0, sg, eta) )
+
+def voigt( x, A, e0, sg, gm ):
+    # Convolution of a gaussian (std sg) and a lorentzian (HWHM gm) with area A, via the Faddeeva function
+    A, e0, sg, gm = as_column( A ), as_column( e0 ), as_column( sg ), as_column( gm )
+    z = ((x-e0) + 1j*gm)/(sg*np.sqrt(2))
+    return A*np.real( wofz( z ) )/(sg*np.sqrt(2*np.pi))
+def voigt_vj( x, A, e0, sg, gm, out=None, jac=None ):
+    A, e0, sg, gm = as_column( A ), as_column( e0 ), as_column( sg ), as_column( gm )
+    out, jac = buffers( x, (A, e0, sg, gm), out, jac )
+    s2 = sg*np.sqrt(2)
+    z = ((x-e0) + 1j*gm)/s2
+    w = wofz( z )
+    # w'(z) = -2 z w(z) + 2i/sqrt(pi)
+    dw = -2*z*w + 2j/np.sqrt(np.pi)
+    norm = 1/(sg*np.sqrt(2*np.pi))
+    np.multiply( np.real( w ), norm, out=jac[0] )
+    np.multiply( A, jac[0], out=out )
+    np.multiply( A*norm, np.real( -dw/s2 ), out=jac[1] )
+    np.subtract( A*norm*np.real( -dw*z/sg ), out/sg, out=jac[2] )
+    np.multiply( A*norm, np.real( 1j*dw/s2 ), out=jac[3] )
+    return out, jac
+def d_voigt( x, A, e0, sg, gm ):
+    return jacobian_T( voigt_vj( x, A, e0, sg, gm )[1], (A, e0, sg, gm) )
 
 ## Decay Functions
 def powerlaw( x, A1, r1 ):
+    A1, r1 = as_column( A1 ), as_column( r1 )
     return A1 * ( x**(-r1) )
+def powerlaw_vj( x, A1, r1, out=None, jac=None ):
+    A1, r1 = as_column( A1 ), as_column( r1 )
+    out, jac = buffers( x, (A1, r1), out, jac )
+    np.power( x, -r1, out=jac[0] )
+    np.multiply( A1, jac[0], out=out )
+    np.multiply( out, -np.log(x), out=jac[1] )
+    return out, jac
 def d_powerlaw( x, A1, r1):
-    dfdA = x**(-r1)
-    dfdr = -A1*np.log(x)*dfdA
-    return np.array( [dfdA, dfdr]).T
+    return jacobian_T( powerlaw_vj( x, A1, r1 )[1], (A1, r1) )
 
 def lcpowerlaw( x, A1, r1, A2, r2 ):
-    return A1 * ( x**(-r1) ) + A2 * ( x**(-r2) )
+    return powerlaw( x, A1, r1 ) + powerlaw( x, A2, r2 )
+def lcpowerlaw_vj( x, A1, r1, A2, r2, out=None, jac=None ):
+    out, jac = buffers( x, tuple( as_column( p ) for p in (A1, r1, A2, r2) ), out, jac )
+    f2, _ = powerlaw_vj( x, A2, r2, jac=jac[2:] )
+    powerlaw_vj( x, A1, r1, out=out, jac=jac[:2] )
+    out += f2
+    return out, jac
 def d_lcpowerlaw( x, A1, r1, A2,r2):
-    dfdA1 = x**(-r1)
-    dfdr1 = -A1*np.log(x)*dfdA1
-    dfdA2 = x**(-r2)
-    dfdr2 = -A2*np.log(x)*dfdA2
-    return np.array( [dfdA1, dfdr1, dfdA2, dfdr2]).T
+    return jacobian_T( lcpowerlaw_vj( x, A1, r1, A2, r2 )[1], (A1, r1, A2, r2) )
 
 def exponential( x, A1, b ):
+    A1, b = as_column( A1 ), as_column( b )
     return A1*np.exp(-b*x)
+def exponential_vj( x, A1, b, out=None, jac=None ):
+    A1, b = as_column( A1 ), as_column( b )
+    out, jac = buffers( x, (A1, b), out, jac )
+    np.exp( -b*x, out=jac[0] )
+    np.multiply( A1, jac[0], out=out )
+    np.multiply( out, -x, out=jac[1] )
+    return out, jac
 def d_exponential( x, A1, b ):
-    dfdA = np.exp(-b*x)
-    dfdb = -b*A1*dfdA
-    return np.array( [dfdA, dfdb] ).T
+    return jacobian_T( exponential_vj( x, A1, b )[1], (A1, b) )
 
 ## Other Functions
 def linear( x, a, b):
+    a, b = as_column( a ), as_column( b )
     return a*x + b
+def linear_vj( x, a, b, out=None, jac=None ):
+    a, b = as_column( a ), as_column( b )
+    out, jac = buffers( x, (a, b), out, jac )
+    jac[0] = x
+    jac[1] = 1
+    np.add( a*x, b, out=out )
+    return out, jac
 def d_linear( x, a, b):
-    dfda = x
-    dfdb = np.ones_like(x)
-    return np.array( [dfda, dfdb] ).T
\ No newline at end of file
+    return jacobian_T( linear_vj( x, a, b )[1], (a, b) )
+
+
+## Fused evaluation by name
+lineshapes = {'gaussian':     (gaussian_vj,     ('A', 'e0', 'sg')),
+              'lorentzian':   (lorentzian_vj,   ('A', 'e0', 'sg')),
+              'pseudo_voigt': (pseudo_voigt_vj, ('A', 'e0', 'sg', 'eta')),
+              'voigt':        (voigt_vj,        ('A', 'e0', 'sg', 'gm')),
+              'powerlaw':     (powerlaw_vj,     ('A', 'r')),
+              'lcpowerlaw':   (lcpowerlaw_vj,   ('A1', 'r1', 'A2', 'r2')),
+              'exponential':  (exponential_vj,  ('A', 'b')),
+              'linear':       (linear_vj,       ('a', 'b'))}
+
+def value_and_jacobian( name, x, params, out=None, jac=None ):
+    """
+    Value and Jacobian of lineshape name, sharing every intermediate term.
+
+    Inputs:
+    name - key of lineshapes, e.g. 'gaussian', 'voigt', 'powerlaw'
+    x - energy axis (ne,)
+    params - (npix, nparam) array, or a sequence of nparam scalars / (npix,) arrays
+    out, jac - optional preallocated (npix, ne) and (nparam, npix, ne) buffers, filled in place
+
+    Outputs:
+    f - (npix, ne) values
+    J - (nparam, npix, ne) derivatives with respect to each parameter
+    """
+    fun, names = lineshapes[name]
+    if isinstance( params, np.ndarray ) and params.ndim == 2:
+        params = params.T
+    return fun( x, *params, out=out, jac=jac )
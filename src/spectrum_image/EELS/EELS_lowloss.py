@@ -0,0 +1,121 @@
+import numpy as np
+
+from spectrum_image.EELS.EELS_chunks import iter_chunks
+from spectrum_image.EELS.EELS_axis import EnergyAxis, searchsorted
+from spectrum_image.EELS.EELS_deconv import zlp_threshold
+from spectrum_image.EELS.EELS_util import zlp_shifts, shift_spectra
+
+
+def thickness_map( si_lowloss, energy, zlp_window=None, mask_threshold=None, chunk_mb=64 ):
+    """
+    Log-ratio thickness map t/lambda = ln( I_total / I_zlp ) of a low-loss SI.
+    Evaluated with array operations on row blocks, so memmapped inputs are streamed.
+
+    Inputs:
+    si_lowloss - (ny,nx,ne) low-loss SI
+    energy - energy axis of si_lowloss
+    zlp_window - (emin, emax) in eV integrated as zero-loss peak. None detects, per pixel,
+                 everything up to the first minimum after the peak.
+    mask_threshold - if set, also return mask = t/lambda > mask_threshold,
+                     usable as the mask argument of bgsub_SI to exclude vacuum
+
+    Outputs:
+    tlambda - (ny,nx) t/lambda map, NaN where no zero-loss counts were found
+    mask - (ny,nx) boolean non-vacuum mask, only if mask_threshold is set
+    """
+    (ny, nx, ne) = si_lowloss.shape
+    if zlp_window is not None:
+        indmin, indmax = searchsorted( energy, zlp_window )
+        if indmin == indmax:
+            indmax += 1
+    channels = np.arange( ne )
+
+    tlambda = np.full( (ny, nx), np.nan )
+    for rows, chunk in iter_chunks( si_lowloss, chunk_mb ):
+        spectra = np.reshape( chunk, (-1, ne) )
+        i_total = np.sum( spectra, axis=-1, dtype='float64' )
+        if zlp_window is None:
+            inzlp = channels <= zlp_threshold( spectra )[:,None]
+            i_zlp = np.sum( spectra, axis=-1, where=inzlp, dtype='float64' )
+        else:
+            i_zlp = np.sum( spectra[:, indmin:indmax], axis=-1, dtype='float64' )
+
+        valid = (i_zlp > 0) & (i_total > 0)
+        t = np.full( i_total.shape, np.nan )
+        t[valid] = np.log( i_total[valid]/i_zlp[valid] )
+        tlambda[rows] = np.reshape( t, (-1, nx) )
+
+    if mask_threshold is None:
+        return tlambda
+    mask = np.nan_to_num( tlambda, nan=0.0 ) > mask_threshold
+    return tlambda, mask
+
+def splice_dual( si_ll, si_hl, energy_ll, energy_hl, exposure_ratio=1, align=True, out=None, chunk_mb=64 ):
+    """
+    Splice the low-loss and high-loss halves of a dual EELS SI (as returned by specload_dual)
+    into one cube, block by block. Both halves of a pixel are shifted by the sub-channel offset
+    of its low-loss ZLP from 0 eV, and the high-loss half is divided by the exposure ratio.
+    Where the halves overlap, the high-loss data is kept. Intensity shifted past either end
+    of a half is dropped instead of wrapping around, and the vacated channels are zero.
+
+    Inputs:
+    si_ll, si_hl - (ny,nx,ne_ll) low-loss and (ny,nx,ne_hl) high-loss SIs
+    energy_ll, energy_hl - their energy axes, with the same dispersion
+    exposure_ratio - exposure time of the high loss over the low loss, see EELS_util.dual_exposure_ratio
+    align - if True, align the ZLP of every pixel to 0 eV
+    out - optional (ny,nx,ne) output array, e.g. a memmap, see splice_dual_axis for its size
+
+    Outputs:
+    si - (ny,nx,ne) spliced SI
+    energy - its energy axis
+    """
+    (ny, nx, ne_ll) = si_ll.shape
+    ne_hl = si_hl.shape[-1]
+    energy, offset, frac = splice_dual_axis( energy_ll, energy_hl, ne_hl )
+    dispersion = energy[1]-energy[0]
+    ne = len( energy )
+    if out is None:
+        out = np.zeros( (ny, nx, ne), dtype='float32' )
+
+    # Take equally many rows of both SIs per block
+    chunk_mb = chunk_mb*ne_ll/(ne_ll+ne_hl+ne)
+    for rows, chunk in iter_chunks( si_ll, chunk_mb ):
+        spectra_ll = chunk.astype( 'float64' )
+        spectra_hl = np.nan_to_num( np.asarray( si_hl[rows] ) ).astype( 'float64' )/exposure_ratio
+
+        if align:
+            shifts_ind = zlp_shifts( spectra_ll, energy_ll, reference=0 )/dispersion
+        else:
+            shifts_ind = np.zeros( spectra_ll.shape[:2] )
+
+        block = np.zeros( spectra_ll.shape[:2] + (ne,) )
+        block[..., :ne_ll] = shift_spectra_padded( spectra_ll, shifts_ind )
+        block[..., offset:offset+ne_hl] = shift_spectra_padded( spectra_hl, shifts_ind+frac )
+        out[rows] = block
+    return out, energy
+
+def shift_spectra_padded( spectra, shifts_ind ):
+    # shift_spectra on zero padded spectra, cropped back; channels whose source lies outside the axis are zero
+    ne = spectra.shape[-1]
+    pad = int( np.ceil( np.max( np.abs( shifts_ind ), initial=0 ) ) ) + 1
+    widths = [(0,0)]*(spectra.ndim-1) + [(pad,pad)]
+    shifted = shift_spectra( np.pad( spectra, widths ), shifts_ind )[..., pad:pad+ne]
+    source = np.arange( ne ) - np.asarray( shifts_ind )[...,None]
+    shifted[(source < 0) | (source > ne-1)] = 0
+    return shifted
+
+def splice_dual_axis( energy_ll, energy_hl, ne_hl=None ):
+    # Energy axis of a spliced dual EELS SI, the channel offset of the high-loss half and its sub-channel remainder
+    dispersion = energy_ll[1]-energy_ll[0]
+    if not np.isclose( dispersion, energy_hl[1]-energy_hl[0] ):
+        raise ValueError( "Low-loss and high-loss SIs need the same dispersion" )
+    if ne_hl is None:
+        ne_hl = len( energy_hl )
+
+    start = (energy_hl[0]-energy_ll[0])/dispersion
+    offset = int( np.round( start ) )
+    if offset < 0:
+        raise ValueError( "High-loss SI starts below the low-loss SI" )
+    ne = max( len(energy_ll), offset+ne_hl )
+    energy = EnergyAxis( energy_ll[0], dispersion, ne ).values.copy()
+    return energy, offset, start-offset
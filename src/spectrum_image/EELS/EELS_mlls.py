@@ -0,0 +1,73 @@
+import hashlib
+import numpy as np
+import numpy.linalg as LA
+
+from spectrum_image.EELS.EELS_chunks import iter_chunks
+from spectrum_image.EELS.EELS_axis import searchsorted
+from spectrum_image.EELS.EELS_bgsub import nnls_batch
+
+# Pseudo-inverses of recently used bases, keyed by the basis contents
+pinv_cache = {}
+
+def cached_pinv( X ):
+    key = (X.shape, hashlib.sha1( np.ascontiguousarray( X ).tobytes() ).hexdigest())
+    if key not in pinv_cache:
+        if len( pinv_cache ) > 32:
+            pinv_cache.clear()
+        pinv_cache[key] = LA.pinv( X )
+    return pinv_cache[key]
+
+def powerlaw_basis( energy, rs ):
+    # (len(rs), ne) power law background basis functions energy**(-r)
+    energy = np.asarray( energy, dtype='float64' )
+    return np.stack( [energy**(-r) for r in rs] )
+
+def mlls_fit( si, energy, references, e_fit=None, background=None, nonneg=False, chunk_mb=64 ):
+    """
+    Multiple linear least squares (MLLS) fit of reference spectra to every pixel of an SI.
+    All pixels of a row block are solved at once; the unconstrained solution uses a cached
+    pseudo-inverse of the basis, the non-negative one a batched NNLS (bgsub.nnls_batch).
+
+    Inputs:
+    si - (ny,nx,ne) spectrum image
+    energy - energy axis of si
+    references - (K, ne) reference spectra on energy, e.g. Fe2+ and Fe3+ L-edges
+    e_fit - (emin, emax) fit window in eV, default is the full axis
+    background - optional background basis appended after the references: a (B, ne) array,
+                 or a list of power law exponents r giving energy**(-r)
+    nonneg - if True, constrain all coefficients to be non-negative
+
+    Outputs:
+    coefs - (ny,nx,K+B) coefficient maps, references first
+    residual - (ny,nx) RMS residual of the fit in the window
+    """
+    (ny, nx, ne) = si.shape
+    basis = np.atleast_2d( np.asarray( references, dtype='float64' ) )
+    if background is not None:
+        background = np.asarray( background, dtype='float64' )
+        if background.ndim == 1:
+            background = powerlaw_basis( energy, background )
+        basis = np.append( basis, background, axis=0 )
+
+    if e_fit is None:
+        indmin, indmax = 0, ne
+    else:
+        indmin, indmax = searchsorted( energy, e_fit )
+    X = basis[:, indmin:indmax].T
+    nbasis = X.shape[1]
+
+    if not nonneg:
+        P = cached_pinv( X )
+
+    coefs = np.zeros( (ny, nx, nbasis) )
+    residual = np.zeros( (ny, nx) )
+    for rows, chunk in iter_chunks( si, chunk_mb ):
+        Y = np.reshape( chunk[..., indmin:indmax], (-1, indmax-indmin) ).T.astype( 'float64' )
+        if nonneg:
+            b = nnls_batch( Y, X )
+        else:
+            b = P @ Y
+        coefs[rows] = np.reshape( b.T, (-1, nx, nbasis) )
+        residual[rows] = np.reshape( np.sqrt( np.mean( (X @ b - Y)**2, axis=0 ) ), (-1, nx) )
+
+    return coefs, residual
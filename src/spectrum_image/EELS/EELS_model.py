@@ -0,0 +1,141 @@
+import numpy as np
+
+import spectrum_image.EELS.EELS_lineshapes as ls
+import spectrum_image.EELS.EELS_bgsub as bg
+from spectrum_image.EELS.EELS_axis import searchsorted
+from spectrum_image.EELS.EELS_chunks import iter_chunks
+from spectrum_image.EELS.EELS_fit import levenberg_marquardt
+
+
+class CompositeModel :
+    def __init__( self, components ):
+        """
+        Sum of EELS_lineshapes components fitted together, e.g. ['powerlaw', 'gaussian', 'gaussian']
+        for a background and two peaks in one pass. Parameters are named '<component index>_<name>',
+        e.g. 'c0_r', 'c1_e0', and can be fixed or linked before fitting.
+        """
+        self.components = list( components )
+        self.names, self.slices = [], []
+        for i, shape in enumerate( self.components ):
+            pnames = ls.lineshapes[shape][1]
+            self.slices.append( slice( len(self.names), len(self.names)+len(pnames) ) )
+            self.names += [ 'c{}_{}'.format( i, n ) for n in pnames ]
+        self.fixed = {}
+        self.links = {}
+
+    def fix( self, name, value ):
+        # Keep parameter name at value
+        self.links.pop( name, None )
+        self.fixed[name] = float( value )
+
+    def link( self, name, target, scale=1, offset=0 ):
+        # Tie parameter name to scale*target + offset, e.g. equal widths or a fixed peak splitting
+        self.fixed.pop( name, None )
+        self.links[name] = (target, float( scale ), float( offset ))
+
+    def free_names( self ):
+        return [n for n in self.names if n not in self.fixed and n not in self.links]
+
+    def transform( self ):
+        # Full parameters p = T @ q + c from the free parameters q
+        free = self.free_names()
+        T = np.zeros( (len(self.names), len(free)) )
+        c = np.zeros( len(self.names) )
+        for j, n in enumerate( free ):
+            T[self.names.index( n ), j] = 1
+        for n, v in self.fixed.items():
+            c[self.names.index( n )] = v
+
+        pending = dict( self.links )
+        while pending:
+            resolved = [n for n, (t, s, o) in pending.items() if t not in pending]
+            if not resolved:
+                raise ValueError( "Circular parameter links: {}".format( list(pending) ) )
+            for n in resolved:
+                t, s, o = pending.pop( n )
+                i, k = self.names.index( n ), self.names.index( t )
+                T[i] = s*T[k]
+                c[i] = s*c[k] + o
+        return T, c
+
+    def value_and_jacobian( self, x, p, out=None, jac=None ):
+        # Model (m, ne) and Jacobian (nparam, m, ne) for full parameters p (m, nparam)
+        x = np.asarray( x, dtype='float64' )
+        p = np.atleast_2d( p )
+        if out is None:
+            out = np.zeros( (len(p), len(x)) )
+        if jac is None:
+            jac = np.empty( (len(self.names), len(p), len(x)) )
+        out[:] = 0
+        fi = np.empty_like( out )
+        for shape, sl in zip( self.components, self.slices ):
+            ls.value_and_jacobian( shape, x, p[:, sl], out=fi, jac=jac[sl] )
+            out += fi
+        return out, jac
+
+    def __call__( self, x, p ):
+        return self.value_and_jacobian( x, p )[0]
+
+    def fit( self, spectra, x, p0, max_iter=100 ):
+        """
+        Fit the model to spectra (m, ne) on x at once with the batched Levenberg-Marquardt solver.
+        p0 - (nparam,) or (m, nparam) full initial parameters; fixed and linked entries are ignored
+        Returns the full parameters (m, nparam) and the cost (m,).
+        """
+        T, c = self.transform()
+
+        def fun( q ):
+            f, J = self.value_and_jacobian( x, q @ T.T + c )
+            return f, np.einsum( 'kmi,kj->jmi', J, T )
+
+        free = [self.names.index( n ) for n in self.free_names()]
+        q0 = np.asarray( p0, dtype='float64' )[..., free]
+        q, cost = levenberg_marquardt( fun, q0, spectra, max_iter=max_iter )
+        return q @ T.T + c, cost
+
+    def fit_SI( self, si, energy, e_fit, p0, e_bsub=None, mask=None, max_iter=100, chunk_mb=64 ):
+        """
+        Fit the composite model to every pixel of an SI in one pass, block by block.
+
+        Inputs:
+        si - (ny,nx,ne) spectrum image
+        e_fit - (emin, emax) combined fit window of background and peaks
+        p0 - (nparam,) initial parameters in the order of names
+        e_bsub - optional pre-edge window; if the first component is 'powerlaw' its A and r are
+                 started per pixel from a log-log linear fit there
+        mask - optional (ny,nx) boolean mask, pixels outside are not fitted
+
+        Outputs:
+        params - dict of parameter name -> (ny,nx) map, plus 'cost'; NaN outside mask
+        """
+        (ny, nx, ne) = si.shape
+        indmin, indmax = searchsorted( energy, e_fit )
+        x = np.asarray( energy[indmin:indmax], dtype='float64' )
+        if mask is None:
+            mask = np.ones( (ny, nx), dtype=bool )
+        if e_bsub is not None:
+            bmin, bmax = searchsorted( energy, e_bsub )
+            e_log = np.stack( [np.ones( bmax-bmin ), np.log( np.asarray( energy[bmin:bmax], dtype='float64' ) )], axis=1 )
+
+        maps = np.full( (len(self.names)+1, ny*nx), np.nan )
+        for rows, chunk in iter_chunks( si, chunk_mb ):
+            sel = np.flatnonzero( mask[rows] )
+            if len( sel ) == 0:
+                continue
+            spectra = np.reshape( chunk, (-1, ne) )[sel].astype( 'float64' )
+
+            p_init = np.tile( np.asarray( p0, dtype='float64' ), (len(sel), 1) )
+            if e_bsub is not None and self.components[0] == 'powerlaw':
+                # log y = log A - r log E over the pre-edge window
+                with np.errstate( divide='ignore', invalid='ignore' ):
+                    b = bg.linear_regression_QR( np.log( spectra[:, bmin:bmax] ).T, e_log )
+                ok = np.all( np.isfinite( b ), axis=0 )
+                p_init[ok, 0], p_init[ok, 1] = np.exp( b[0, ok] ), -b[1, ok]
+
+            p, cost = self.fit( spectra[:, indmin:indmax], x, p_init, max_iter )
+            pix = rows.start*nx + sel
+            maps[:-1, pix] = p.T
+            maps[-1, pix] = cost
+
+        params = dict( zip( self.names + ['cost'], np.reshape( maps, (-1, ny, nx) ) ) )
+        return params
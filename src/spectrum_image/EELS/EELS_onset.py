@@ -0,0 +1,115 @@
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+
+from spectrum_image.EELS.EELS_axis import searchsorted
+from spectrum_image.EELS.EELS_chunks import iter_chunks
+from spectrum_image.EELS.EELS_edge import EELS_edge
+from spectrum_image.EELS.EELS_peaks import index_to_energy
+
+## Edge onsets, vectorized over the leading axes of spectra (..., ne)
+
+def first_crossing( y, level, start=None ):
+    """
+    Fractional channel index where y (..., ne) first rises to level (...) at or after
+    channel start (...), linearly interpolated. NaN where it never does.
+    """
+    ne = y.shape[-1]
+    ch = np.arange( ne )
+    above = y >= level[...,None]
+    if start is not None:
+        above &= ch >= start[...,None]
+    i1 = np.argmax( above, axis=-1 )
+    found = np.any( above, axis=-1 )
+
+    i0 = np.maximum( i1-1, 0 )[...,None]
+    y0 = np.take_along_axis( y, i0, axis=-1 )[...,0]
+    y1 = np.take_along_axis( y, i1[...,None], axis=-1 )[...,0]
+    t = np.divide( level-y0, y1-y0, out=np.zeros( y0.shape ), where=(y1!=y0) & (i1>0) )
+    return np.where( found, i0[...,0] + np.clip( t, 0, 1 ), np.nan )
+
+def edge_onset( spectra, x, method='derivative', sigma=2, level=0.5 ):
+    """
+    Onset energy of the strongest edge in spectra (..., ne) on x.
+
+    method - 'derivative': the derivative of the gaussian smoothed spectrum peaks at the edge;
+                           the onset is where it first reaches level*peak before the peak
+             'threshold': the rise above the running minimum (which follows a decaying
+                          background) first reaches level*its maximum
+    sigma - smoothing in channels, 0 for spectra that are already smooth
+    level - fraction of the peak derivative / total rise defining the onset; 1 gives the
+            inflection point for 'derivative'
+    """
+    spectra = np.asarray( spectra, dtype='float64' )
+    smooth = gaussian_filter1d( spectra, sigma, axis=-1, mode='nearest' ) if sigma else spectra
+    if method == 'derivative':
+        signal = np.gradient( smooth, axis=-1 )
+        peak = np.argmax( signal, axis=-1 )
+        # Walk back from the peak to the last channel below level
+        ch = np.arange( spectra.shape[-1] )
+        thresh = level*np.take_along_axis( signal, peak[...,None], axis=-1 )[...,0]
+        start = np.max( np.where( (signal < thresh[...,None]) & (ch < peak[...,None]), ch, 0 ), axis=-1 )
+    elif method == 'threshold':
+        signal = smooth - np.minimum.accumulate( smooth, axis=-1 )
+        thresh = level*np.max( signal, axis=-1 )
+        start = None
+    else:
+        raise ValueError( "method must be 'derivative' or 'threshold'" )
+
+    ind = first_crossing( signal, thresh, start )
+    ind = np.where( thresh > 0, ind, np.nan )
+    return index_to_energy( x, ind )
+
+def onset_map( si, energy, e_search, method='derivative', sigma=2, level=0.5, mask=None, chunk_mb=64 ):
+    """
+    edge_onset of every pixel within the search window e_search = (emin, emax), streamed
+    block by block. The window is padded by 4 sigma for the smoothing so the search bounds
+    do not create edges; sigma=0 skips the smoothing. Returns an (ny,nx) onset map, NaN outside mask.
+    """
+    (ny, nx, ne) = si.shape
+    emin, emax = searchsorted( energy, e_search )
+    pad = int( np.ceil( 4*sigma ) )
+    lo, hi = max( emin-pad, 0 ), min( emax+pad, ne )
+    x = np.asarray( energy[emin:emax], dtype='float64' )
+
+    onset = np.full( (ny, nx), np.nan )
+    for rows, chunk in iter_chunks( si[:,:,lo:hi], chunk_mb ):
+        # Smooth over the padded window, then search only inside e_search
+        smooth = chunk.astype( 'float64' )
+        if sigma:
+            smooth = gaussian_filter1d( smooth, sigma, axis=-1, mode='nearest' )
+        onset[rows] = edge_onset( smooth[..., emin-lo:emax-lo], x, method, 0, level )
+    if mask is not None:
+        onset[~np.asarray( mask, dtype=bool )] = np.nan
+    return onset
+
+def suggest_edge( energy, onset, label="", gap=2, bsub_width=30, int_width=30 ):
+    """
+    EELS_edge windows around an onset energy or onset map.
+    The background window ends gap eV below the earliest onsets (1st percentile), so chemical
+    shifts across the map stay outside of it; the integration window starts at the median onset.
+    Windows are clipped to the energy axis.
+    """
+    onset = np.asarray( onset, dtype='float64' )
+    onset = onset[np.isfinite( onset )]
+    if len( onset ) == 0:
+        raise ValueError( "No edge onset found" )
+    e_first, e_mid = np.percentile( onset, 1 ), np.median( onset )
+
+    emin, emax = energy[0], energy[-1]
+    clip = lambda e: float( np.clip( np.round( e, 4 ), emin, emax ) )
+    e_bsub = (clip( e_first-gap-bsub_width ), clip( e_first-gap ))
+    e_int = (clip( e_mid ), clip( e_mid+int_width ))
+    return EELS_edge( label, e_bsub, e_int )
+
+def detect_edge( si, energy, e_search, label="", method='derivative', sigma=2, level=0.5,
+                 gap=2, bsub_width=30, int_width=30, mask=None, chunk_mb=64 ):
+    """
+    Onset map of the edge within e_search and the EELS_edge suggested from it.
+
+    Outputs:
+    edge - EELS_edge with e_bsub and e_int, see suggest_edge
+    onset - (ny,nx) onset energies, see onset_map
+    """
+    onset = onset_map( si, energy, e_search, method, sigma, level, mask, chunk_mb )
+    edge = suggest_edge( energy, onset, label, gap, bsub_width, int_width )
+    return edge, onset
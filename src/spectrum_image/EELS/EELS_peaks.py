@@ -0,0 +1,132 @@
+import numpy as np
+
+from spectrum_image.EELS.EELS_axis import searchsorted
+from spectrum_image.EELS.EELS_chunks import iter_chunks
+
+## Model-free peak estimators, vectorized over the leading axes of spectra (..., ne).
+## Sub-channel positions are found in channel index space and mapped onto x,
+## so non-uniform energy axes are handled too.
+
+def index_to_energy( x, ind ):
+    # Energy at fractional channel index ind
+    return np.interp( ind, np.arange( len(x) ), np.asarray( x, dtype='float64' ), left=np.nan, right=np.nan )
+
+def peak_position( spectra, x, method='parabolic' ):
+    """
+    Peak position by three-point interpolation around the maximum channel.
+
+    Inputs:
+    spectra - (..., ne) spectra on x
+    method - 'parabolic': parabola through the three top channels
+             'gaussian': parabola through their logarithm, exact for a sampled gaussian
+
+    Outputs:
+    position - (...) peak energies
+    height - (...) interpolated peak heights
+    """
+    spectra = np.asarray( spectra, dtype='float64' )
+    ne = spectra.shape[-1]
+    ind = np.clip( np.argmax( spectra, axis=-1 ), 1, ne-2 )[...,None]
+    ym, y0, yp = [np.take_along_axis( spectra, ind+k, axis=-1 )[...,0] for k in (-1, 0, 1)]
+
+    if method == 'gaussian':
+        with np.errstate( divide='ignore', invalid='ignore' ):
+            lm, l0, lp = np.log( ym ), np.log( y0 ), np.log( yp )
+        ok = np.isfinite( lm ) & np.isfinite( l0 ) & np.isfinite( lp )
+        # Fall back to the parabola where a channel is not positive
+        ym, y0, yp = np.where( ok, lm, ym ), np.where( ok, l0, y0 ), np.where( ok, lp, yp )
+    elif method != 'parabolic':
+        raise ValueError( "method must be 'parabolic' or 'gaussian'" )
+
+    denom = ym - 2*y0 + yp
+    frac = np.divide( 0.5*(ym-yp), denom, out=np.zeros( denom.shape ), where=denom<0 )
+    frac = np.clip( frac, -0.5, 0.5 )
+    height = y0 - 0.25*(ym-yp)*frac
+    if method == 'gaussian':
+        height = np.where( ok, np.exp( height ), height )
+
+    return index_to_energy( x, ind[...,0] + frac ), height
+
+def remove_baseline( spectra, x ):
+    # Subtract the straight line through the first and last channel of every spectrum
+    x = np.asarray( x, dtype='float64' )
+    t = (x - x[0])/(x[-1] - x[0])
+    return spectra - (spectra[...,:1]*(1-t) + spectra[...,-1:]*t)
+
+def centroid( spectra, x, baseline=False ):
+    """
+    Intensity weighted mean energy of spectra (..., ne) on x.
+    baseline - subtract the straight line through the first and last channel first;
+               negative weights are clipped to zero
+    """
+    spectra = np.asarray( spectra, dtype='float64' )
+    x = np.asarray( x, dtype='float64' )
+    if baseline:
+        spectra = remove_baseline( spectra, x )
+    w = np.maximum( spectra, 0 )
+    total = np.sum( w, axis=-1 )
+    return np.divide( w @ x, total, out=np.full( total.shape, np.nan ), where=total>0 )
+
+def fwhm( spectra, x, baseline=0 ):
+    """
+    Full width at half maximum from the half-max crossings nearest to the maximum channel,
+    linearly interpolated between channels. NaN where a crossing lies outside the window.
+    baseline - scalar or (...) level the half maximum is measured from
+    """
+    spectra = np.asarray( spectra, dtype='float64' ) - np.asarray( baseline, dtype='float64' )[...,None]
+    ne = spectra.shape[-1]
+    ch = np.arange( ne )
+    peak = np.argmax( spectra, axis=-1 )[...,None]
+    half = 0.5*np.take_along_axis( spectra, peak, axis=-1 )
+    below = spectra < half
+
+    # Last channel below half max before the peak, first one after it
+    il = np.max( np.where( below & (ch < peak), ch, -1 ), axis=-1 )
+    ir = np.min( np.where( below & (ch > peak), ch, ne ), axis=-1 )
+    okl, okr = il >= 0, ir < ne
+    il, ir = np.clip( il, 0, ne-2 )[...,None], np.clip( ir, 1, ne-1 )[...,None]
+
+    def crossing( i0, i1 ):
+        y0 = np.take_along_axis( spectra, i0, axis=-1 )
+        y1 = np.take_along_axis( spectra, i1, axis=-1 )
+        t = np.divide( half-y0, y1-y0, out=np.zeros( y0.shape ), where=y1!=y0 )
+        return (i0 + t*(i1-i0))[...,0]
+
+    left = index_to_energy( x, crossing( il, il+1 ) )
+    right = index_to_energy( x, crossing( ir-1, ir ) )
+    return np.where( okl & okr, right-left, np.nan )
+
+def peak_maps( si, energy, e_window, method='parabolic', baseline=False, mask=None, chunk_mb=64 ):
+    """
+    Peak position, height, centroid and FWHM of every pixel within e_window, streamed
+    block by block so memmapped SIs only read the window channels of one block at a time.
+
+    Inputs:
+    si - (ny,nx,ne) spectrum image
+    e_window - (emin, emax) window around the feature
+    method - 'parabolic' or 'gaussian' three-point interpolation, see peak_position
+    baseline - remove the linear baseline through the window ends before centroid and FWHM
+    mask - optional (ny,nx) boolean mask, NaN outside
+
+    Outputs:
+    maps - dict of 'position', 'height', 'centroid', 'fwhm' -> (ny,nx) arrays
+    """
+    (ny, nx, ne) = si.shape
+    emin, emax = searchsorted( energy, e_window )
+    x = np.asarray( energy[emin:emax], dtype='float64' )
+
+    names = ['position', 'height', 'centroid', 'fwhm']
+    maps = {name: np.full( (ny, nx), np.nan ) for name in names}
+    for rows, chunk in iter_chunks( si[:,:,emin:emax], chunk_mb ):
+        chunk = chunk.astype( 'float64' )
+        corrected = remove_baseline( chunk, x ) if baseline else chunk
+        values = dict( zip( names[:2], peak_position( chunk, x, method ) ) )
+        values['centroid'] = centroid( corrected, x )
+        values['fwhm'] = fwhm( corrected, x )
+        for name in names:
+            maps[name][rows] = values[name]
+
+    if mask is not None:
+        for name in names:
+            maps[name][~np.asarray( mask, dtype=bool )] = np.nan
+    return maps
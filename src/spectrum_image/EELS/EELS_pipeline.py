@@ -0,0 +1,211 @@
+import os
+import csv
+import json
+import time
+import argparse
+import numpy as np
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import spectrum_image.EELS.EELS_util as util
+import spectrum_image.EELS.EELS_bgsub as bg
+from spectrum_image.EELS.EELS_edge import EELS_edge
+from spectrum_image.EELS.EELS_axis import searchsorted
+from spectrum_image.EELS.EELS_onset import detect_edge
+
+
+class options_pipeline:
+
+    def __init__(self, edges=None, fit_options=None, preprocess=None, outdir='.',
+                       nproc=1, mask_threshold=None, save_si=False, auto_edges=None, onset_options=None):
+        """
+        **kwargs:
+        edges - list of EELS_edge, or KEM lists ['label',bsub_start,bsub_end,int_start,int_end]
+        fit_options - eels_bgsub.options_bgsub object, or dict of its keyword arguments
+        preprocess - list of steps applied in order before fitting, each a name or (name, kwargs).
+                     Available steps: 'remove_outlier', 'align_zlp', 'pca'
+        outdir - output directory for maps, parameters and the timing report
+        nproc - number of worker processes
+        mask_threshold - threshold passed to bgsub_SI, excludes vacuum from LC fitting
+        save_si - if True, also save the background subtracted SI of every edge
+        auto_edges - list of ['label',search_start,search_end]; the windows of these edges are set per
+                     file from the onset map detected in the search range (EELS_onset.detect_edge)
+        onset_options - dict of detect_edge keyword arguments, e.g. method, sigma, gap, bsub_width, int_width
+        """
+        self.edges = []
+        for edge in ([] if edges is None else edges):
+            if not isinstance( edge, EELS_edge ):
+                edge_KEM = edge
+                edge = EELS_edge()
+                edge.from_KEM( edge_KEM )
+            self.edges.append( edge )
+
+        if fit_options is None:
+            fit_options = bg.options_bgsub()
+        elif isinstance( fit_options, dict ):
+            fit_options = bg.options_bgsub( **fit_options )
+        self.fit_options = fit_options
+
+        self.preprocess = []
+        for step in ([] if preprocess is None else preprocess):
+            if isinstance( step, str ):
+                step = (step, {})
+            name, kwargs = step
+            if name not in preprocess_steps:
+                raise ValueError( "Unknown preprocessing step '{}', choose from {}".format( name, list(preprocess_steps) ) )
+            self.preprocess.append( (name, dict(kwargs)) )
+
+        self.outdir = outdir
+        self.nproc = nproc
+        self.mask_threshold = mask_threshold
+        self.save_si = save_si
+        self.auto_edges = [(label, (emin, emax)) for label, emin, emax in ([] if auto_edges is None else auto_edges)]
+        self.onset_options = {} if onset_options is None else dict( onset_options )
+
+    @classmethod
+    def from_json( cls, file ):
+        # Read options from a JSON config with the same keys as the constructor
+        with open( file ) as f:
+            return cls( **json.load( f ) )
+
+
+######## Preprocessing steps
+def step_remove_outlier( si, energy, **kwargs ):
+    return util.remove_outlier( si, show=False, **kwargs ), energy
+
+def step_align_zlp( si, energy, reference=None ):
+    shifts = util.zlp_shifts( si, energy, reference=reference )
+    return util.shift_SI( si, energy, shifts )
+
+def step_pca( si, energy, n_components=10 ):
+    return util.PCA_filter( si, n_components )[0], energy
+
+preprocess_steps = {'remove_outlier': step_remove_outlier,
+                    'align_zlp': step_align_zlp,
+                    'pca': step_pca}
+
+
+######## Pipeline
+def load_file( file ):
+    t0 = time.perf_counter()
+    si, energy, pxscale, disp, params = util.specload( file, show=False )
+    si = np.asarray( si )
+    return si, energy, time.perf_counter()-t0
+
+def process_si( si, energy, options, stem ):
+    """
+    Preprocess one SI and background subtract every edge, writing results to options.outdir:
+    <stem>_<label>_map.npy - background subtracted intensity integrated over edge.e_int
+    <stem>_<label>_params.npy - (2, ny, nx) background fit parameters, not written for sampled
+                                LC fits (lc_sample), which have no per-pixel parameters
+    <stem>_<label>_si.npy - background subtracted SI, if options.save_si
+    <stem>_<label>_onset.npy - (ny, nx) onset map of every auto edge
+    Returns a dict of timings in seconds.
+    """
+    timing = {}
+    t0 = time.perf_counter()
+    for name, kwargs in options.preprocess:
+        si, energy = preprocess_steps[name]( si, energy, **kwargs )
+    timing['preprocess'] = time.perf_counter()-t0
+
+    t0 = time.perf_counter()
+    edges = list( options.edges )
+    for label, e_search in options.auto_edges:
+        edge, onset = detect_edge( si, energy, e_search, label, **options.onset_options )
+        np.save( os.path.join( options.outdir, "{}_{}_onset.npy".format( stem, label.replace(' ','_') ) ), onset )
+        edges.append( edge )
+    timing['onset'] = time.perf_counter()-t0
+
+    t0 = time.perf_counter()
+    for edge in edges:
+        result = bg.bgsub_SI( si, energy, edge, fit_options=options.fit_options,
+                             threshold=options.mask_threshold, return_params=True )
+        si_bsub, fit_params = result[-2], result[-1]
+
+        indmin, indmax = searchsorted( energy, edge.e_int )
+        if indmin == indmax:
+            indmax += 1
+
+        prefix = os.path.join( options.outdir, "{}_{}".format( stem, edge.label.replace(' ','_') ) )
+        np.save( prefix+'_map.npy', np.sum( si_bsub[...,indmin:indmax], axis=-1 ) )
+        if fit_params is not None:
+            np.save( prefix+'_params.npy', fit_params )
+        if options.save_si:
+            np.save( prefix+'_si.npy', si_bsub )
+    timing['fit'] = time.perf_counter()-t0
+    return timing
+
+def run_worker( files, options ):
+    # Process files in order while the next file is read in a background thread
+    report = []
+    if len( files ) == 0:
+        return report
+
+    with ThreadPoolExecutor( max_workers=1 ) as io:
+        future = io.submit( load_file, files[0] )
+        for i, file in enumerate( files ):
+            t0 = time.perf_counter()
+            si, energy, t_load = future.result()
+            t_wait = time.perf_counter()-t0
+            if i+1 < len( files ):
+                future = io.submit( load_file, files[i+1] )
+
+            stem = os.path.splitext( os.path.basename( file ) )[0]
+            timing = process_si( si, energy, options, stem )
+            timing = {'file': file, 'pid': os.getpid(), 'load': t_load, 'wait': t_wait, **timing}
+            timing['total'] = t_wait + timing['preprocess'] + timing['onset'] + timing['fit']
+            report.append( timing )
+    return report
+
+def run_pipeline( files, options ):
+    """
+    Background subtract a list of SI files with the same settings, without the browser.
+    Files are loaded with specload and spread over options.nproc processes; each process
+    prefetches its next file while fitting the current one.
+
+    Inputs:
+    files - list of file paths readable by hyperspy
+    options - options_pipeline object
+
+    Outputs:
+    report - list of per-file timing dicts, also written to <outdir>/timing.csv
+    """
+    os.makedirs( options.outdir, exist_ok=True )
+    nproc = max( 1, min( options.nproc, len(files) ) )
+
+    if nproc == 1:
+        reports = [run_worker( list(files), options )]
+    else:
+        groups = [list( files[i::nproc] ) for i in range(nproc)]
+        with ProcessPoolExecutor( max_workers=nproc ) as pool:
+            reports = list( pool.map( run_worker, groups, repeat(options) ) )
+
+    report = sorted( [r for rep in reports for r in rep], key=lambda r: list(files).index( r['file'] ) )
+
+    fields = ['file', 'pid', 'load', 'wait', 'preprocess', 'onset', 'fit', 'total']
+    with open( os.path.join( options.outdir, 'timing.csv' ), 'w', newline='' ) as f:
+        writer = csv.DictWriter( f, fieldnames=fields )
+        writer.writeheader()
+        writer.writerows( report )
+    return report
+
+def main( argv=None ):
+    parser = argparse.ArgumentParser( description="Headless background subtraction of many spectrum images" )
+    parser.add_argument( 'config', help="JSON file with options_pipeline keyword arguments" )
+    parser.add_argument( 'files', nargs='+', help="SI files readable by hyperspy" )
+    parser.add_argument( '-o', '--outdir', default=None, help="output directory, overrides the config" )
+    parser.add_argument( '-n', '--nproc', type=int, default=None, help="number of processes, overrides the config" )
+    args = parser.parse_args( argv )
+
+    options = options_pipeline.from_json( args.config )
+    if args.outdir is not None:
+        options.outdir = args.outdir
+    if args.nproc is not None:
+        options.nproc = args.nproc
+
+    report = run_pipeline( args.files, options )
+    for r in report:
+        print( "{file}: load {load:.2f}s, preprocess {preprocess:.2f}s, fit {fit:.2f}s".format( **r ) )
+
+if __name__ == '__main__':
+    main()
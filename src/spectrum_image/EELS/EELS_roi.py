@@ -0,0 +1,143 @@
+import numpy as np
+from scipy import sparse
+
+from spectrum_image.EELS.EELS_chunks import iter_chunks, nan_to_zero
+
+roi_colors = ['crimson', 'royalblue', 'seagreen', 'darkorange', 'darkviolet',
+              'goldenrod', 'teal', 'saddlebrown', 'deeppink', 'slategray']
+
+
+def rect_mask( shape, xaxis, yaxis, extents ):
+    # Boolean (ny,nx) mask of a rectangular ROI, extents = (xmin, xmax, ymin, ymax) in axis units
+    xmin = np.searchsorted( xaxis, int( extents[0]))
+    xmax = np.searchsorted( xaxis, int( extents[1]))
+    ymin = np.searchsorted( yaxis, int( extents[2]))
+    ymax = np.searchsorted( yaxis, int( extents[3]))
+
+    if xmin == xmax:
+        xmax += 1
+    if ymin == ymax:
+        ymax +=1
+
+    mask = np.zeros( shape, dtype=bool )
+    mask[ymin:ymax,xmin:xmax] = True
+    return mask
+
+def roi_matrix( masks ):
+    """
+    Sparse averaging matrix of a set of ROIs.
+
+    Inputs:
+    masks - list of boolean (ny,nx) masks, or an integer label image (0 = unlabeled)
+
+    Outputs:
+    W - scipy.sparse csr matrix (nroi, ny*nx), row k holds 1/npix_k on the pixels of ROI k
+    """
+    if isinstance( masks, np.ndarray ) and masks.dtype.kind in 'iu':
+        labels = masks.ravel()
+        pix, = np.nonzero( labels )
+        rows = labels[pix] - 1
+        nroi = int( labels.max() )
+        npix = labels.size
+    else:
+        masks = [np.asarray( mask, dtype=bool ).ravel() for mask in masks]
+        nroi = len( masks )
+        npix = masks[0].size
+        pix = [np.flatnonzero( mask ) for mask in masks]
+        rows = np.repeat( np.arange( nroi ), [len(p) for p in pix] )
+        pix = np.concatenate( pix )
+
+    counts = np.bincount( rows, minlength=nroi ).astype( 'float64' )
+    weights = 1/counts[rows]
+    return sparse.csr_matrix( (weights, (rows, pix)), shape=(nroi, npix) )
+
+def roi_spectra( si, rois, chunk_mb=64 ):
+    """
+    Mean spectra of many ROIs in a single sparse product with the flattened SI.
+    The product is accumulated over row blocks, and blocks without any ROI pixel
+    are never read, so small ROIs on memmapped data stay cheap. NaNs count as zeros.
+
+    Inputs:
+    si - (ny,nx,ne) spectrum image
+    rois - list of boolean masks, an integer label image, or a matrix from roi_matrix
+
+    Outputs:
+    spectra - (nroi, ne) mean spectrum of each ROI
+    """
+    (ny,nx,ne) = si.shape
+    if sparse.issparse( rois ):
+        W = rois
+    else:
+        W = roi_matrix( rois )
+    W = sparse.csc_matrix( W )
+
+    # Skip row blocks that no ROI touches
+    rows_used, = np.nonzero( np.diff( W.indptr ).reshape( ny, nx ).any( axis=1 ) )
+    spectra = np.zeros( (W.shape[0], ne) )
+    if len( rows_used ) == 0:
+        return spectra
+
+    for rows, chunk in iter_chunks( si, chunk_mb, start=rows_used[0], stop=rows_used[-1]+1 ):
+        W_chunk = W[:, rows.start*nx:rows.stop*nx]
+        if W_chunk.nnz > 0:
+            spectra += W_chunk @ np.reshape( chunk, (-1, ne) )
+    return spectra
+
+def line_coordinates( p0, p1, width=1, step=1 ):
+    """
+    Coordinate map of a line profile with a perpendicular integration width.
+
+    Inputs:
+    p0, p1 - (x, y) start and end points in pixels
+    width - integration width perpendicular to the line in pixels
+    step - sampling step along the line in pixels
+
+    Outputs:
+    ys, xs - (nt, nw) sample coordinates, nt along the line and nw across it
+    t - (nt,) distance of each sample from p0 in pixels
+    """
+    p0 = np.asarray( p0, dtype='float64' )
+    p1 = np.asarray( p1, dtype='float64' )
+    length = np.hypot( *(p1-p0) )
+    if length == 0:
+        raise ValueError( "Line profile start and end points coincide" )
+    u = (p1-p0)/length            # along the line
+    v = np.array( [-u[1], u[0]] ) # across the line
+
+    t = np.arange( 0, length+step/2, step )
+    nw = max( 1, int( round( width ) ) )
+    w = np.arange( nw ) - (nw-1)/2
+
+    xs = p0[0] + t[:,None]*u[0] + w[None,:]*v[0]
+    ys = p0[1] + t[:,None]*u[1] + w[None,:]*v[1]
+    return ys, xs, t
+
+def interp_pixels( data, ys, xs ):
+    """
+    Bilinear interpolation of data (ny,nx,...) at fractional pixel positions ys, xs of shape (n,).
+    All trailing (energy) channels are interpolated at once; only the needed pixels are read,
+    and coordinates outside the image are clamped to the border.
+    """
+    (ny, nx) = data.shape[:2]
+    ys = np.clip( ys, 0, ny-1 )
+    xs = np.clip( xs, 0, nx-1 )
+    y0 = np.minimum( np.floor( ys ).astype( int ), ny-2 ) if ny > 1 else np.zeros( len(ys), dtype=int )
+    x0 = np.minimum( np.floor( xs ).astype( int ), nx-2 ) if nx > 1 else np.zeros( len(xs), dtype=int )
+    y1 = np.minimum( y0+1, ny-1 )
+    x1 = np.minimum( x0+1, nx-1 )
+    dy = (ys-y0).reshape( (-1,) + (1,)*(data.ndim-2) )
+    dx = (xs-x0).reshape( (-1,) + (1,)*(data.ndim-2) )
+
+    out  = nan_to_zero( np.asarray( data[y0,x0] ) )*((1-dy)*(1-dx))
+    out += nan_to_zero( np.asarray( data[y0,x1] ) )*((1-dy)*dx)
+    out += nan_to_zero( np.asarray( data[y1,x0] ) )*(dy*(1-dx))
+    out += nan_to_zero( np.asarray( data[y1,x1] ) )*(dy*dx)
+    return out
+
+def line_profile( data, p0, p1, width=1, step=1 ):
+    # Width-averaged profile of data (ny,nx,...) along p0 -> p1, returns (profile (nt,...), t)
+    ys, xs, t = line_coordinates( p0, p1, width, step )
+    profile = 0
+    for k in range( ys.shape[1] ):
+        profile = profile + interp_pixels( data, ys[:,k], xs[:,k] )
+    return profile/ys.shape[1], t
@@ -0,0 +1,81 @@
+import numpy as np
+
+from spectrum_image.EELS.EELS_chunks import iter_chunks
+
+
+class SIStats:
+    """
+    Summary statistics of a spectrum image, computed in one chunked pass on first use.
+
+    Attributes:
+    sum_spectrum - (ne,) spectrum summed over all pixels
+    sum_image - (ny,nx) per-pixel total counts
+    min_spectrum, max_spectrum - (ne,) per-channel extrema
+    min, max - global extrema
+    mean_spectrum, mean_image - sum_spectrum and sum_image normalized by pixel / channel count
+    NaNs count as zeros.
+    """
+    def __init__( self, si, chunk_mb=64 ):
+        self.si = si
+        self.chunk_mb = chunk_mb
+        self.valid = False
+
+    def compute( self ):
+        (ny, nx, ne) = self.si.shape
+        self._sum_spectrum = np.zeros( ne )
+        self._sum_image = np.zeros( (ny, nx) )
+        self._min_spectrum = np.full( ne, np.inf )
+        self._max_spectrum = np.full( ne, -np.inf )
+
+        for rows, chunk in iter_chunks( self.si, self.chunk_mb ):
+            self._sum_image[rows] = np.sum( chunk, axis=-1, dtype='float64' )
+            self._sum_spectrum += np.sum( chunk, axis=(0,1), dtype='float64' )
+            np.minimum( self._min_spectrum, chunk.min( axis=(0,1) ), out=self._min_spectrum )
+            np.maximum( self._max_spectrum, chunk.max( axis=(0,1) ), out=self._max_spectrum )
+
+        self.valid = True
+
+    def invalidate( self ):
+        # Call when the underlying data changes
+        self.valid = False
+
+    def _get( self, name ):
+        if not self.valid:
+            self.compute()
+        return getattr( self, name )
+
+    @property
+    def npix( self ):
+        return self.si.shape[0]*self.si.shape[1]
+
+    @property
+    def sum_spectrum( self ):
+        return self._get( '_sum_spectrum' )
+
+    @property
+    def sum_image( self ):
+        return self._get( '_sum_image' )
+
+    @property
+    def min_spectrum( self ):
+        return self._get( '_min_spectrum' )
+
+    @property
+    def max_spectrum( self ):
+        return self._get( '_max_spectrum' )
+
+    @property
+    def min( self ):
+        return self.min_spectrum.min()
+
+    @property
+    def max( self ):
+        return self.max_spectrum.max()
+
+    @property
+    def mean_spectrum( self ):
+        return self.sum_spectrum/self.npix
+
+    @property
+    def mean_image( self ):
+        return self.sum_image/self.si.shape[-1]
@@ -4,6 +4,8 @@ from scipy.optimize import curve_fit
 from scipy.ndimage import affine_transform
 from tqdm import tqdm, tqdm_notebook
 import spectrum_image.EELS.EELS_lineshapes as ls
+from spectrum_image.EELS.EELS_chunks import gather_pixels
+from spectrum_image.EELS.EELS_axis import EnergyAxis, searchsorted
 
 from sklearn.decomposition import PCA
 from tqdm import tqdm, tqdm_notebook
@@ -14,13 +16,15 @@ from lmfit.models import GaussianModel
 
 
 
-def remove_outlier( si, threshold_multiplier=5, remove_nn=True):
+def remove_outlier( si, threshold_multiplier=5, remove_nn=True, show=True):
     # remove outliers that are larger than threshold_multiplier*std + median of each spectrum
     # remove_nn also remove two nearest neighbor pixels
     # Outliers are replaced by medians
+    # show - plot the cleaned spectra
     (ny,nx,ne) = si.shape
     si_cleaned = si.copy()
-    fig, ax = plt.subplots(1)
+    if show:
+        fig, ax = plt.subplots(1)
     for i in range(ny):
         for j in range(nx):
             cur_spec = si_cleaned[i,j,:]
@@ -37,7 +41,8 @@ def remove_outlier( si, threshold_multiplier=5, remove_nn=True):
                     else:
                         cur_spec[ ind_outlier] = med
                 si_cleaned[i,j,:] = cur_spec
-                plt.plot(cur_spec)
+                if show:
+                    plt.plot(cur_spec)
     
     return si_cleaned
 
@@ -53,13 +58,11 @@ def specload(file, show=True):
     params=rawSI.axes_manager
     if show==True:
         print(params)
-    ch1=np.round(rawSI.axes_manager[2j].get_axis_dictionary()['offset'],4)
-    disp=np.round(rawSI.axes_manager[2j].get_axis_dictionary()['scale'],4)
-    rawSI.z=int(rawSI.axes_manager[2j].get_axis_dictionary()['size'])
-    energy= np.round(np.arange(ch1,ch1+rawSI.z*disp,disp),4)
+    axis = EnergyAxis.from_hyperspy( rawSI.axes_manager[2j] )
+    energy = axis.values.copy()
+    disp = axis.dispersion
+    rawSI.z = axis.size
     pxscale = rawSI.axes_manager[0].get_axis_dictionary()['scale']
-    if len(energy)!= rawSI.z:
-        energy = energy[:-1]
     return (rawSI.data, energy, pxscale, disp, params)
 
 def specload_dual(file, norm = False, type = "1"):
@@ -87,13 +90,11 @@ def specload_dual(file, norm = False, type = "1"):
         rawSI=hs.load(file)[0]
         params=rawSI.axes_manager
         print(params)
-        ch1=np.round(rawSI.axes_manager[2j].get_axis_dictionary()['offset'],4)
-        disp=np.round(rawSI.axes_manager[2j].get_axis_dictionary()['scale'],4)
-        rawSI.z=int(rawSI.axes_manager[2j].get_axis_dictionary()['size'])
-        energy= np.round(np.arange(ch1,ch1+rawSI.z*disp,disp),4)
+        axis = EnergyAxis.from_hyperspy( rawSI.axes_manager[2j] )
+        energy = axis.values.copy()
+        disp = axis.dispersion
+        rawSI.z = axis.size
         pxscale = rawSI.axes_manager[0].get_axis_dictionary()['scale']
-        if len(energy)!= rawSI.z:
-            energy = energy[:-1]
         if norm == True:
             rawSI.data = rawSI.data/sum(rawSI.data)
         energies.append(energy)
@@ -104,13 +105,11 @@ def specload_dual(file, norm = False, type = "1"):
         rawSI=hs.load(file)[1]
         params=rawSI.axes_manager
         print(params)
-        ch1=np.round(rawSI.axes_manager[2j].get_axis_dictionary()['offset'],4)
-        disp=np.round(rawSI.axes_manager[2j].get_axis_dictionary()['scale'],4)
-        rawSI.z=int(rawSI.axes_manager[2j].get_axis_dictionary()['size'])
-        energy= np.round(np.arange(ch1,ch1+rawSI.z*disp,disp),4)
+        axis = EnergyAxis.from_hyperspy( rawSI.axes_manager[2j] )
+        energy = axis.values.copy()
+        disp = axis.dispersion
+        rawSI.z = axis.size
         pxscale = rawSI.axes_manager[0].get_axis_dictionary()['scale']
-        if len(energy)!= rawSI.z:
-            energy = energy[:-1]
         if norm == True:
             rawSI.data = rawSI.data/sum(rawSI.data)
         energies.append(energy)
@@ -122,13 +121,11 @@ def specload_dual(file, norm = False, type = "1"):
         rawSI=hs.load(file)[2]
         params=rawSI.axes_manager
         print(params)
-        ch1=np.round(rawSI.axes_manager[2j].get_axis_dictionary()['offset'],4)
-        disp=np.round(rawSI.axes_manager[2j].get_axis_dictionary()['scale'],4)
-        rawSI.z=int(rawSI.axes_manager[2j].get_axis_dictionary()['size'])
-        energy= np.round(np.arange(ch1,ch1+rawSI.z*disp,disp),4)
+        axis = EnergyAxis.from_hyperspy( rawSI.axes_manager[2j] )
+        energy = axis.values.copy()
+        disp = axis.dispersion
+        rawSI.z = axis.size
         pxscale = rawSI.axes_manager[0].get_axis_dictionary()['scale']
-        if len(energy)!= rawSI.z:
-            energy = energy[:-1]
         if norm == True:
             rawSI.data = rawSI.data/sum(rawSI.data)
         energies.append(energy)
@@ -139,13 +136,11 @@ def specload_dual(file, norm = False, type = "1"):
         rawSI=hs.load(file)[3]
         params=rawSI.axes_manager
         print(params)
-        ch1=np.round(rawSI.axes_manager[2j].get_axis_dictionary()['offset'],4)
-        disp=np.round(rawSI.axes_manager[2j].get_axis_dictionary()['scale'],4)
-        rawSI.z=int(rawSI.axes_manager[2j].get_axis_dictionary()['size'])
-        energy= np.round(np.arange(ch1,ch1+rawSI.z*disp,disp),4)
+        axis = EnergyAxis.from_hyperspy( rawSI.axes_manager[2j] )
+        energy = axis.values.copy()
+        disp = axis.dispersion
+        rawSI.z = axis.size
         pxscale = rawSI.axes_manager[0].get_axis_dictionary()['scale']
-        if len(energy)!= rawSI.z:
-            energy = energy[:-1]
         if norm == True:
             rawSI.data = rawSI.data/sum(rawSI.data)
         energies.append(energy)
@@ -154,16 +149,34 @@ def specload_dual(file, norm = False, type = "1"):
 
     return(energies, spectra, pxscale, disp, paramses)
 
+def get_exposure(hs_si):
+    # Exposure time (s) of a hyperspy EELS signal loaded from a DM file
+    try:
+        return float( hs_si.metadata.Acquisition_instrument.TEM.Detector.EELS.exposure )
+    except AttributeError:
+        pass
+    try:
+        return float( hs_si.original_metadata.ImageList.TagGroup0.ImageTags.EELS.Acquisition['Exposure_(s)'] )
+    except (AttributeError, KeyError):
+        raise ValueError( "No exposure time found in the metadata of {}".format( hs_si.metadata.General.title ) )
+
+def dual_exposure_ratio(file, type = "1"):
+    """
+    Exposure ratio (high loss / low loss) of a dual EELS file, read from metadata only.
+    type - same convention as specload_dual
+    """
+    raw = hs.load(file, lazy=True)
+    ind_ll, ind_hl = {'1': (0, 1), '2': (2, 3)}[type]
+    return get_exposure( raw[ind_hl] )/get_exposure( raw[ind_ll] )
+
 def get_hyperspy_data(hs_si):
     params=hs_si.axes_manager
     print(params)
-    ch1=np.round(hs_si.axes_manager[2j].get_axis_dictionary()['offset'],4)
-    disp=np.round(hs_si.axes_manager[2j].get_axis_dictionary()['scale'],4)
-    hs_si.z=int(hs_si.axes_manager[2j].get_axis_dictionary()['size'])
-    energy= np.round(np.arange(ch1,ch1+hs_si.z*disp,disp),4)
+    axis = EnergyAxis.from_hyperspy( hs_si.axes_manager[2j] )
+    energy = axis.values.copy()
+    disp = axis.dispersion
+    hs_si.z = axis.size
     pxscale = hs_si.axes_manager[0].get_axis_dictionary()['scale']
-    if len(energy)!= hs_si.z:
-        energy = energy[:-1]
     return(energy, hs_si.data, pxscale, disp, params)
 
 def shear_y_SI( si, ADF=None, angle=0 ):
@@ -220,7 +233,9 @@ def shear_y_img( img, angle=0 ):
     img_shear =affine_transform(img, shear_matrix_ADF, order=1)
     return img_shear
 
-def fit_feature_si( si, eaxis, model, e_bound, params=None ):
+def fit_feature_si( si, eaxis, model, e_bound, params=None, mask=None ):
+    # Fit an lmfit model to every pixel in the e_bound window, returns (ny,nx) array of ModelResult
+    # mask - optional (ny,nx) boolean mask; pixels outside it are not fitted and stay None
 
     if len(np.shape(si)) == 2:
         tempx,tempz = np.shape(si)
@@ -231,12 +246,16 @@ def fit_feature_si( si, eaxis, model, e_bound, params=None ):
 
     (ny,nx,nz) = np.shape(si)
 
-    emin,emax = np.searchsorted( eaxis, e_bound)
+    emin,emax = searchsorted( eaxis, e_bound)
+
+    if mask is None:
+        mask = np.ones( (ny,nx), dtype=bool )
+    iy, ix = np.nonzero( mask )
 
-    si_sub = si[:,:, emin:emax]
+    si_sub = gather_pixels( si[:,:, emin:emax], mask )
     es_sub = eaxis[emin:emax]
 
-    si_mean = np.mean( si_sub, axis=(0,1))
+    si_mean = np.mean( si_sub, axis=0)
     if params is None:
         params = model.guess( data=si_mean, x=es_sub)#,center=es_sub[np.argmax(si_mean)])
         result = model.fit( si_mean, params=params, x=es_sub)
@@ -244,44 +263,69 @@ def fit_feature_si( si, eaxis, model, e_bound, params=None ):
 
     results = np.empty( (ny,nx),dtype=object )
 
-    pbar = tqdm_notebook(total = (nx)*(ny),desc = "Fitting Features")
-    for i in range(ny):
-        for j in range(nx):
-            cur_data = si_sub[i,j,:]
-            results[i,j] = model.fit( cur_data, params = params, x=es_sub,
-                                     method='least_squares')
+    pbar = tqdm_notebook(total = len(iy),desc = "Fitting Features")
+    for k in range(len(iy)):
+        cur_data = si_sub[k,:]
+        results[iy[k],ix[k]] = model.fit( cur_data, params = params, x=es_sub,
+                                          method='least_squares')
 
-            pbar.update(1)
+        pbar.update(1)
     pbar.close()
 
     return results
     
 
-def shift_SI( si, es, shifts ):
+def zlp_shifts( si, es, reference=None ):
+    # Shifts (eV) that move the zero-loss peak of every pixel onto reference
+    # Peak = per-pixel maximum refined by a parabola through the three top channels
+    # reference defaults to the median peak position, usable directly as shift_SI( si, es, shifts )
+    (ny, nx, ne) = si.shape
+    dispersion = es[1]-es[0]
+
+    ind = np.clip( np.argmax( si, axis=-1 ), 1, ne-2 )
+    ym = np.take_along_axis( si, ind[:,:,None]-1, axis=-1 )[:,:,0]
+    y0 = np.take_along_axis( si, ind[:,:,None],   axis=-1 )[:,:,0]
+    yp = np.take_along_axis( si, ind[:,:,None]+1, axis=-1 )[:,:,0]
+    denom = ym - 2*y0 + yp
+    frac = np.divide( 0.5*(ym-yp), denom, out=np.zeros(denom.shape), where=denom!=0 )
+
+    zlp = es[0] + (ind + np.clip( frac, -0.5, 0.5 ))*dispersion
+    if reference is None:
+        reference = np.median( zlp )
+    return reference - zlp
+
+def shift_spectra( spectra, shifts_ind ):
+    # Fourier shift every spectrum along the last axis by shifts_ind channels (sub-channel), batched
+    ne = spectra.shape[-1]
+    ke = 2*np.pi*np.fft.fftfreq( ne )
+    phase = np.exp( -1j*ke*np.asarray( shifts_ind )[...,None] )
+    return np.real( np.fft.ifft( np.fft.fft( spectra, axis=-1 )*phase, axis=-1 ) )
+
+def shift_SI( si, es, shifts, mask=None ):
+    # mask - optional (ny,nx) boolean mask; only those pixels are shifted and set the crop
     (ny, nx, ne) = si.shape
     si_shifted = si.copy()
 
     dispersion = es[1]-es[0]
     shifts_ind = shifts/dispersion
 
-    ke = ( np.arange( ne ) - ne/2 )*(2*np.pi/ne)
-
-
-    pbar = tqdm_notebook(total = (nx)*(ny),desc = "Shifting Zeroloss Peak")
-    for i in range(ny):
-        for j in range(nx):
-            cur_spec = si[i,j]
-            cur_shift = shifts_ind[i,j]
-
-            spec_fft = np.fft.fftshift( np.fft.fft(cur_spec) )
-            result = spec_fft*np.exp( -1j*ke*cur_shift )
-            spec_shifted = np.real( np.fft.ifft( np.fft.ifftshift( result) ) )
-
-
+    if mask is None:
+        pbar = tqdm_notebook(total = (nx)*(ny),desc = "Shifting Zeroloss Peak")
+        for i in range(ny):
             # spec_shifted = shift(cur_spec, cur_shift, order=1, mode='constant', cval=0.0, prefilter=False)
-            si_shifted[i,j] = spec_shifted
-            pbar.update(1)
-    pbar.close()
+            si_shifted[i] = shift_spectra( si[i], shifts_ind[i] )
+            pbar.update(nx)
+        pbar.close()
+    else:
+        mask = np.asarray( mask, dtype=bool )
+        iy, ix = np.nonzero( mask )
+        shifts_ind = shifts_ind[mask]
+        pbar = tqdm_notebook(total = len(iy),desc = "Shifting Zeroloss Peak")
+        for k in range( 0, len(iy), nx ):
+            batch = slice( k, k+nx )
+            si_shifted[iy[batch], ix[batch]] = shift_spectra( si[iy[batch], ix[batch]], shifts_ind[batch] )
+            pbar.update( len(iy[batch]) )
+        pbar.close()
 
     min_shift = int( np.floor( np.min( shifts_ind )) )
     max_shift = int( np.ceil( np.max( shifts_ind )) )
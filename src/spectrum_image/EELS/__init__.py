@@ -13,4 +13,17 @@ from spectrum_image.EELS.EELS_SI import SpectrumImage
 from spectrum_image.EELS.EELS_LP import LineProfile
 import spectrum_image.EELS.EELS_bgsub as bg
 import spectrum_image.EELS.EELS_edge as EELS_edge
+import spectrum_image.EELS.EELS_roi as EELS_roi
+from spectrum_image.EELS.EELS_stats import SIStats
+from spectrum_image.EELS.EELS_axis import EnergyAxis
+import spectrum_image.EELS.EELS_pipeline as EELS_pipeline
+import spectrum_image.EELS.EELS_deconv as EELS_deconv
+import spectrum_image.EELS.EELS_lowloss as EELS_lowloss
+import spectrum_image.EELS.EELS_cluster as EELS_cluster
+import spectrum_image.EELS.EELS_mlls as EELS_mlls
 
+import spectrum_image.EELS.EELS_binning as EELS_binning
+import spectrum_image.EELS.EELS_fit as EELS_fit
+import spectrum_image.EELS.EELS_model as EELS_model
+import spectrum_image.EELS.EELS_peaks as EELS_peaks
+import spectrum_image.EELS.EELS_onset as EELS_onset
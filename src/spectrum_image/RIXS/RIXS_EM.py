@@ -1,42 +1,251 @@
+import hashlib
 import numpy as np
+from scipy import sparse
 import matplotlib.pyplot as plt
 from matplotlib.widgets import RangeSlider, RectangleSelector, SpanSelector, CheckButtons, RadioButtons, Button, TextBox
 from matplotlib.backend_bases import MouseButton
 
+from spectrum_image.EELS.EELS_roi import roi_colors
+from spectrum_image.EELS.EELS_axis import EnergyAxis, searchsorted
+from spectrum_image.EELS.EELS_util import zlp_shifts, shift_spectra
+from spectrum_image.EELS.EELS_fit import fit_peaks, peak_model_values
+
+
+def sort_index( axis ):
+    # Index that sorts axis; a slice (view) when it is already monotonic
+    if isinstance( axis, EnergyAxis ):
+        return slice( None ) if axis.dispersion >= 0 else slice( None, None, -1 )
+    axis = np.asarray( axis )
+    d = np.diff( axis )
+    if np.all( d >= 0 ):
+        return slice( None )
+    if np.all( d <= 0 ):
+        return slice( None, None, -1 )
+    return np.argsort( axis )
+
+
+def uniform_axis( axis ):
+    # EnergyAxis of axis if it is uniformly spaced, otherwise None
+    # Only used for its dispersion; maps keep the caller's axis values
+    if isinstance( axis, EnergyAxis ):
+        return axis
+    try:
+        return EnergyAxis.from_array( axis )
+    except ValueError:
+        return None
+
+# Interpolation matrices of recently used axis pairs, keyed by both axes
+regrid_cache = {}
+
+def regrid_matrix( axis, grid ):
+    """
+    Sparse (len(grid), len(axis)) linear interpolation matrix from the sorted, possibly
+    irregular axis onto grid. Cached, so maps sharing axes reuse the weights.
+    """
+    axis = np.asarray( axis, dtype='float64' )
+    grid = np.asarray( grid, dtype='float64' )
+    key = tuple( hashlib.sha1( a.tobytes() ).hexdigest() for a in (axis, grid) )
+    if key not in regrid_cache:
+        if len( regrid_cache ) > 32:
+            regrid_cache.clear()
+        n = len( axis )
+        hi = np.clip( np.searchsorted( axis, grid ), 1, n-1 )
+        lo = hi-1
+        dx = axis[hi]-axis[lo]
+        t = np.divide( grid-axis[lo], dx, out=np.zeros_like(grid), where=dx>0 )
+        t = np.clip( t, 0, 1 )
+        rows = np.repeat( np.arange( len(grid) ), 2 )
+        cols = np.stack( [lo, hi], axis=1 ).ravel()
+        vals = np.stack( [1-t, t], axis=1 ).ravel()
+        regrid_cache[key] = sparse.csr_matrix( (vals, (rows, cols)), shape=(len(grid), n) )
+    return regrid_cache[key]
+
+def regular_grid( axis, grid=True ):
+    # Uniform axis for regridding axis: True = same range with the median step, int = number of points,
+    # or a target EnergyAxis / uniform array
+    if isinstance( grid, EnergyAxis ):
+        return grid
+    axis = np.asarray( axis, dtype='float64' )
+    if grid is True:
+        step = np.median( np.diff( axis ) )
+        n = int( np.round( (axis[-1]-axis[0])/step ) ) + 1
+    elif isinstance( grid, (int, np.integer) ):
+        n = int( grid )
+    else:
+        # Uniform target arrays are used as given; from_array only checks the spacing
+        EnergyAxis.from_array( grid )
+        return np.asarray( grid, dtype='float64' )
+    return EnergyAxis( axis[0], (axis[-1]-axis[0])/max( n-1, 1 ), n )
+
+
+def elastic_shifts( spectra, eloss, window=None, method='peak', reference=0 ):
+    """
+    Shifts (eV) that move the elastic line of every spectrum onto reference, all at once.
+
+    Inputs:
+    spectra - (nspec, neloss) spectra on the uniform axis eloss
+    window - optional (emin, emax) energy-loss range that contains the elastic line
+    method - 'peak': maximum refined by a parabola through the three top channels
+             'xcorr': FFT cross-correlation with the mean spectrum, refined the same way,
+                      robust for broad or structured lines; the zero is the median peak position
+    """
+    spectra = np.nan_to_num( np.asarray( spectra, dtype='float64' ) )
+    if window is not None:
+        indmin, indmax = searchsorted( eloss, window )
+        spectra, eloss = spectra[:, indmin:indmax], eloss[indmin:indmax]
+
+    if method == 'peak':
+        return zlp_shifts( spectra[None], eloss, reference=reference )[0]
+    elif method == 'xcorr':
+        ne = spectra.shape[-1]
+        template = np.mean( spectra, axis=0 )
+        xc = np.fft.irfft( np.fft.rfft( spectra, 2*ne, axis=-1 )*np.conj( np.fft.rfft( template, 2*ne ) ), 2*ne, axis=-1 )
+        # Lags -ne+1..ne-1 in order, with the peak refined like zlp_shifts
+        xc = np.roll( xc, ne-1, axis=-1 )[:, :2*ne-1]
+        lags = EnergyAxis( -(ne-1)*(eloss[1]-eloss[0]), eloss[1]-eloss[0], 2*ne-1, decimals=12 )
+        lag = -zlp_shifts( xc[None], lags, reference=0 )[0]
+        # Zero of the template: median over spectra of peak position minus lag
+        template_shift = np.median( zlp_shifts( spectra[None], eloss, reference=reference )[0] + lag )
+        return template_shift - lag
+    raise ValueError( "method must be 'peak' or 'xcorr'" )
+
 
 class EnergyMap :
     def __init__( self, si, einc=None, eloss=None):
-
-        si[np.isnan(si)] = 0
+        # si is kept by reference when both axes are monotonic, NaNs are zeroed when reduced
         self.si = si
         (self.neloss,  self.neinc) = self.si.shape
 
 
         if eloss is None:
-            eloss = np.arange( self.neloss )
+            eloss = EnergyAxis( 0, 1, self.neloss )
         if einc is None:
-            einc = np.arange( self.neinc )
-
-        self.eloss = eloss
-        self.einc = einc
+            einc = EnergyAxis( 0, 1, self.neinc )
+
+        ind_eloss = sort_index( eloss )
+        ind_einc  = sort_index( einc )
+
+        # EnergyAxis stays an EnergyAxis, arrays are sorted copies
+        self.eloss = (eloss if isinstance( eloss, EnergyAxis ) else np.asarray( eloss ))[ind_eloss]
+        self.einc = (einc if isinstance( einc, EnergyAxis ) else np.asarray( einc ))[ind_einc]
+
+        self.ind_eloss, self.ind_einc = ind_eloss, ind_einc
+        self.si = self.sorted_map( self.si )
+
+    def regrid( self, einc=True, eloss=False ):
+        """
+        EnergyMap interpolated (linearly) onto uniform axes, with cached weights.
+        einc, eloss - False keeps the axis, True uses the same range with the median step,
+                      an int sets the number of points, or a target EnergyAxis / uniform array
+        """
+        si = np.nan_to_num( self.si )
+        new_einc, new_eloss = self.einc, self.eloss
+        if einc is not False:
+            new_einc = regular_grid( self.einc, einc )
+            si = (regrid_matrix( self.einc, new_einc ) @ si.T).T
+        if eloss is not False:
+            new_eloss = regular_grid( self.eloss, eloss )
+            si = regrid_matrix( self.eloss, new_eloss ) @ si
+        return EnergyMap( si, new_einc, new_eloss )
+
+    def sorted_map( self, si ):
+        # si (neloss,neinc) reordered like the axes, a view when both axes were monotonic
+        if isinstance( self.ind_eloss, slice ) or isinstance( self.ind_einc, slice ):
+            return si[self.ind_eloss, self.ind_einc]
+        return si[np.ix_( self.ind_eloss, self.ind_einc )]
+
+    def set_map( self, si ):
+        """
+        Replace the map by si, with the same (unsorted) axes as the original map.
+        An open browser is redrawn with the current ROIs.
+        """
+        self.si = self.sorted_map( si )
+        if hasattr( self, 'fig' ):
+            self.si_finite = np.nan_to_num( self.si )
+            self.prefix_sums()
+            self.im_inel = self.si
+            self.h['inel'].set_array( self.im_inel )
+            self.on_change_roi( list(range(len(self.roi_masks))) )
+            self.fig.canvas.draw_idle()
+
+    def align_elastic( self, window=None, method='peak', reference=0 ):
+        """
+        Align the elastic line of every incident-energy column to reference (default zero loss).
+        All columns are located at once with elastic_shifts and moved by a batched FFT
+        sub-channel shift; the energy-loss axis must be uniform (see regrid).
+        Spectra are zero padded for the shift, so intensity moved past either end of the axis
+        is dropped instead of wrapping around, and the vacated channels are zero.
+
+        Outputs:
+        aligned - aligned EnergyMap on the same axes
+        shifts - (neinc,) applied shifts in eV
+        """
+        uniform = uniform_axis( self.eloss )
+        if uniform is None:
+            raise ValueError( "Energy-loss axis is not uniform, regrid( einc=False, eloss=True ) first" )
+        spectra = np.nan_to_num( self.si ).T
+        shifts = elastic_shifts( spectra, self.eloss, window, method, reference )
+        shifts_ind = shifts/uniform.dispersion
+        ne = spectra.shape[-1]
+        pad = int( np.ceil( np.max( np.abs( shifts_ind ), initial=0 ) ) ) + 1
+        aligned = shift_spectra( np.pad( spectra, ((0,0), (pad,pad)) ), shifts_ind )[:, pad:pad+ne]
+        # Channels whose source lies outside the axis
+        source = np.arange( ne ) - shifts_ind[:,None]
+        aligned[(source < 0) | (source > ne-1)] = 0
+        aligned = aligned.T
+        return EnergyMap( aligned, self.einc, self.eloss ), shifts
+
+    def fit_peaks( self, peaks, p0, background='linear', window=None, axis='einc', seed=None, block=32, free=None ):
+        """
+        Fit elastic, phonon, d-d or charge-transfer features of every column (axis='einc': spectra
+        along energy loss, one per incident energy) or row (axis='eloss') at once with the batched
+        solver of EELS_fit.fit_peaks, warm starting each block of spectra from its neighbour.
+
+        Inputs:
+        peaks - list of peak lineshapes, see EELS_fit.peak_model, e.g. ['gaussian', 'voigt']
+        p0 - initial parameters of the peaks in order (e.g. A, e0, sg), optionally followed by background terms
+        background - None, 'constant' or 'linear'
+        window - optional (emin, emax) fit range along the spectra
+        seed - index of the first spectrum, default the most intense one
+
+        Outputs:
+        params - dict of parameter name -> array along the other axis (e.g. 'p0_e0' vs einc), plus 'cost'
+        fit - EnergyMap of the fitted model over the window
+        """
+        if axis == 'einc':
+            spectra, x = self.si.T, self.eloss
+        elif axis == 'eloss':
+            spectra, x = self.si, self.einc
+        else:
+            raise ValueError( "axis must be 'einc' or 'eloss'" )
 
-        ind_eloss = np.argsort( self.eloss )
-        ind_einc  = np.argsort( self.einc )
+        if window is not None:
+            indmin, indmax = searchsorted( x, window )
+            spectra, x = spectra[:, indmin:indmax], x[indmin:indmax]
 
-        self.eloss = self.eloss[ind_eloss]
-        self.einc = self.einc[ind_einc]
+        values, cost, names = fit_peaks( spectra, x, peaks, p0, background, seed, block, free )
+        params = dict( zip( names, values.T ) )
+        params['cost'] = cost
 
-        self.si = self.si[ind_eloss,:]
-        self.si = self.si[:,ind_einc]
+        model = peak_model_values( x, peaks, values, background )
+        if axis == 'einc':
+            return params, EnergyMap( model.T, self.einc, x )
+        return params, EnergyMap( model, x, self.eloss )
 
-    def browser( self, cmap='gray', figsize=(6,8), vmin=None, vmax=None):
+    def browser( self, cmap='gray', figsize=(6,8), vmin=None, vmax=None, rois=None):
+        # rois - optional list of boolean (neloss,neinc) masks added as extra ROIs
         
         self.int_dir = 0
         self.eaxis  = [self.einc, self.eloss]
         self.elabel = ["Incident Energy (eV)", "Energy Loss (eV)"]
         ## Initialize browser object
-        self.spec1 = np.mean(self.si,axis=self.int_dir)
-        self.spec2 = np.mean(self.si,axis=self.int_dir)
+        # NaN-free copy used for ROI reductions
+        self.si_finite = np.nan_to_num( self.si )
+        self.prefix_sums()
+        # ROI 0 follows the left button, ROI 1.. are right button rectangles or masks
+        self.roi_masks = [None, None]
+        self.specs = np.mean(self.si_finite,axis=self.int_dir)[np.newaxis].repeat( 2, axis=0 )
+        self.active_roi = 1
 
         self.im_inel = self.si
 
@@ -49,11 +258,20 @@ class EnergyMap :
         self.ax['spec']=self.fig.add_axes([0.1,0.05,0.8,0.4]) # Spectrum
         self.ax['ck_ysetting'] = self.fig.add_axes([0.7,0.45,0.3,0.07]) # Y-lock chkbox
         self.ax['ck_roisetting'] = self.fig.add_axes([0.7,0.94,0.3,0.07]) # ROI2 chkbox
+        self.ax['btn_roi'] = self.fig.add_axes([0.55,0.955,0.12,0.04]) # Add ROI Button
 
         ## Initialize plot handles
         self.h = {}
         ################## ax['inel'] ######################
-        self.h['inel'] = self.ax['inel'].pcolormesh( self.einc, self.eloss, self.im_inel,cmap = cmap, vmin=vmin, vmax=vmax)
+        einc, eloss = uniform_axis( self.einc ), uniform_axis( self.eloss )
+        if einc is not None and eloss is not None:
+            # Uniform axes: image rendering, pixel centers on the axis values
+            de, dl = einc.dispersion/2, eloss.dispersion/2
+            extent = (self.einc[0]-de, self.einc[-1]+de, self.eloss[0]-dl, self.eloss[-1]+dl)
+            self.h['inel'] = self.ax['inel'].imshow( self.im_inel, cmap=cmap, vmin=vmin, vmax=vmax, extent=extent,
+                                                     origin='lower', aspect='auto', interpolation='nearest')
+        else:
+            self.h['inel'] = self.ax['inel'].pcolormesh( self.einc, self.eloss, self.im_inel,cmap = cmap, vmin=vmin, vmax=vmax)
         self.ax['inel'].set_axis_on()
         self.ax['inel'].set_title('RIXS Energy Map')
         self.ax['inel'].set_ylabel('Energy Loss (eV)')
@@ -63,9 +281,11 @@ class EnergyMap :
         # self.ax['inel'].autoscale(enable=True, axis='xy', tight=True)
 
         ################## ax['spec'] ######################
-        self.h['spec1'], = self.ax['spec'].plot(self.eaxis[self.int_dir], self.spec1,color='crimson')
-        self.h['spec2'], = self.ax['spec'].plot(self.eaxis[self.int_dir], self.spec2,color='royalblue')
-        self.h['spec2'].set_alpha(0)
+        self.h['spec'] = []
+        for k in range(2):
+            h_spec, = self.ax['spec'].plot(self.eaxis[self.int_dir], self.specs[k],color=roi_colors[k])
+            self.h['spec'].append( h_spec )
+        self.h['spec'][1].set_alpha(0)
         # self.ax['spec'].set_yticks([])
         self.ax['spec'].set_xlabel(self.elabel[self.int_dir])
         self.ax['spec'].set_ylabel('Intensity')
@@ -82,28 +302,27 @@ class EnergyMap :
         self.y_log = False
 
 
-        self.ui['ck_roisetting'] = CheckButtons(ax=self.ax['ck_roisetting'], labels= ["Enable ROI 2", "Integrate E-loss"],
+        self.ui['ck_roisetting'] = CheckButtons(ax=self.ax['ck_roisetting'], labels= ["Enable ROIs", "Integrate E-loss"],
                                         actives=[False, False], check_props={'facecolor': 'k'} )
         self.ui['ck_roisetting'].on_clicked( lambda v: self.onclick_ck_roisetting() )
         self.roi2_enabled = False
 
+        self.ui['btn_roi']=Button(self.ax['btn_roi'],"Add ROI",useblit=True,)
+        self.ui['btn_roi'].on_clicked( lambda v: self.add_roi() )
+
 
         ################### Selectors ###################
-        self.ui['roi1'] = RectangleSelector(self.ax['inel'], self.dummy, button=[1],
-                                        useblit=True ,minspanx=1, minspany=1,spancoords='pixels',
-                                        interactive=True,props=dict(facecolor='crimson',edgecolor='crimson',alpha=0.2,fill=True),
-                                        handle_props=dict(markersize=2,markerfacecolor='white'))#,ignore_event_outlpde=True
-        
-        self.ui['roi2'] = RectangleSelector(self.ax['inel'], self.dummy, button=[3],
-                                        useblit=True ,minspanx=1, minspany=1,spancoords='pixels',
-                                        interactive=True,props=dict(facecolor='royalblue',edgecolor='royalblue',alpha=0.2,fill=True),
-                                        handle_props=dict(markersize=2,markerfacecolor='white'))#,ignore_event_outlpde=True)   
-        self.ui['roi2'].set_visible( False )
-        self.ui['roi2'].set_active( False )
+        self.ui['rois'] = [ self.roi_selector( 0, button=1 ), self.roi_selector( 1, button=3 ) ]
+        self.ui['rois'][1].set_visible( False )
+        self.ui['rois'][1].set_active( False )
             
 
         self.fig.canvas.mpl_connect( 'motion_notify_event', 
                                     lambda event: self.onclick_figure(event))
+
+        if rois is not None:
+            for mask in rois:
+                self.add_roi( mask )
         
 
         # self.rescale_yrange()
@@ -117,17 +336,72 @@ class EnergyMap :
         self.y_log = self.ui['ck_ysetting'].get_status()[1]
         self.rescale_yrange()
     
+    ################### ROI Management ###################
+    def roi_selector( self, k, button ):
+        color = roi_colors[ k % len(roi_colors) ]
+        return RectangleSelector(self.ax['inel'], self.dummy, button=[button],
+                                        useblit=True ,minspanx=1, minspany=1,spancoords='pixels',
+                                        interactive=True,props=dict(facecolor=color,edgecolor=color,alpha=0.2,fill=True),
+                                        handle_props=dict(markersize=2,markerfacecolor='white'))#,ignore_event_outlpde=True
+
+    def add_roi( self, mask=None ):
+        """
+        Add a region of interest to the browser.
+        mask - boolean (neloss,neinc) array. If None, a new rectangle is bound to the right mouse button.
+        """
+        k = len( self.roi_masks )
+        color = roi_colors[ k % len(roi_colors) ]
+
+        if mask is None:
+            self.ui['rois'][self.active_roi].set_active( False )
+            self.ui['rois'].append( self.roi_selector( k, button=3 ) )
+            self.active_roi = k
+        else:
+            mask = np.asarray( mask, dtype=bool )
+            self.ui['rois'].append( self.ax['inel'].contour( self.einc, self.eloss, mask,
+                                                            levels=[0.5], colors=[color] ) )
+        self.roi_masks.append( mask )
+
+        self.specs = np.append( self.specs, self.specs[:1], axis=0 )
+        h_spec, = self.ax['spec'].plot(self.eaxis[self.int_dir], self.specs[k],color=color)
+        self.h['spec'].append( h_spec )
+
+        if self.roi2_enabled:
+            self.update_rois_visible()
+        else:
+            self.ui['ck_roisetting'].set_active(0)
+        self.on_change_roi( list(range(1,len(self.roi_masks))) )
+
+    def update_rois_visible( self ):
+        for k in range(1, len(self.roi_masks)):
+            self.ui['rois'][k].set_visible( self.roi2_enabled )
+            self.h['spec'][k].set_alpha( float(self.roi2_enabled) )
+        self.ui['rois'][self.active_roi].set_active( self.roi2_enabled )
+
+    def prefix_sums( self ):
+        # Cumulative sums along both axes with a leading zero, so a band of rows or
+        # columns sums to a difference of two rows: O(n) spectra for any ROI size
+        self.cumsum = [np.zeros( (self.neloss+1, self.neinc) ), np.zeros( (self.neloss, self.neinc+1) )]
+        np.cumsum( self.si_finite, axis=0, out=self.cumsum[0][1:] )
+        np.cumsum( self.si_finite, axis=1, out=self.cumsum[1][:,1:] )
+
+    def roi_range( self, k ):
+        # Index range of rectangle ROI k along the integrated axis
+        roi = self.ui['rois'][k].extents
+        if self.int_dir == 0:
+            indmin = searchsorted( self.eloss, float(roi[2]))
+            indmax = searchsorted( self.eloss, float(roi[3]))
+        else:
+            indmin = searchsorted( self.einc,  float(roi[0]))
+            indmax = searchsorted( self.einc,  float(roi[1]))
+        if indmin == indmax:
+            indmax += 1
+        return indmin, min( indmax, self.si.shape[self.int_dir] )
+
     def onclick_ck_roisetting(self):
         # Check for ROI2 
         self.roi2_enabled = self.ui['ck_roisetting'].get_status()[0]
-        if self.roi2_enabled:
-            self.h['spec2'].set_alpha(1)
-            self.ui['roi2'].set_visible( True )
-            self.ui['roi2'].set_active( True )
-        else:
-            self.h['spec2'].set_alpha(0)
-            self.ui['roi2'].set_visible( False )
-            self.ui['roi2'].set_active( False )
+        self.update_rois_visible()
 
 
         # Check for integration flip
@@ -141,68 +415,60 @@ class EnergyMap :
             self.ax['spec'].set_xlabel('Incident Energy (eV)')
 
         self.int_dir = int(self.ui['ck_roisetting'].get_status()[1])
-        self.on_change_roi1()
-        # self.on_change_roi2()
-
-
-    def on_change_roi1(self):
-        roi1 = self.ui['roi1'].extents
-        roi2 = self.ui['roi2'].extents
-        if self.int_dir == 0:
-            self.ui['roi2'].extents = (roi1[0],roi1[1],roi2[2],roi2[3])
-        else:
-            self.ui['roi2'].extents = (roi2[0],roi2[1],roi1[2],roi1[3])
-
-        eimin = np.searchsorted( self.einc,  float(roi1[0]))
-        eimax = np.searchsorted( self.einc,  float(roi1[1]))
-        elmin = np.searchsorted( self.eloss, float(roi1[2]))
-        elmax = np.searchsorted( self.eloss, float(roi1[3]))
-
-        if eimin == eimax:
-            eimax += 1
-        if elmin == elmax:
-            elmax += 1
-
-
-        if self.int_dir == 0:
-            self.spec1  = np.mean(self.si[elmin:elmax,:],axis=(0))
-            eminmax = (self.einc[eimin], self.einc[eimax])
-        else:
-            self.spec1 = np.mean(self.si[:,eimin:eimax],axis=(1))
-            eminmax = (self.eloss[elmin], self.eloss[elmax])
-        
-        self.ax['spec'].set_xlim( eminmax )
-        self.h['spec1'].set_data( self.eaxis[self.int_dir], self.spec1)
+        self.on_change_roi( list(range(len(self.roi_masks))) )
 
 
+    def on_change_roi(self, rois):
+        # Rectangles share the extent of ROI 0 along the plotted axis
+        roi1 = self.ui['rois'][0].extents
+        for k in range(1, len(self.roi_masks)):
+            if self.roi_masks[k] is None:
+                roik = self.ui['rois'][k].extents
+                if self.int_dir == 0:
+                    self.ui['rois'][k].extents = (roi1[0],roi1[1],roik[2],roik[3])
+                else:
+                    self.ui['rois'][k].extents = (roik[0],roik[1],roi1[2],roi1[3])
 
-        self.rescale_yrange()
-
-    def on_change_roi2(self):
-        roi1 = self.ui['roi1'].extents
-        roi2 = self.ui['roi2'].extents
-
-        if self.int_dir == 0:
-            self.ui['roi2'].extents = (roi1[0],roi1[1],roi2[2],roi2[3])
-        else:
-            self.ui['roi2'].extents = (roi2[0],roi2[1],roi1[2],roi1[3])
-
-        eimin = np.searchsorted( self.einc,  float(roi2[0]))
-        eimax = np.searchsorted( self.einc,  float(roi2[1]))
-        elmin = np.searchsorted( self.eloss, float(roi2[2]))
-        elmax = np.searchsorted( self.eloss, float(roi2[3]))
-        if eimin == eimax:
-            eimax += 1
-        if elmin == elmax:
-            elmax += 1
-
-        if self.int_dir == 0:
-            self.spec2  = np.mean(self.si[elmin:elmax,:],axis=(0))
-        else:
-            self.spec2 = np.mean(self.si[:,eimin:eimax],axis=(1))
-        
+        if 0 in rois:
+            eimin = searchsorted( self.einc,  float(roi1[0]))
+            eimax = searchsorted( self.einc,  float(roi1[1]))
+            elmin = searchsorted( self.eloss, float(roi1[2]))
+            elmax = searchsorted( self.eloss, float(roi1[3]))
+            if eimin == eimax:
+                eimax += 1
+            if elmin == elmax:
+                elmax += 1
 
-        self.h['spec2'].set_data( self.eaxis[self.int_dir], self.spec2)
+            if self.int_dir == 0:
+                eminmax = (self.einc[eimin], self.einc[min(eimax,self.neinc-1)])
+            else:
+                eminmax = (self.eloss[elmin], self.eloss[min(elmax,self.neloss-1)])
+            self.ax['spec'].set_xlim( eminmax )
+
+        nspec = self.si.shape[1-self.int_dir]
+        if self.specs.shape[1] != nspec:
+            self.specs = np.zeros( (len(self.roi_masks), nspec) )
+
+        # Rectangles from the prefix sums, mask ROIs in one batched contraction
+        cumsum = self.cumsum[self.int_dir]
+        for k in [k for k in rois if self.roi_masks[k] is None]:
+            indmin, indmax = self.roi_range( k )
+            if self.int_dir == 0:
+                self.specs[k] = (cumsum[indmax] - cumsum[indmin])/max( indmax-indmin, 1 )
+            else:
+                self.specs[k] = (cumsum[:,indmax] - cumsum[:,indmin])/max( indmax-indmin, 1 )
+
+        mask_rois = [k for k in rois if self.roi_masks[k] is not None]
+        if mask_rois:
+            masks = np.stack( [self.roi_masks[k] for k in mask_rois] )
+            counts = np.sum( masks, axis=1+self.int_dir )
+            if self.int_dir == 0:
+                sums = np.einsum( 'kij,ij->kj', masks, self.si_finite )
+            else:
+                sums = np.einsum( 'kij,ij->ki', masks, self.si_finite )
+            self.specs[mask_rois] = np.divide( sums, counts, out=np.zeros_like(sums), where=counts>0 )
+        for k in rois:
+            self.h['spec'][k].set_data( self.eaxis[self.int_dir], self.specs[k])
 
         self.rescale_yrange()
     
@@ -219,54 +485,17 @@ class EnergyMap :
 
         if self.y_locked == False:
 
-            roi1 = self.ui['roi1'].extents
-            eimin = np.searchsorted( self.einc,  int(roi1[0]))
-            eimax = np.searchsorted( self.einc,  int(roi1[1]))
-            elmin = np.searchsorted( self.eloss, int(roi1[2]))
-            elmax = np.searchsorted( self.eloss, int(roi1[3]))
-            if eimin == eimax:
-                eimax += 1
-            if elmin == elmax:
-                elmax += 1
-
+            if self.roi2_enabled:
+                specs = self.specs
+            else:
+                specs = self.specs[:1]
 
             if not self.y_log:
-                if self.int_dir == 1:
-                    maxval =  1.02*self.spec1.max()
-                    minval =  0.98*self.spec1.min()
-                else:
-                    maxval =  1.02*self.spec1.max()
-                    minval =  0.98*self.spec1.min()
-
+                maxval =  1.02*specs.max()
+                minval =  0.98*specs.min()
             else:
-                if self.int_dir == 1:
-                    maxval =  1.1*self.spec1.max()
-                    minval =  0.9*self.spec1.min()
-                else:
-                    maxval =  1.1*self.spec1.max()
-                    minval =  0.9*self.spec1.min()
-
-
-
-            if self.roi2_enabled:
-                if not self.y_log:
-                    if self.int_dir == 1:
-                        maxval2 =  1.02*self.spec2.max()
-                        minval2 =  0.98*self.spec2.min()
-                    else:
-                        maxval2 =  1.02*self.spec2.max()
-                        minval2 =  0.98*self.spec2.min()
-
-                else:
-                    if self.int_dir == 1:
-                        maxval2 =  1.1*self.spec2.max()
-                        minval2 =  0.9*self.spec2.min()
-                    else:
-                        maxval2 =  1.1*self.spec2.max()
-                        minval2 =  0.9*self.spec2.min()
-
-                minval = min( minval, minval2)
-                maxval = max( maxval, maxval2)
+                maxval =  1.1*specs.max()
+                minval =  0.9*specs.min()
 
             # print( minval, maxval )
 
@@ -278,11 +507,11 @@ class EnergyMap :
         if event.inaxes in [self.ax['inel']]:
             if event.button == MouseButton.LEFT:
                 # Left Click on Inelastic Image
-                self.on_change_roi1()
+                self.on_change_roi( [0] )
             elif event.button == MouseButton.RIGHT:
                 if self.roi2_enabled:
                     # Right Click on Inelastic Image
-                    self.on_change_roi2()
+                    self.on_change_roi( [self.active_roi] )
 
         # elif event.inaxes in [self.ax['spec']]:
         #     if event.button == MouseButton.LEFT:
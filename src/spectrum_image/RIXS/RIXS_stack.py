@@ -0,0 +1,119 @@
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.widgets import Slider
+
+from spectrum_image.RIXS.RIXS_EM import EnergyMap
+from spectrum_image.EELS.EELS_chunks import chunked_mean
+
+
+class EnergyMapStack :
+    def __init__( self, data, einc=None, eloss=None, axes=None, names=None ):
+        """
+        Stack of RIXS energy maps over extra dimensions (sample position, temperature, q, ...).
+        data is kept by reference, so a memmap is only read where it is sliced or projected.
+
+        Inputs:
+        data - (*extra, neloss, neinc) array or memmap
+        einc, eloss - energy axes shared by all maps
+        axes - optional list of coordinate arrays, one per extra dimension
+        names - optional list of names of the extra dimensions
+        """
+        self.data = data
+        self.extra_shape = data.shape[:-2]
+        (self.neloss, self.neinc) = data.shape[-2:]
+        self.einc = einc
+        self.eloss = eloss
+
+        nextra = len( self.extra_shape )
+        if axes is None:
+            axes = [np.arange( n ) for n in self.extra_shape]
+        if names is None:
+            names = ['axis{}'.format( k ) for k in range( nextra )]
+        self.axes = [np.asarray( a ) for a in axes]
+        self.names = list( names )
+        self.projections = {}
+
+    @classmethod
+    def from_npy( cls, file, einc=None, eloss=None, axes=None, names=None ):
+        # Stack memory-mapped from a .npy file
+        return cls( np.load( file, mmap_mode='r' ), einc, eloss, axes, names )
+
+    @classmethod
+    def from_memmap( cls, file, shape, dtype='float32', einc=None, eloss=None, axes=None, names=None ):
+        # Stack memory-mapped from a raw binary file of the given (*extra, neloss, neinc) shape
+        return cls( np.memmap( file, dtype=dtype, mode='r', shape=tuple(shape) ), einc, eloss, axes, names )
+
+    def __len__( self ):
+        return self.extra_shape[0]
+
+    def __getitem__( self, index ):
+        """
+        Integer indices over all extra dimensions give the EnergyMap at that point,
+        anything else a sub-stack. Only index bookkeeping is done; data is read lazily.
+        """
+        if not isinstance( index, tuple ):
+            index = (index,)
+        if len( index ) == len( self.extra_shape ) and all( isinstance( i, (int, np.integer) ) for i in index ):
+            return EnergyMap( self.data[index], self.einc, self.eloss )
+
+        index = index + (slice(None),)*(len( self.extra_shape )-len( index ))
+        axes = [a[i] for a, i in zip( self.axes, index )]
+        keep = [np.ndim( a ) > 0 for a in axes]
+        return EnergyMapStack( self.data[index], self.einc, self.eloss,
+                               [a for a, k in zip( axes, keep ) if k],
+                               [n for n, k in zip( self.names, keep ) if k] )
+
+    def axis_index( self, axis ):
+        # Data axis of an extra dimension name, 'eloss', 'einc' or an integer axis
+        if isinstance( axis, str ):
+            special = {'eloss': -2, 'einc': -1}
+            if axis in special:
+                return special[axis] % self.data.ndim
+            return self.names.index( axis )
+        return axis % self.data.ndim
+
+    def projection( self, axis, reduce='mean', chunk_mb=64 ):
+        """
+        Projection of the stack along one or more axes (names, 'eloss', 'einc' or integers),
+        streamed block by block and cached, so repeated requests are free. NaNs count as zeros.
+        reduce - 'mean' or 'sum'
+        """
+        axis = tuple( sorted( self.axis_index( a ) for a in np.atleast_1d( axis ) ) )
+        key = (axis, reduce)
+        if key not in self.projections:
+            proj = chunked_mean( self.data, axis, chunk_mb )
+            if reduce == 'sum':
+                proj = proj*np.prod( [self.data.shape[a] for a in axis] )
+            elif reduce != 'mean':
+                raise ValueError( "reduce must be 'mean' or 'sum'" )
+            self.projections[key] = proj
+        return self.projections[key]
+
+    def mean_map( self ):
+        # EnergyMap averaged over all extra dimensions
+        return EnergyMap( self.projection( list(range(len( self.extra_shape ))) ), self.einc, self.eloss )
+
+    def browser( self, cmap='gray', figsize=(6,8), vmin=None, vmax=None, rois=None ):
+        """
+        EnergyMap browser with one slider per extra dimension. Moving a slider reads only
+        the selected map and keeps the ROIs. Returns the EnergyMap being browsed.
+        """
+        nextra = len( self.extra_shape )
+        self.index = [0]*nextra
+        self.current = self[tuple(self.index)]
+        self.current.browser( cmap=cmap, figsize=figsize, vmin=vmin, vmax=vmax, rois=rois )
+
+        fig = self.current.fig
+        self.current.ax['spec'].set_position( [0.1, 0.05+0.04*nextra, 0.8, 0.4-0.04*nextra] )
+        self.ui = {'sliders': []}
+        for k in range( nextra ):
+            ax = fig.add_axes( [0.2, 0.01+0.04*k, 0.6, 0.03] )
+            slider = Slider( ax, self.names[k], 0, self.extra_shape[k]-1, valinit=0, valstep=1 )
+            slider.on_changed( lambda v, k=k: self.on_change_index( k, int(v) ) )
+            self.ui['sliders'].append( slider )
+        return self.current
+
+    def on_change_index( self, k, i ):
+        self.index[k] = i
+        self.ui['sliders'][k].valtext.set_text( '{}'.format( self.axes[k][i] ) )
+        self.current.set_map( self.data[tuple(self.index)] )
@@ -14,4 +14,5 @@ from tqdm import tqdm, tqdm_notebook
 # import spectrum_image.EELS.EELS_bgsub as bg
 # import spectrum_image.EELS.EELS_edge as EELS_edge
 
-from spectrum_image.RIXS.RIXS_EM import EnergyMap
\ No newline at end of file
+from spectrum_image.RIXS.RIXS_EM import EnergyMap
+from spectrum_image.RIXS.RIXS_stack import EnergyMapStack
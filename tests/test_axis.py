@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from spectrum_image.EELS.EELS_axis import EnergyAxis, searchsorted
+
+
+@pytest.mark.parametrize( 'offset, dispersion, size', [(-20.5, 0.25, 400), (283.7, 0.1, 1024),
+                                                       (0.0, 0.0333, 777), (531.3, 1.7, 5)] )
+def test_searchsorted_matches_numpy( offset, dispersion, size ):
+    axis = EnergyAxis( offset, dispersion, size )
+    values = np.asarray( axis )
+    rng = np.random.default_rng( size )
+    # Channel energies themselves, points between channels, ties at rounding precision and out of range
+    energy = np.concatenate( [values, values + 0.5*dispersion, values - 1e-5, values + 1e-5,
+                              rng.uniform( values[0] - 10, values[-1] + 10, 200 ),
+                              [values[0] - 1e6, values[-1] + 1e6]] )
+    for side in ('left', 'right'):
+        np.testing.assert_array_equal( axis.searchsorted( energy, side ), np.searchsorted( values, energy, side ) )
+        assert searchsorted( axis, energy[7], side ) == np.searchsorted( values, energy[7], side )
+
+    sub = axis[3::2]
+    np.testing.assert_array_equal( sub.searchsorted( energy ), np.searchsorted( values[3::2], energy ) )
+
+def test_from_array_round_trip_and_non_uniform_arrays():
+    energy = np.round( 99.3 + 0.05*np.arange( 300 ), 4 )
+    axis = EnergyAxis.from_array( energy )
+    np.testing.assert_array_equal( np.asarray( axis ), energy )
+    np.testing.assert_array_equal( axis.searchsorted( [99.3, 105.01, 120] ), np.searchsorted( energy, [99.3, 105.01, 120] ) )
+
+    energy[150] += 0.01
+    with pytest.raises( ValueError ):
+        EnergyAxis.from_array( energy )
+
+def test_get_hyperspy_data_returns_writable_ndarray():
+    hs = pytest.importorskip( 'hyperspy.api' )
+    from spectrum_image.EELS.EELS_util import get_hyperspy_data
+
+    signal = hs.signals.Signal1D( np.zeros( (2, 3, 50) ) )
+    signal.axes_manager[2].offset = 280.0
+    signal.axes_manager[2].scale = 0.1
+    energy, si, pxscale, disp, params = get_hyperspy_data( signal )
+
+    assert type( energy ) is np.ndarray and energy.flags.writeable
+    np.testing.assert_allclose( energy, 280 + 0.1*np.arange( 50 ) )
+    energy -= 280
+    assert energy.reshape( 5, 10 ).shape == (5, 10) and energy.tolist()[1] == pytest.approx( 0.1 )
@@ -0,0 +1,44 @@
+import numpy as np
+from scipy.optimize import minimize
+
+from spectrum_image.EELS.EELS_bgsub import poisson_regression
+
+
+def poisson_mle( y, X, link ):
+    # Maximum likelihood fit of Poisson counts y with mean exp(Xb) ('log') or Xb ('identity')
+    def nll( b ):
+        eta = X @ b
+        if link == 'log':
+            return np.sum( np.exp( eta ) - y*eta )
+        mu = np.maximum( eta, 1e-12 )
+        return np.sum( mu - y*np.log( mu ) )
+    b0 = np.linalg.lstsq( X, np.log( np.maximum( y, 1 ) ) if link == 'log' else y, rcond=None )[0]
+    return minimize( nll, b0, method='BFGS', options={'gtol': 1e-10} ).x
+
+def test_irls_converges_to_poisson_mle_of_power_law():
+    rng = np.random.default_rng( 7 )
+    energy = np.linspace( 250, 280, 60 )
+    X = np.stack( [np.ones( len(energy) ), np.log( energy/250 )], axis=1 )
+    r = rng.uniform( 2.5, 4, 5 )
+    y = rng.poisson( 20*(energy[:,None]/250)**-r ).astype( 'float64' )
+
+    b = poisson_regression( y, X, irls=20, log=True )
+    b_mle = np.stack( [poisson_mle( y[:,j], X, 'log' ) for j in range( y.shape[1] )], axis=1 )
+    np.testing.assert_allclose( b, b_mle, atol=1e-4 )
+    # Poisson score equations X^T (y - mu) = 0 hold at the IRLS solution
+    score = X.T @ (y - np.exp( X @ b ))
+    np.testing.assert_allclose( score, 0, atol=1e-6*y.sum( axis=0 ).max() )
+
+    # Without refinement the weighted log fit is close to, but not at, the MLE
+    b0 = poisson_regression( y, X, irls=0, log=True )
+    assert np.max( np.abs( b0 - b_mle ) ) > 1e-3
+
+def test_irls_identity_link_converges_to_poisson_mle():
+    rng = np.random.default_rng( 8 )
+    x = np.linspace( 0, 1, 50 )
+    X = np.stack( [np.ones( len(x) ), x], axis=1 )
+    y = rng.poisson( 30 - 20*x[:,None]*np.array( [0.5, 1.0, 1.2] ) ).astype( 'float64' )
+
+    b = poisson_regression( y, X, irls=30, log=False )
+    b_mle = np.stack( [poisson_mle( y[:,j], X, 'identity' ) for j in range( y.shape[1] )], axis=1 )
+    np.testing.assert_allclose( b, b_mle, atol=1e-4 )
@@ -0,0 +1,42 @@
+import numpy as np
+
+from spectrum_image.EELS.EELS_binning import quadtree_bins
+
+
+def reference_bins( counts, target_snr, mask, min_size ):
+    # Recursive quadtree, one tile at a time; returns the bins as sets of pixels
+    def split( y0, y1, x0, x1 ):
+        ym = (y0+y1)//2 if y1-y0 > 1 else y1
+        xm = (x0+x1)//2 if x1-x0 > 1 else x1
+        quads = [(y0, ym, x0, xm), (y0, ym, xm, x1), (ym, y1, x0, xm), (ym, y1, xm, x1)]
+        quads = [q for q in quads if mask[q[0]:q[1], q[2]:q[3]].any()]
+        snr_ok = all( np.sqrt( counts[q[0]:q[1], q[2]:q[3]][mask[q[0]:q[1], q[2]:q[3]]].sum() ) >= target_snr
+                      for q in quads )
+        if (y1-y0)*(x1-x0) > max( min_size, 1 ) and snr_ok:
+            return [b for q in quads for b in split( *q )]
+        ys, xs = np.nonzero( mask[y0:y1, x0:x1] )
+        return [frozenset( zip( ys+y0, xs+x0 ) )]
+    return set( split( 0, counts.shape[0], 0, counts.shape[1] ) )
+
+def bins_of( labels ):
+    return {frozenset( zip( *np.nonzero( labels == k ) ) ) for k in range( 1, labels.max()+1 )}
+
+def test_quadtree_bins_matches_recursive_reference():
+    rng = np.random.default_rng( 6 )
+    # Counts falling off across the image, so bins grow towards the low-count side
+    counts = rng.poisson( np.outer( np.linspace( 400, 5, 13 ), np.ones( 11 ) ) ).astype( 'float64' )
+    mask = np.ones( counts.shape, dtype=bool )
+    mask[9:, 7:] = False
+
+    for target_snr, min_size in [(15, 1), (30, 1), (15, 4)]:
+        labels = quadtree_bins( counts, target_snr, mask=mask, min_size=min_size )
+        assert np.all( (labels > 0) == mask )
+        assert bins_of( labels ) == reference_bins( counts, target_snr, mask, min_size )
+
+def test_quadtree_bins_reach_target_snr():
+    counts = np.outer( np.linspace( 200, 20, 16 ), np.ones( 16 ) )
+    labels = quadtree_bins( counts, 40 )
+    snr = np.sqrt( np.bincount( labels.ravel(), weights=counts.ravel() )[1:] )
+    assert np.all( snr >= 40 )
+    # Single pixels reach SNR 14 at most, so no bin is smaller than 8 pixels
+    assert np.bincount( labels.ravel() )[1:].min() >= 8
@@ -0,0 +1,30 @@
+import numpy as np
+
+from spectrum_image.EELS.EELS_cluster import cluster_SI, labels_to_masks
+
+
+def phase_si( rng ):
+    # Three phases with distinct spectral shapes in vertical bands, at varying intensity
+    ch = np.arange( 40 )
+    phases = np.stack( [np.exp( -0.5*((ch-c)/3)**2 ) for c in (8, 20, 32)] )
+    truth = np.repeat( np.repeat( np.arange( 3 ), 4 )[None], 10, axis=0 )
+    scale = rng.uniform( 50, 500, truth.shape )
+    si = scale[...,None]*phases[truth] + rng.normal( 0, 0.5, truth.shape + (40,) )
+    return si, truth
+
+def assert_same_partition( labels, truth ):
+    for k in range( truth.max()+1 ):
+        assert len( np.unique( labels[truth == k] ) ) == 1
+    assert len( np.unique( labels ) ) == truth.max()+1
+
+def test_cluster_SI_recovers_phases_and_their_mean_spectra():
+    rng = np.random.default_rng( 5 )
+    si, truth = phase_si( rng )
+
+    labels, mean_spectra = cluster_SI( si, 3, normalize=True, random_state=0, chunk_mb=1e-3 )
+    assert_same_partition( labels, truth )
+    for k, mask in enumerate( labels_to_masks( labels ) ):
+        np.testing.assert_allclose( mean_spectra[k], si[mask].mean( axis=0 ) )
+
+    labels, _ = cluster_SI( si, 3, n_components=4, normalize=True, random_state=0, chunk_mb=1e-3 )
+    assert_same_partition( labels, truth )
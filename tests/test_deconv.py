@@ -0,0 +1,50 @@
+import numpy as np
+from scipy import fft
+
+from spectrum_image.EELS.EELS_deconv import fourier_log, fourier_ratio
+
+
+def gaussian( x, x0, sigma, area=1 ):
+    return area*np.exp( -0.5*((x-x0)/sigma)**2 )/(np.sqrt( 2*np.pi )*sigma)
+
+def test_fourier_log_recovers_single_scattering_of_poisson_plural_spectrum():
+    ne, disp = 400, 0.5
+    energy = -5 + disp*np.arange( ne )
+    n = fft.next_fast_len( 2*ne, real=True )
+    loss = disp*np.arange( n )
+
+    zlp = gaussian( -5 + disp*np.arange( n ), 0, 0.5, 1e4 )
+    Z = fft.rfft( zlp )
+    ssd = []
+    spectra = []
+    for t in (0.3, 0.6, 1.0):
+        # Plasmon of relative intensity t, plural scattering from the Poisson series exp(S/I0)
+        S = fft.rfft( gaussian( loss, 20, 2, t*1e4 ) )
+        spectra.append( fft.irfft( Z*np.exp( S/1e4 ), n )[:ne] )
+        ssd.append( fft.irfft( Z*S/1e4, n )[:ne] )
+    si = np.reshape( spectra, (1, 3, ne) )
+
+    out = fourier_log( si, energy, ntaper=0, chunk_mb=1e-3 )
+    np.testing.assert_allclose( out[0], np.array( ssd ), atol=1e-3*np.max( ssd ) )
+    # Second and third order peaks at 40 and 60 eV are gone
+    assert np.all( np.abs( out[0][:, np.abs( energy-40 ) < 3] ) < 1e-2*np.max( ssd ) )
+
+def test_fourier_ratio_removes_low_loss_convolution():
+    ne_ll, ne_cl = 200, 300
+    energy_ll = -5 + 0.5*np.arange( ne_ll )
+    energy_cl = 200 + 0.5*np.arange( ne_cl )
+    n = fft.next_fast_len( ne_ll+ne_cl, real=True )
+    ch = np.arange( n )
+
+    ll = gaussian( ch, 10, 1, 1e4 ) + gaussian( ch, 50, 4, 3e3 )
+    edge = gaussian( ch, 120, 6, 500 )
+    cl = fft.irfft( fft.rfft( ll )*fft.rfft( edge )/1e4, n )
+
+    si_ll = np.tile( ll[:ne_ll], (2, 2, 1) )
+    si_cl = np.tile( cl[:ne_cl], (2, 2, 1) )
+    out = fourier_ratio( si_ll, si_cl, energy_ll, energy_cl, ntaper=0 )
+
+    # Reconvolved with the zero-loss peak only
+    zlp = ll[:ne_ll]*(np.arange( ne_ll ) <= 30)
+    expected = fft.irfft( fft.rfft( zlp, n )*fft.rfft( edge )/1e4, n )[:ne_cl]
+    np.testing.assert_allclose( out[1, 1], expected, atol=1e-3*expected.max() )
@@ -0,0 +1,46 @@
+import numpy as np
+from scipy.optimize import curve_fit
+
+from spectrum_image.EELS.EELS_fit import levenberg_marquardt, peak_model, fit_peaks
+
+
+def two_peaks( rng, x, m ):
+    # Two gaussians on a sloped background with per-spectrum positions and heights
+    p = np.stack( [rng.uniform( 50, 100, m ), rng.uniform( 2.8, 3.2, m ), np.full( m, 0.4 ),
+                   rng.uniform( 20, 60, m ), rng.uniform( 5.8, 6.2, m ), np.full( m, 0.6 ),
+                   np.full( m, 5.0 ), np.full( m, -0.3 )], axis=1 )
+    fun, names = peak_model( x, ['gaussian', 'gaussian'] )
+    return p, fun(p)[0], fun, names
+
+def test_levenberg_marquardt_matches_curve_fit_per_spectrum():
+    rng = np.random.default_rng( 10 )
+    x = np.linspace( 0, 9, 120 )
+    p_true, y, fun, names = two_peaks( rng, x, 20 )
+    y = y + rng.normal( 0, 1, y.shape )
+    p0 = np.array( [70, 3.1, 0.5, 40, 5.9, 0.5, 0, 0] )
+
+    p, cost = levenberg_marquardt( fun, p0, y, max_iter=200 )
+    for j in range( len( y ) ):
+        f1 = lambda x_, *q: fun( np.array( [q] ) )[0][0]
+        q, _ = curve_fit( f1, x, y[j], p0=p0 )
+        cost_ref = np.sum( (y[j] - f1( x, *q ))**2 )
+        assert cost[j] <= cost_ref*(1 + 1e-6)
+        np.testing.assert_allclose( p[j], q, rtol=1e-3, atol=1e-3 )
+    np.testing.assert_allclose( cost, np.sum( (y - fun( p )[0])**2, axis=-1 ) )
+
+def test_levenberg_marquardt_keeps_fixed_parameters_and_fit_peaks_recovers_exact_data():
+    rng = np.random.default_rng( 11 )
+    x = np.linspace( 0, 9, 120 )
+    p_true, y, fun, names = two_peaks( rng, x, 12 )
+
+    # Widths held at the wrong value stay there
+    free = np.ones( len( names ), dtype=bool )
+    free[[2, 5]] = False
+    p0 = np.array( [70, 3.1, 0.5, 40, 5.9, 0.5, 0, 0] )
+    p, cost = levenberg_marquardt( fun, p0, y, free=free )
+    np.testing.assert_array_equal( p[:, [2, 5]], 0.5 )
+    assert np.all( cost > 0 )
+
+    params, cost, names_fit = fit_peaks( y, x, ['gaussian', 'gaussian'], p0[:6], block=5 )
+    assert names_fit == names
+    np.testing.assert_allclose( params, p_true, rtol=1e-5, atol=1e-5 )
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+import spectrum_image.EELS.EELS_lineshapes as ls
+
+x = np.linspace( 1.5, 9, 200 )
+# Parameters of every lineshape, scalars and one (npix,) set
+params = {'gaussian':     [(80, 5, 0.7),  ([80, 30, 5], [5, 4, 6], [0.7, 1.2, 0.4])],
+          'lorentzian':   [(80, 5, 0.7),  ([80, 30, 5], [5, 4, 6], [0.7, 1.2, 0.4])],
+          'pseudo_voigt': [(80, 5, 0.7, 0.3), ([80, 30, 5], [5, 4, 6], [0.7, 1.2, 0.4], [0.3, 0.9, 0.1])],
+          'voigt':        [(80, 5, 0.7, 0.4), ([80, 30, 5], [5, 4, 6], [0.7, 1.2, 0.4], [0.4, 0.1, 1.0])],
+          'powerlaw':     [(1e4, 3),      ([1e4, 5e3, 2e4], [3, 2.5, 4])],
+          'lcpowerlaw':   [(1e4, 3, 5e3, 2), ([1e4, 5e3, 2e4], [3, 2.5, 4], [5e3, 1e3, 1e2], [2, 1.5, 3.5])],
+          'exponential':  [(50, 0.4),     ([50, 20, 80], [0.4, 0.1, 1.1])],
+          'linear':       [(-2, 7),       ([-2, 0.5, 3], [7, 1, -4])]}
+
+def numeric_jacobian( f, p, h=1e-6 ):
+    # Central differences (nparam, ...) of f( *p ) with relative steps
+    jac = []
+    for i in range( len( p ) ):
+        step = h*np.maximum( np.abs( p[i] ), 1 )
+        lo, hi = list( p ), list( p )
+        lo[i], hi[i] = p[i]-step, p[i]+step
+        d = 2*step[...,None] if step.ndim else 2*step
+        jac.append( (f( *hi ) - f( *lo ))/d )
+    return np.array( jac )
+
+@pytest.mark.parametrize( 'name', sorted( params ) )
+def test_jacobians_match_finite_differences( name ):
+    vj = ls.lineshapes[name][0]
+    value = getattr( ls, name )
+    deriv = getattr( ls, 'd_' + name )
+    for p in params[name]:
+        p = [np.asarray( q, dtype='float64' ) for q in p]
+        f = lambda *q: value( x, *q )
+        f_num = numeric_jacobian( f, p )
+        scale = np.max( np.abs( f_num ), axis=-1, keepdims=True )
+
+        out, jac = vj( x, *p )
+        np.testing.assert_allclose( out, f( *p ), rtol=1e-12 )
+        np.testing.assert_allclose( jac, f_num, rtol=1e-5, atol=1e-6*np.max( scale ) )
+
+        d = deriv( x, *p )
+        if p[0].ndim == 0:
+            assert d.shape == (len( x ), len( p ))
+            np.testing.assert_allclose( d.T, f_num, rtol=1e-5, atol=1e-6*np.max( scale ) )
+        else:
+            np.testing.assert_allclose( d, jac )
+
+        # value_and_jacobian with a (npix, nparam) array and preallocated buffers
+        if p[0].ndim:
+            out_buf, jac_buf = np.empty( out.shape ), np.empty( jac.shape )
+            ls.value_and_jacobian( name, x, np.stack( p, axis=1 ), out=out_buf, jac=jac_buf )
+            np.testing.assert_allclose( out_buf, out )
+            np.testing.assert_allclose( jac_buf, jac )
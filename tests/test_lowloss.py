@@ -0,0 +1,45 @@
+import numpy as np
+
+from spectrum_image.EELS.EELS_lowloss import thickness_map, splice_dual
+
+
+def lowloss_si( tlambda, energy ):
+    # Zero-loss peak of unit area at 0 eV plus a plasmon carrying exp(t/lambda)-1 of it
+    zlp = np.exp( -0.5*(energy/0.5)**2 )
+    plasmon = np.exp( -0.5*((energy-20)/3)**2 )
+    zlp, plasmon = zlp/zlp.sum(), plasmon/plasmon.sum()
+    return 1e4*(zlp + (np.exp( tlambda )-1)[...,None]*plasmon)
+
+def test_thickness_map_log_ratio_with_detected_and_fixed_zlp_window():
+    energy = np.arange( -5, 60, 0.25 )
+    tlambda = np.linspace( 0.1, 1.5, 12 ).reshape( 3, 4 )
+    si = lowloss_si( tlambda, energy )
+    si[2, 3] = 0
+
+    expected = tlambda.copy()
+    expected[2, 3] = np.nan
+    np.testing.assert_allclose( thickness_map( si, energy, chunk_mb=1e-3 ), expected, rtol=1e-6 )
+    np.testing.assert_allclose( thickness_map( si, energy, zlp_window=(-5, 5) ), expected, rtol=1e-6 )
+
+    t, mask = thickness_map( si, energy, mask_threshold=0.5 )
+    np.testing.assert_array_equal( mask, np.nan_to_num( expected ) > 0.5 )
+
+def test_splice_dual_aligns_without_wrapping_steps_around():
+    energy_ll = -10 + 0.25*np.arange( 120 )
+    energy_hl = 15 + 0.25*np.arange( 200 )
+    zlp_at = np.array( [[2.0, -2.0]] )
+    si_ll = 1e4*np.exp( -0.5*((energy_ll - zlp_at[...,None])/0.4)**2 )
+    # High-loss step at 30 eV, continuing up to the end of the axis
+    si_hl = np.where( energy_hl - zlp_at[...,None] < 30, 100.0, 1000.0 )
+
+    si, energy = splice_dual( si_ll, si_hl, energy_ll, energy_hl, chunk_mb=1e-3 )
+    assert si.shape == (1, 2, 300)
+    np.testing.assert_allclose( energy[np.argmax( si[0], axis=-1 )], 0 )
+
+    # Shifted down by 8 channels: the end is vacated, not filled with the 100 count start
+    np.testing.assert_allclose( si[0, 0, -8:], 0 )
+    np.testing.assert_allclose( si[0, 0, 200:292], 1000, rtol=1e-4 )
+    # Shifted up by 8 channels: the start of the high-loss half is vacated, not filled with the step
+    np.testing.assert_allclose( si[0, 1, 100:108], 0, atol=1e-3 )
+    np.testing.assert_allclose( si[0, 1, 108:160], 100, rtol=1e-4 )
+    np.testing.assert_allclose( si[0, 1, 180:], 1000, rtol=1e-4 )
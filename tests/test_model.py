@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from spectrum_image.EELS.EELS_model import CompositeModel
+
+
+def test_composite_fit_with_fixed_and_linked_parameters():
+    rng = np.random.default_rng( 12 )
+    x = np.linspace( 0, 10, 150 )
+    model = CompositeModel( ['linear', 'gaussian', 'gaussian'] )
+    assert model.names == ['c0_a', 'c0_b', 'c1_A', 'c1_e0', 'c1_sg', 'c2_A', 'c2_e0', 'c2_sg']
+
+    # Equal widths and a fixed 2.5 eV splitting; the background slope is known
+    model.fix( 'c0_a', -0.5 )
+    model.link( 'c2_sg', 'c1_sg' )
+    model.link( 'c2_e0', 'c1_e0', offset=2.5 )
+    assert model.free_names() == ['c0_b', 'c1_A', 'c1_e0', 'c1_sg', 'c2_A']
+
+    m = 6
+    e1 = rng.uniform( 3, 4, m )
+    sg = rng.uniform( 0.4, 0.6, m )
+    p_true = np.stack( [np.full( m, -0.5 ), np.full( m, 8.0 ), rng.uniform( 40, 60, m ), e1, sg,
+                        rng.uniform( 10, 30, m ), e1+2.5, sg], axis=1 )
+    y = model( x, p_true )
+
+    # Fixed and linked entries of p0 are ignored, even if they are wrong
+    p0 = np.array( [3.0, 7, 50, 3.5, 0.5, 20, 99.0, 9.0] )
+    p, cost = model.fit( y, x, p0 )
+    np.testing.assert_allclose( p, p_true, rtol=1e-6, atol=1e-6 )
+    np.testing.assert_allclose( cost, 0, atol=1e-12 )
+
+    # fix after link replaces the link
+    model.fix( 'c2_e0', 6.0 )
+    T, c = model.transform()
+    assert 'c2_e0' not in model.links and c[6] == 6.0 and not T[6].any()
+
+def test_circular_links_raise():
+    model = CompositeModel( ['gaussian', 'gaussian'] )
+    model.link( 'c0_sg', 'c1_sg' )
+    model.link( 'c1_sg', 'c0_sg' )
+    with pytest.raises( ValueError ):
+        model.transform()
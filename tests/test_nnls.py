@@ -0,0 +1,31 @@
+import numpy as np
+from scipy.optimize import nnls
+
+from spectrum_image.EELS.EELS_bgsub import nnls_batch
+
+
+def test_nnls_batch_matches_scipy_on_ill_conditioned_powerlaw_basis():
+    # 3-component LC power-law basis as built by lc_basis for perc=(5,50,95)
+    rng = np.random.default_rng( 1 )
+    e = np.linspace( 400, 450, 100 )
+    X = np.stack( [e**-r for r in (2.49, 3.0, 3.52)], axis=1 )
+    b_true = np.abs( rng.normal( size=(3, 300) ) )*np.array( [[1e7], [1e10], [1e12]] )
+    Y = rng.poisson( X @ b_true ).astype( 'float64' )
+
+    b = nnls_batch( Y, X )
+    b_ref = np.stack( [nnls( X, Y[:, j] )[0] for j in range( Y.shape[1] )], axis=1 )
+
+    assert np.all( b >= 0 )
+    res = np.linalg.norm( X @ b - Y, axis=0 )
+    res_ref = np.linalg.norm( X @ b_ref - Y, axis=0 )
+    np.testing.assert_array_less( res, res_ref*(1 + 1e-9) + 1e-12 )
+
+
+def test_nnls_batch_matches_scipy_coefficients():
+    rng = np.random.default_rng( 0 )
+    X = np.abs( rng.normal( size=(200, 5) ) )
+    Y = X @ np.maximum( rng.normal( size=(5, 500) ), 0 ) + rng.normal( 0, 0.3, (200, 500) )
+
+    b = nnls_batch( Y, X )
+    b_ref = np.stack( [nnls( X, Y[:, j] )[0] for j in range( Y.shape[1] )], axis=1 )
+    np.testing.assert_allclose( b, b_ref, atol=1e-8 )
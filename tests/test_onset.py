@@ -0,0 +1,34 @@
+import numpy as np
+
+from spectrum_image.EELS.EELS_onset import edge_onset, onset_map, detect_edge
+
+
+def edge_si( energy, onsets, width=1.0 ):
+    # Decaying background plus a smooth step centred on onsets (ny,nx)
+    step = 0.5*(1 + np.tanh( (energy - onsets[...,None])/width ))
+    return 1e4*(energy/energy[0])**-3 + 400*step
+
+def test_onset_map_follows_chemical_shift_with_and_without_smoothing():
+    energy = np.arange( 250, 330, 0.25 )
+    onsets = np.linspace( 282, 288, 12 ).reshape( 3, 4 )
+    si = edge_si( energy, onsets ).astype( 'float32' )
+    mask = np.ones( (3, 4), dtype=bool )
+    mask[2, 3] = False
+
+    for sigma in (0, 2):
+        onset = onset_map( si, energy, (270, 300), sigma=sigma, level=1, mask=mask, chunk_mb=1e-3 )
+        assert np.isnan( onset[2, 3] )
+        # level=1 gives the inflection point, the centre of the step on the sloped background
+        np.testing.assert_allclose( onset[mask], onsets[mask], atol=0.3 )
+        np.testing.assert_allclose( onset[mask], edge_onset( si[mask][:, 80:200], energy[80:200], sigma=sigma, level=1 ),
+                                    atol=1e-6 )
+
+def test_detect_edge_windows_bracket_the_onsets():
+    energy = np.arange( 250, 330, 0.25 )
+    onsets = np.linspace( 282, 288, 12 ).reshape( 3, 4 )
+    edge, onset = detect_edge( edge_si( energy, onsets ), energy, (270, 300), label='C K', level=0.2, bsub_width=20 )
+    assert edge.label == 'C K'
+    # Background window ends 2 eV below the earliest onsets, integration starts at the median onset
+    np.testing.assert_allclose( edge.e_bsub, np.percentile( onset, 1 ) - np.array( [22, 2] ), atol=1e-4 )
+    np.testing.assert_allclose( edge.e_int, np.median( onset ) + np.array( [0, 30] ), atol=1e-4 )
+    assert edge.e_bsub[1] < onsets.min()
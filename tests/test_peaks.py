@@ -0,0 +1,49 @@
+import numpy as np
+
+from spectrum_image.EELS.EELS_peaks import peak_position, centroid, fwhm, peak_maps
+
+
+def gaussians( x, e0, sg, A=1.0 ):
+    return A*np.exp( -0.5*((x - e0[...,None])/sg)**2 )
+
+def test_peak_position_height_centroid_and_fwhm_of_sampled_gaussians():
+    x = np.linspace( 0, 10, 101 )
+    e0 = np.array( [[4.013, 5.5], [6.27, 3.951]] )
+    spectra = gaussians( x, e0, 0.5, 3.0 )
+
+    position, height = peak_position( spectra, x, method='gaussian' )
+    np.testing.assert_allclose( position, e0, atol=1e-10 )
+    np.testing.assert_allclose( height, 3.0, rtol=1e-10 )
+    position, height = peak_position( spectra, x )
+    np.testing.assert_allclose( position, e0, atol=5e-3 )
+    np.testing.assert_allclose( height, 3.0, rtol=5e-3 )
+
+    np.testing.assert_allclose( centroid( spectra, x ), e0, atol=1e-8 )
+    np.testing.assert_allclose( centroid( spectra + 0.2*x/10, x, baseline=True ), e0, atol=5e-3 )
+    np.testing.assert_allclose( fwhm( spectra, x ), 2.3548*0.5, rtol=1e-2 )
+    np.testing.assert_allclose( fwhm( spectra + 0.7, x, baseline=0.7 ), 2.3548*0.5, rtol=1e-2 )
+
+def test_peak_estimators_on_non_uniform_axis_and_cut_peaks():
+    ch = np.linspace( 0, 1, 200 )
+    x = 10*ch**2
+    # Gaussian in channel space: the position maps through the axis, the width does not
+    spectrum = gaussians( ch, np.array( 0.6 ), 0.05 )
+    position, _ = peak_position( spectrum, x, method='gaussian' )
+    np.testing.assert_allclose( position, 3.6, rtol=1e-3 )
+
+    cut = gaussians( np.linspace( 0, 10, 101 ), np.array( 9.8 ), 0.5 )
+    assert np.isnan( fwhm( cut, np.linspace( 0, 10, 101 ) ) )
+
+def test_peak_maps_streams_window_and_applies_mask():
+    energy = np.linspace( 0, 20, 401 )
+    e0 = np.linspace( 8, 12, 12 ).reshape( 3, 4 )
+    si = gaussians( energy, e0, 0.8, 100 ).astype( 'float32' )
+    mask = np.ones( (3, 4), dtype=bool )
+    mask[0, 0] = False
+
+    maps = peak_maps( si, energy, (2, 18), method='gaussian', mask=mask, chunk_mb=1e-3 )
+    assert np.isnan( maps['position'][0, 0] ) and np.isnan( maps['fwhm'][0, 0] )
+    np.testing.assert_allclose( maps['position'][mask], e0[mask], atol=1e-4 )
+    np.testing.assert_allclose( maps['centroid'][mask], e0[mask], atol=1e-4 )
+    np.testing.assert_allclose( maps['height'][mask], 100, rtol=1e-4 )
+    np.testing.assert_allclose( maps['fwhm'][mask], 2.3548*0.8, rtol=2e-3 )
@@ -0,0 +1,20 @@
+import os
+import numpy as np
+
+from spectrum_image.EELS.EELS_pipeline import options_pipeline, process_si
+
+
+def test_process_si_skips_params_file_for_sampled_lc( tmp_path ):
+    rng = np.random.default_rng( 4 )
+    energy = np.arange( 300, 500, 1.0 )
+    r = rng.uniform( 2.5, 3.5, (6, 5) )
+    si = 1e9*energy**-r[..., None]
+    si[..., energy >= 400] *= 1.2
+
+    options = options_pipeline( edges=[['C K', 320, 390, 400, 440]], outdir=str( tmp_path ),
+                                fit_options={'fit': 'pl', 'log': True, 'lc': True, 'lc_sample': 10, 'lc_seed': 0} )
+    process_si( si, energy, options, 'sample' )
+
+    files = sorted( os.listdir( tmp_path ) )
+    assert files == ['sample_C_K_map.npy']
+    assert np.load( tmp_path/files[0], allow_pickle=False ).shape == (6, 5)
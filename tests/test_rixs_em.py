@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from spectrum_image.RIXS.RIXS_EM import EnergyMap
+
+
+def elastic_map( eloss, einc, centers ):
+    return np.exp( -0.5*((eloss[:,None] - centers[None,:])/0.1)**2 )
+
+def test_energy_map_keeps_uniform_axis_values():
+    eloss = np.linspace( -1, 8, 91 )
+    einc = np.linspace( 530, 537, 15 )
+    em = EnergyMap( elastic_map( eloss, einc, np.zeros( 15 ) ), einc, eloss )
+    assert np.array_equal( em.eloss, eloss ) and np.array_equal( em.einc, einc )
+
+    # Descending axes are reversed, not rounded
+    em = EnergyMap( elastic_map( eloss, einc, np.zeros( 15 ) )[::-1], einc, eloss[::-1] )
+    assert np.array_equal( em.eloss, eloss )
+
+    grid = np.linspace( -1, 8, 46 )
+    assert np.array_equal( em.regrid( einc=False, eloss=grid ).eloss, grid )
+
+def test_align_elastic_on_caller_axis():
+    eloss = np.linspace( -1, 8, 91 )
+    einc = np.linspace( 530, 537, 15 )
+    centers = np.linspace( -0.3, 0.3, 15 )
+    aligned, shifts = EnergyMap( elastic_map( eloss, einc, centers ), einc, eloss ).align_elastic()
+
+    np.testing.assert_allclose( shifts, -centers, atol=5e-3 )
+    assert np.array_equal( aligned.eloss, eloss )
+    np.testing.assert_array_equal( np.argmax( aligned.si, axis=0 ), np.argmin( np.abs( eloss ) ) )
+
+    irregular = np.sort( np.concatenate( [eloss[:-1], [7.95]] ) )
+    with pytest.raises( ValueError ):
+        EnergyMap( elastic_map( irregular, einc, centers ), einc, irregular ).align_elastic()
@@ -0,0 +1,31 @@
+import numpy as np
+
+from spectrum_image.RIXS.RIXS_stack import EnergyMapStack
+
+
+def test_stack_indexing_and_cached_projections_on_memmap( tmp_path ):
+    rng = np.random.default_rng( 9 )
+    data = rng.random( (4, 3, 20, 15) ).astype( 'float32' )
+    data[1, 2, 5, 7] = np.nan
+    np.save( tmp_path/'stack.npy', data )
+    clean = np.nan_to_num( data ).astype( 'float64' )
+
+    eloss = -1 + 0.5*np.arange( 20 )
+    einc = 530 + 0.5*np.arange( 15 )
+    stack = EnergyMapStack.from_npy( tmp_path/'stack.npy', einc, eloss, axes=[np.arange( 4 )*10., [1, 2, 3]],
+                                     names=['T', 'q'] )
+    assert isinstance( stack.data, np.memmap ) and len( stack ) == 4
+
+    em = stack[2, 1]
+    np.testing.assert_array_equal( em.si, data[2, 1] )
+    np.testing.assert_allclose( np.asarray( em.eloss ), eloss )
+
+    sub = stack[1:3, 2]
+    assert sub.extra_shape == (2,) and sub.names == ['T']
+    np.testing.assert_array_equal( sub.axes[0], [10., 20.] )
+
+    np.testing.assert_allclose( stack.projection( 'T' ), clean.mean( axis=0 ), rtol=1e-6 )
+    np.testing.assert_allclose( stack.projection( ['q', 'eloss'], reduce='sum', chunk_mb=1e-3 ),
+                                clean.sum( axis=(1, 2) ), rtol=1e-5 )
+    assert stack.projection( 'T' ) is stack.projection( 'T' )
+    np.testing.assert_allclose( stack.mean_map().si, clean.mean( axis=(0, 1) ), rtol=1e-6 )
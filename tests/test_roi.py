@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from spectrum_image.EELS.EELS_roi import rect_mask, roi_matrix, roi_spectra, line_profile
+
+
+def test_roi_spectra_matches_masked_means_for_masks_and_labels():
+    rng = np.random.default_rng( 3 )
+    si = rng.random( (9, 7, 20) )
+    si[4, 2, 5] = np.nan
+
+    masks = [rect_mask( (9, 7), np.arange( 7 ), np.arange( 9 ), (1, 4, 2, 6) ),
+             np.zeros( (9, 7), dtype=bool )]
+    masks[1][8, 6] = True
+    masks[1][0, 0] = True
+
+    clean = np.nan_to_num( si )
+    expected = np.stack( [clean[m].mean( axis=0 ) for m in masks] )
+    np.testing.assert_allclose( roi_spectra( si, masks, chunk_mb=1e-3 ), expected )
+
+    labels = np.zeros( (9, 7), dtype=int )
+    labels[masks[0]] = 1
+    labels[masks[1]] = 2
+    np.testing.assert_allclose( roi_spectra( si, labels ), expected )
+    np.testing.assert_allclose( roi_spectra( si, roi_matrix( masks ) ), expected )
+
+
+def test_roi_spectra_reads_only_rows_touched_by_rois():
+    class RowLog( np.ndarray ):
+        read = []
+        def __getitem__( self, key ):
+            if isinstance( key, slice ):
+                RowLog.read.append( key )
+            return np.ndarray.__getitem__( self, key )
+
+    si = np.arange( 10*4*3, dtype='float64' ).reshape( 10, 4, 3 ).view( RowLog )
+    mask = np.zeros( (10, 4), dtype=bool )
+    mask[6, 1:3] = True
+
+    spectra = roi_spectra( si, [mask], chunk_mb=1e-4 )
+    np.testing.assert_allclose( spectra[0], np.asarray( si )[6, 1:3].mean( axis=0 ) )
+    assert RowLog.read and all( 6 <= key.start and key.stop <= 7 for key in RowLog.read )
+
+
+def test_line_profile_averages_across_width_and_rejects_zero_length_lines():
+    # Intensity = x + 10*y, so a horizontal line samples x + 10*y0, averaged over its width
+    y, x = np.mgrid[0:8, 0:9].astype( 'float64' )
+    data = np.stack( [x + 10*y, np.ones_like( x )], axis=-1 )
+
+    profile, t = line_profile( data, (1, 4), (6, 4), width=3 )
+    np.testing.assert_allclose( t, np.arange( 6 ) )
+    np.testing.assert_allclose( profile[:, 0], np.arange( 1, 7 ) + 40 )
+    np.testing.assert_allclose( profile[:, 1], 1 )
+
+    with pytest.raises( ValueError ):
+        line_profile( data, (2, 3), (2, 3) )
@@ -0,0 +1,31 @@
+import numpy as np
+
+from spectrum_image.EELS.EELS_stats import SIStats
+
+
+def test_sistats_matches_numpy_reductions_with_nans():
+    rng = np.random.default_rng( 2 )
+    si = rng.random( (6, 5, 12) ).astype( 'float32' )
+    si[1, 3, 4] = np.nan
+    clean = np.nan_to_num( si ).astype( 'float64' )
+
+    stats = SIStats( si, chunk_mb=1e-3 )
+    np.testing.assert_allclose( stats.sum_spectrum, clean.sum( axis=(0,1) ), rtol=1e-6 )
+    np.testing.assert_allclose( stats.sum_image, clean.sum( axis=-1 ), rtol=1e-6 )
+    np.testing.assert_allclose( stats.mean_spectrum, clean.mean( axis=(0,1) ), rtol=1e-6 )
+    np.testing.assert_allclose( stats.mean_image, clean.mean( axis=-1 ), rtol=1e-6 )
+    np.testing.assert_array_equal( stats.min_spectrum, clean.min( axis=(0,1) ) )
+    np.testing.assert_array_equal( stats.max_spectrum, clean.max( axis=(0,1) ) )
+    assert stats.min == clean.min() and stats.max == clean.max()
+
+
+def test_sistats_recomputes_only_after_invalidate():
+    si = np.ones( (2, 3, 4) )
+    stats = SIStats( si )
+    assert stats.max == 1
+
+    si[0, 0, 0] = 5
+    assert stats.max == 1
+    stats.invalidate()
+    assert stats.max == 5
+    assert stats.sum_image[0, 0] == 8